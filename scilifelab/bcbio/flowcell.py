@@ -7,6 +7,8 @@ import json
 import csv
 import glob
 import copy
+import collections
+import numpy as np
 from cStringIO import StringIO
 from scilifelab.utils.misc import filtered_walk
 from scilifelab.log import minimal_logger
@@ -19,16 +21,118 @@ LOG = minimal_logger(__name__)
 ## FIX ME: make generic flowcell object, that then Illumina, MiSeq,
 ## SOLiD subclass from
 
-## FIX ME: the representation of flowcells and samples is still
-## cumbersome. One solution would be to use DataFrame from pandas. For
-## casava structure, grouping/collection of files should be done on a
-## sample-level basis, making the flowcell object slightly obsolete in
-## these cases.
+## FIX ME: for casava structure, grouping/collection of files should
+## be done on a sample-level basis, making the flowcell object
+## slightly obsolete in these cases.
+
+## Lane files, as in 1_120829_AA001AAAXX_nophix.bc_metrics or 1_120829_AA001AAAXX_nophix_1_fastq.txt
+re_lane_file = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?\.(filter|bc)_metrics|^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_[12]_fastq.txt')
+## Sample files, as in 1_120829_AA001AAAXX_nophix_10_1_fastq.txt
+re_sample_file = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_([0-9]+|unmatched).*')
+re_casava_sequence_file = re.compile("fastq(\.gz)?$")
+
+class PrefixTrie(object):
+    """Trie of string prefixes, for finding the prefixes of a string
+    in time linear in its length."""
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        """Add a prefix. The first value added for a prefix is kept.
+
+        :param prefix: prefix string
+        :param value: value associated with prefix
+        """
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node.setdefault("", value)
+
+    def prefixes(self, s):
+        """Find the prefixes of a string.
+
+        :param s: string
+
+        :returns: list of (prefix length, value) tuples, shortest prefix first
+        """
+        res = []
+        node = self.root
+        for i, c in enumerate(s):
+            if "" in node:
+                res.append((i, node[""]))
+            node = node.get(c, None)
+            if node is None:
+                return res
+        if "" in node:
+            res.append((len(s), node[""]))
+        return res
+
+class FileClassifier(object):
+    """Classifier of the files of a flowcell by lane and sample.
+
+    The classifier is built once from the run information. Lane and
+    sample file names are matched with precompiled patterns, and
+    casava sample names are looked up in a prefix trie, so that files
+    are classified in time independent of the number of samples.
+
+    :param fc: <Flowcell> object
+    """
+    def __init__(self, fc):
+        self.samples = set(fc.samples.keys())
+        self.lanes = set(str(x) for x in fc._lane_index().keys())
+        self.id_to_sequence = dict((lane, d["id_to_sequence"]) for lane, d in fc._lane_index().items())
+        self.names = PrefixTrie()
+        for i in range(len(fc)):
+            name = fc._value(i, 'name')
+            if not name is None:
+                ## Value holds the row order, as the first of several matching names is used
+                self.names.add(str(name), (i, "{}_{}".format(fc._value(i, 'lane'), fc._value(i, 'sequence'))))
+
+    def classify(self, f, strict=False):
+        """Classify a file.
+
+        :param f: file name
+        :param strict: only classify casava sample files whose name is followed by '_' or '-', as in glob_pfx_str
+
+        :returns: tuple of ('lane', lane) for lane files, ('files', sample key) for sample sequence files, ('results', sample key) for other sample files, or None for files of other lanes and samples
+        """
+        fn = os.path.basename(f)
+        if re_lane_file.match(fn):
+            lane = fn.split("_")[0]
+            return ("lane", lane) if lane in self.lanes else None
+        m_sample = re_sample_file.match(fn)
+        if m_sample:
+            lane = m_sample.group(1)
+            sample = m_sample.group(3)
+            if sample == "unmatched":
+                return ("lane", lane) if lane in self.lanes else None
+            key = "{}_{}".format(lane, self.id_to_sequence.get(lane, {}).get(int(sample), None))
+            if not key in self.samples:
+                return None
+            return ("files" if f.find("fastq.txt") > 0 else "results", key)
+        matches = self.names.prefixes(fn)
+        if strict:
+            matches = [(n, v) for n, v in matches if fn[n:n + 1] in ["_", "-"]]
+        if matches:
+            key = min(v for n, v in matches)[1]
+            return ("files" if re_casava_sequence_file.search(f) else "results", key)
+        return None
+
+def _object_array(values):
+    """Make a one-dimensional object array, also of list values"""
+    arr = np.empty(len(values), dtype=object)
+    for i, x in enumerate(values):
+        arr[i] = x
+    return arr
 
 class Flowcell(object):
     """Class for handling (Illumina) run information.
 
-    Run information is stored as a table."""
+    Run information is stored as a table, one object array per column.
+    A flowcell holds the positions of its rows in the columns, so that
+    subsets are views that share the columns, and thereby the sample
+    files and results, with the flowcell they were taken from. Sample
+    keys and per-lane barcode mappings are indexed once, on first use."""
     ## Run information
     fc_name = None
     fc_date = None
@@ -41,27 +145,53 @@ class Flowcell(object):
     ## csv keys
     _csv_keys = ['flowcell_id', 'lane', 'name', 'genome_build', 'sequence', 'sample_prj', 'control', 'recipe', 'operator', 'sample_prj']
 
-    ## sample keys
-    samples = dict()
-    ## lane files
-    lane_files = dict()
-    ## results
-    results = list()
-    
     # keys to be printed for yaml output
     _out_yaml_keys = dict(lane= ['lane', 'lane_description', 'flowcell_id', 'lane_analysis', 'genome_build'],
                      mp = ['mp_analysis', 'barcode_id', 'barcode_type', 'sample_prj', 'name', 'sequence', 'files', 'genomes_filter_out', 'mp_description'])
     ## keys to write for table
     _out_table_columns = ['lane', 'lane_description', 'flowcell_id', 'lane_analysis', 'genome_build', 'barcode_id', 'barcode_type', 'sample_prj', 'name', 'sequence', 'genomes_filter_out']
+    ## columns whose values are not indexed
+    _file_keys = ['files', 'results']
 
     def __init__(self, infile=None):
         self.filename = None
         self.path = None
-        self.data = None
         self.i = 0
+        ## sample keys
+        self.samples = dict()
+        ## lane files
+        self.lane_files = dict()
+        ## results
+        self.results = list()
+        self._columns = None
+        self._rows = np.array([], dtype=int)
+        ## Modification count of indexed columns, shared with subsets
+        self._stamp = [0]
+        self._indexed = None
+        self._lanes = None
+        self._classifier = None
         if not infile:
             return
         self.data = self._read(infile)
+
+    @property
+    def data(self):
+        """Run information as a list of rows, or None if no run
+        information has been loaded. Rows are copies; use set_entry to
+        modify entries."""
+        if self._columns is None:
+            return None
+        return [self._row(i) for i in range(len(self._rows))]
+
+    @data.setter
+    def data(self, data):
+        if data is None:
+            self._columns = None
+            self._rows = np.array([], dtype=int)
+        else:
+            self._columns = dict((k, _object_array([row[j] for row in data])) for j, k in enumerate(self.keys))
+            self._rows = np.arange(len(data))
+        self._stamp = [0]
         self._set_sample_dict()
 
     def fc_id(self):
@@ -74,10 +204,10 @@ class Flowcell(object):
         return self
 
     def next(self):
-        if self.i >= len(self.data):
+        if self.i >= len(self):
             self.i = 0
             raise StopIteration
-        row = self.data[self.i]
+        row = self._row(self.i)
         self.i = self.i + 1 
         return dict(zip(self.keys, row))
 
@@ -88,9 +218,8 @@ class Flowcell(object):
         fh = StringIO()
         w = csv.writer(fh, delimiter="\t", quoting=True)
         tab_out = []
-        for row in self.data:
-            h = self._keys['lane'] + self._keys['mp']
-            d = dict(zip(h, row))
+        for i in range(len(self)):
+            d = dict(zip(self.keys, self._row(i)))
             if not d.get("barcode_id", None):
                 continue
             tab_out.append([d[k] for k in self._out_table_columns])
@@ -98,9 +227,7 @@ class Flowcell(object):
         return fh.getvalue()
 
     def __len__(self):
-        if not self.data:
-            return 0
-        return len(self.data)
+        return len(self._rows)
 
     def _read(self, infile):
         """Read infile. Pass to correct read wrapper."""
@@ -149,14 +276,52 @@ class Flowcell(object):
         return self._tab_to_yaml()
 
     def _set_sample_dict(self):
-        i = 0
+        """Index the rows by sample key, lane and casava sample name"""
         self.samples = {}
-        for row in self.data:
-            d = dict(zip(self.keys, row))
-            key = "{}_{}".format(d['lane'], d['sequence'])
+        self._lanes = None
+        self._classifier = None
+        for i in range(len(self)):
+            key = "{}_{}".format(self._value(i, 'lane'), self._value(i, 'sequence'))
             self.samples[key] = i
-            i += 1
-            
+        self._indexed = self._stamp[0]
+
+    def _reindex(self):
+        """Rebuild the indexes if indexed columns have been modified, possibly in a subset"""
+        if self._indexed != self._stamp[0]:
+            self._set_sample_dict()
+
+    def _lane_index(self):
+        """Get the per-lane index of barcode ids, names and sequences.
+
+        :returns: dictionary mapping lane to a dictionary mapping barcode_id, name and sequence to lists of values
+        """
+        self._reindex()
+        if self._lanes is None:
+            self._lanes = collections.OrderedDict()
+            for i in range(len(self)):
+                d = self._lanes.setdefault(self._value(i, 'lane'), dict(barcode_id=[], name=[], sequence=[]))
+                for k in d.keys():
+                    x = self._value(i, k)
+                    if not x is None:
+                        d[k].append(x)
+            ## Barcode id to sequence map, used when classifying files
+            for d in self._lanes.values():
+                d['id_to_sequence'] = dict(zip(d['barcode_id'], d['sequence']))
+        return self._lanes
+
+    def _lane_values(self, lane, label):
+        return self._lane_index().get(lane, {}).get(label, [])
+
+    def file_classifier(self):
+        """Get the file classifier of the flowcell, built on first use.
+
+        :returns: <FileClassifier> object
+        """
+        self._reindex()
+        if self._classifier is None:
+            self._classifier = FileClassifier(self)
+        return self._classifier
+
     def _yaml_to_tab(self, runinfo_yaml):
         """Convert yaml to internal representation"""
         out = []
@@ -180,8 +345,8 @@ class Flowcell(object):
     def _tab_to_yaml(self):
         """Convert internal representation to yaml"""
         yaml_out = dict()
-        for row in self.data:
-            d = dict(zip(self.keys, row))
+        for i in range(len(self)):
+            d = dict(zip(self.keys, self._row(i)))
             if not d.get("sequence", None):
                 continue
             if not yaml_out.has_key(d['lane']):
@@ -207,25 +372,35 @@ class Flowcell(object):
         return yaml.dump(yaml_out_final)
     
     def get_sample(self, key):
-        return self.data[self.samples[key]]
+        self._reindex()
+        return self._row(self.samples[key])
 
     def get_entry(self, key, label):
-        return self.data[self.samples[key]][self.keys.index(label)]
+        self._reindex()
+        return self._value(self.samples[key], label)
 
     def set_entry(self, key, label, value):
-        self.data[self.samples[key]][self.keys.index(label)] = value
+        self._reindex()
+        self._columns[label][self._rows[self.samples[key]]] = value
+        if not label in self._file_keys:
+            self._stamp[0] += 1
+            self._set_sample_dict()
 
     def append_to_entry(self, key, label, value):
-        if not self.data[self.samples[key]][self.keys.index(label)]:
-            self.data[self.samples[key]][self.keys.index(label)] = []
-        self.data[self.samples[key]][self.keys.index(label)].append(value)
-                
+        if not self.get_entry(key, label):
+            self.set_entry(key, label, [])
+        self.get_entry(key, label).append(value)
+
+    def _value(self, i, label):
+        return self._columns[label][self._rows[i]]
+
     def _column(self, label):
-        i = self.keys.index(label)
-        return [row[i] for row in self.data if not row[i] is None]
+        if self._columns is None:
+            return []
+        return [x for x in self._columns[label][self._rows] if not x is None]
 
     def _row(self, i):
-        return self.data[i]
+        return [self._columns[k][self._rows[i]] for k in self.keys]
 
     def projects(self):
         """List flowcell projects"""
@@ -237,60 +412,56 @@ class Flowcell(object):
 
     def barcodes(self, lane):
         """List barcodes for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("barcode_id"))
+        return list(self._lane_values(lane, "barcode_id"))
 
     def names(self, lane):
         """List names for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("name"))
+        return list(self._lane_values(lane, "name"))
 
     def barcode_sequences(self, lane):
         """List barcode sequences for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("sequence"))
+        return list(self._lane_values(lane, "sequence"))
 
     def barcode_id_to_name(self, lane):
         """Map barcode id to name"""
-        return dict(zip(self.barcodes(lane), self.names(lane)))
+        return dict(zip(self._lane_values(lane, "barcode_id"), self._lane_values(lane, "name")))
 
     def barcode_name_to_id(self, lane):
         """Map barcode name to id"""
-        return dict(zip(self.names(lane), self.barcodes(lane)))
+        return dict(zip(self._lane_values(lane, "name"), self._lane_values(lane, "barcode_id")))
 
     def barcode_sequence_to_name(self, lane):
         """Map barcode sequence to name"""
-        return dict(zip(self.barcode_sequences(lane), self.names(lane)))
+        return dict(zip(self._lane_values(lane, "sequence"), self._lane_values(lane, "name")))
 
     def barcode_name_to_sequence(self, lane):
         """Map barcode name to sequence"""
-        return dict(zip(self.names(lane), self.barcode_sequences(lane)))
+        return dict(zip(self._lane_values(lane, "name"), self._lane_values(lane, "sequence")))
 
     def barcode_id_to_sequence(self, lane):
         """Map barcode id to sequence"""
-        return dict(zip(self.barcodes(lane), self.barcode_sequences(lane)))
+        return dict(self._lane_index().get(lane, {}).get("id_to_sequence", {}))
 
     def fc_with_unique_lanes(self):
         """Transform flowcell to one with unique lane numbers"""
         new_fc = copy.deepcopy(self)
         new_fc.filename = self.filename.replace(".yaml", "-unique-lane.yaml")
-        lane_index = new_fc.keys.index("lane")
-        lane = 1
-        for j in range(0, len(new_fc.data)):
-            new_fc.data[j][lane_index] = str(lane)
-            lane = lane + 1
+        new_fc._columns["lane"][new_fc._rows] = [str(lane) for lane in range(1, len(new_fc) + 1)]
+        new_fc._set_sample_dict()
         new_fc.unique_lanes = True
         return new_fc
             
     def subset(self, column, query):
-        """Subset runinfo. Returns new flowcell object."""
+        """Subset runinfo. Returns new flowcell object that shares the
+        run information of this flowcell."""
         pruned_fc = Flowcell()
-        vals = list(self._column(column))
-        i = [j for j in range(0, len(vals)) if vals[j]==query]
-        pruned_fc.data = [self.data[j] for j in i]
+        pruned_fc._columns = self._columns
+        pruned_fc._stamp = self._stamp
+        if self._columns is not None:
+            pruned_fc._rows = self._rows[self._columns[column][self._rows] == query]
         pruned_fc.filename = self.filename.replace(".yaml", "-pruned.yaml")
         pruned_fc._set_sample_dict()
-        pruned_fc.lane_files = dict((x, self.lane_files[x]) for x in pruned_fc.lanes())
+        pruned_fc.lane_files = dict((x, self.lane_files.setdefault(x, [])) for x in pruned_fc.lanes())
         pruned_fc.fc_date = self.fc_date
         pruned_fc.fc_name = self.fc_name
         return pruned_fc
@@ -307,7 +478,6 @@ class Flowcell(object):
             if not data is None:
                 self.data = data
                 self.filename = os.path.join(p, runinfo)
-                self._set_sample_dict()
                 break
         if not data:
             return None
@@ -376,46 +546,15 @@ class Flowcell(object):
         
         :returns: None
         """
-        re_lane = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?\.(filter|bc)_metrics|^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_[12]_fastq.txt')
-        m_lane = re_lane.search(os.path.basename(f))
-        if m_lane:
-            lane = os.path.basename(f).split("_")[0]
-            sample = None
-            self.lane_files[lane].append(os.path.abspath(f))
+        c = self.file_classifier().classify(f)
+        if c is None:
             return
-        re_sample = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_([0-9]+|unmatched).*')
-        m_sample = re_sample.search(os.path.basename(f))
-        if m_sample:
-            lane = m_sample.group(1)
-            sample = m_sample.group(3)
-            if sample == "unmatched":
-                self.lane_files[lane].append(os.path.abspath(f))
-                return
-            sequence = self.barcode_id_to_sequence(lane).get(int(sample), None)
-            key = "{}_{}".format(lane, sequence)
-            if f.find("fastq.txt") > 0:
-                self.append_to_entry(key, "files", os.path.abspath(f))
-                return
-            else:
-                self.append_to_entry(key, "results", os.path.abspath(f))
-                return
-
-        names = self._column("name")
-        pattern = "|".join("^({}).*".format(x) for x in names)
-        re_casava_sample = re.compile(pattern)
-        m_casava_sample = re_casava_sample.search(os.path.basename(f))
-        if m_casava_sample:
-            row = self._row(names.index(m_casava_sample.group(1)))
-            key = "{}_{}".format(row[0], row[10])
-            if re.search("fastq(\.gz)?$", f):
-                LOG.debug("Adding sequence file {} to files, key {}".format(f, key))
-                self.append_to_entry(key, "files", os.path.abspath(f))
-                return
-            else:
-                LOG.debug("Adding file {} to results, key {}".format(f, key))
-                self.append_to_entry(key, "results", os.path.abspath(f))
-                return
-        return
+        (label, key) = c
+        if label == "lane":
+            self.lane_files.setdefault(key, []).append(os.path.abspath(f))
+        else:
+            LOG.debug("Adding file {} to {}, key {}".format(f, label, key))
+            self.append_to_entry(key, label, os.path.abspath(f))
 
     def collect_files(self, path, project=None):
         """Collect files for a given project.
@@ -426,11 +565,10 @@ class Flowcell(object):
             fc = self.subset("sample_prj", project)
         else:
             fc = self
-        pattern = "|".join(fc.glob_pfx_str())
+        ## Only collect files that are classified to the samples, or lanes, of the subset
+        classifier = fc.file_classifier()
         def file_filter(f):
-            if not pattern:
-                return
-            return re.search(pattern, f) != None
+            return classifier.classify(f, strict=True) is not None
         flist = filtered_walk(path, file_filter)
         for f in flist:
             self.classify_file(f)
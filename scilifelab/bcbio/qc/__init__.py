@@ -6,13 +6,21 @@ import glob
 import xml.parsers.expat
 from uuid import uuid4
 import json
+import zlib
+import base64
+import multiprocessing
 import numpy as np
 import csv
 import collections
 import xml.etree.cElementTree as ET
-from bs4 import BeautifulSoup
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
 
 from cement.core import backend
+from scilifelab.utils.misc import fast_walk
+from scilifelab.utils.metrics_cache import get_metrics_cache
+from scilifelab.io.picard import parse_picard_metrics
+from scilifelab.io.fastqc import read_fastqc_data
 LOG = backend.minimal_logger("bcbio")
 
 from bcbio.broad.metrics import PicardMetricsParser
@@ -64,92 +72,43 @@ class MetricsParser():
         return data
 
 class ExtendedPicardMetricsParser(PicardMetricsParser):
-    """Extend basic functionality and parse all picard metrics"""
+    """Extend basic functionality and parse all picard metrics.
+
+    Files are read with the shared picard reader in
+    scilifelab.io.picard. Metrics are kept as strings, whereas
+    histograms are stored as typed columns.
+    """
 
     def __init__(self):
         PicardMetricsParser.__init__(self)
 
-    def _get_command(self, in_handle):
-        while 1:
-            line = in_handle.readline()
-            if line.startswith("# net.sf.picard.analysis") or line.startswith("# net.sf.picard.sam"):
-                break
-        return line.rstrip("\n")
-
-    def _read_off_header(self, in_handle):
-        while 1:
-            line = in_handle.readline()
-            if line.startswith("## METRICS"):
-                break
-        return in_handle.readline().rstrip("\n").split("\t")
-
-    def _read_vals_of_interest(self, header, info):
-        want_indexes = [header.index(w) for w in header]
-        vals = dict()
-        for i in want_indexes:
-            vals[header[i]] = info[i]
-        return vals
+    def _read_metrics(self, in_handle):
+        data = parse_picard_metrics(in_handle)
+        if data.metrics is None:
+            raise ValueError("no metrics table in picard metrics file")
+        return data
 
     def _parse_align_metrics(self, in_handle):
-        command = self._get_command(in_handle)
-        header = self._read_off_header(in_handle)
-        d = dict([[x, []] for x in header])
-        res = dict(command=command, FIRST_OF_PAIR = d, SECOND_OF_PAIR = d, PAIR = d)
-        while 1:
-            info = in_handle.readline().rstrip("\n").split("\t")
-            category = info[0]
-            if len(info) <= 1:
-                break
-            vals = self._read_vals_of_interest(header, info)
-            res[category] = vals
+        data = self._read_metrics(in_handle)
+        d = dict([[x, []] for x in data.metrics.header])
+        res = dict(command=data.command, FIRST_OF_PAIR = d, SECOND_OF_PAIR = d, PAIR = d)
+        for i in range(0, len(data.metrics)):
+            vals = data.metrics.row(i)
+            res[vals[data.metrics.header[0]]] = vals
         return res
 
     def _parse_dup_metrics(self, in_handle):
-        command = self._get_command(in_handle)
-        header = self._read_off_header(in_handle)
-        info = in_handle.readline().rstrip("\n").split("\t")
-        vals = self._read_vals_of_interest(header, info)
-        histvals = self._read_histogram(in_handle)
-        return dict(command=command, metrics = vals, hist = histvals)
+        data = self._read_metrics(in_handle)
+        histvals = data.hist.to_dict() if data.hist else None
+        return dict(command=data.command, metrics = data.metrics.row(0), hist = histvals)
 
     def _parse_insert_metrics(self, in_handle):
-        command = self._get_command(in_handle)
-        header = self._read_off_header(in_handle)
-        info = in_handle.readline().rstrip("\n").split("\t")
-        vals = self._read_vals_of_interest(header, info)
-        histvals = self._read_histogram(in_handle)
-        return dict(command=command, metrics = vals, hist = histvals)
+        return self._parse_dup_metrics(in_handle)
 
     def _parse_hybrid_metrics(self, in_handle):
-        command = self._get_command(in_handle)
-        header = self._read_off_header(in_handle)
-        info = in_handle.readline().rstrip("\n").split("\t")
-        vals = self._read_vals_of_interest(header, info)
-        return dict(command=command, metrics = vals)
-    
-    def _read_histogram(self, in_handle):
-        labels = self._read_to_histogram(in_handle)
-        if labels is None:
-            return None
-        vals = dict([[x, []] for x in labels])
-        while 1:
-            line = in_handle.readline()
-            info = line.rstrip("\n").split("\t")
-            if len(info) < len(labels):
-                break
-            for i in range(0, len(labels)):
-                vals[labels[i]].append(info[i])
-        return vals
+        data = self._read_metrics(in_handle)
+        return dict(command=data.command, metrics = data.metrics.row(0))
 
-    def _read_to_histogram(self, in_handle):
-        while 1:
-            line = in_handle.readline()
-            if line.startswith("## HISTOGRAM"):
-                break
-            if not line:
-                return None
-        return in_handle.readline().rstrip("\n").split("\t")
-          
 class RunInfoParser():
     """RunInfo parser"""
     def __init__(self):
@@ -257,6 +216,169 @@ class XmlToDict(dict):
             else:
                 self.update({element.tag: element.text})
 
+## RTA chart types, by the name of the report directory holding the charts
+RTA_CHART_DIRS = ["ErrorRate", "FWHM", "Intensity", "NumGT30"]
+
+def _rta_file_types(f):
+    """Get the types of an RTA report file, as keys of the data
+    returned by IlluminaXMLParser.parse.
+
+    :param f: file name
+
+    :returns: list of types
+    """
+    dirname = os.path.basename(os.path.dirname(f))
+    basename = os.path.basename(f)
+    types = []
+    if dirname in RTA_CHART_DIRS:
+        types.append(dirname)
+    if basename.endswith("_Chart.xml"):
+        types.append("Charts")
+    if dirname.endswith("Summary"):
+        types.append("Summary")
+    if basename.startswith("NumClusters By"):
+        types.append("NumClusters")
+    return types
+
+def _rta_chart_index(f):
+    """Get the index of a chart file, e.g. the cycle '12' for
+    ErrorRate/Chart_12.xml"""
+    index = os.path.basename(f)
+    if index.endswith(".xml"):
+        index = index[:-len(".xml")]
+    if index.startswith("Chart_"):
+        index = index[len("Chart_"):]
+    return index
+
+def _parse_rta_chart(f):
+    """Parse an RTA chart file. Module level so that it can be run in
+    worker processes.
+
+    The tile elements are streamed through an expat parser and their
+    values collected in an array of shape (lanes, tiles, metrics).
+
+    :param f: chart file
+
+    :returns: tuple of (header, metric names, array)
+    """
+    header = {}
+    metrics = []
+    columns = {}
+    rows = []
+    def start_element(name, attrs):
+        ## With ordered attributes, attrs is a list of names and values
+        if name == "TL":
+            key = None
+            values = []
+            for i in range(0, len(attrs), 2):
+                if attrs[i] == "Key":
+                    key = attrs[i + 1]
+                    continue
+                if attrs[i] not in columns:
+                    columns[attrs[i]] = len(metrics)
+                    metrics.append(attrs[i])
+                try:
+                    values.append((columns[attrs[i]], float(attrs[i + 1])))
+                except ValueError:
+                    continue
+            if key is not None:
+                rows.append((key, values))
+        elif name in ["FlowCellData", "Layout"]:
+            header.update(zip(attrs[::2], attrs[1::2]))
+    p = xml.parsers.expat.ParserCreate()
+    p.ordered_attributes = True
+    p.StartElementHandler = start_element
+    with open(f) as fh:
+        p.ParseFile(fh)
+    n_lanes = int(header.get("NumLanes", 0))
+    n_tiles = int(header.get("RowsPerLane", 0)) * int(header.get("ColsPerLane", 0))
+    keys = []
+    for key, values in rows:
+        lane, tile = [int(x) for x in key.split("_")]
+        n_lanes, n_tiles = max(n_lanes, lane), max(n_tiles, tile)
+        keys.append((lane - 1, tile - 1))
+    data = np.empty((n_lanes, n_tiles, len(metrics)), dtype=np.float32)
+    data.fill(np.nan)
+    for (lane, tile), (_, values) in zip(keys, rows):
+        for j, v in values:
+            data[lane, tile, j] = v
+    return (header, metrics, data)
+
+class TileMetrics(object):
+    """Tile level metrics of a type of RTA chart, e.g. ErrorRate.
+
+    The values are stored in a float32 array of shape (charts, lanes,
+    tiles, metrics), with NaN for missing values. Charts are identified
+    by their index, e.g. the cycle number, and lanes and tiles are
+    numbered from 1 in RTA tile keys, as in '1_12'.
+
+    :param header: FlowCellData and Layout attributes
+    :param indices: chart indices
+    :param metrics: metric names
+    :param data: array of shape (charts, lanes, tiles, metrics)
+    """
+    def __init__(self, header, indices, metrics, data):
+        self.header = header
+        self.indices = indices
+        self.metrics = metrics
+        self.data = data
+
+    @classmethod
+    def from_charts(cls, charts):
+        """Collect parsed chart files.
+
+        :param charts: list of tuples (index, (header, metric names, array)) as returned by _parse_rta_chart
+
+        :returns: <TileMetrics> object
+        """
+        header = {}
+        metrics = []
+        for _, (h, m, _) in charts:
+            header.update(h)
+            metrics.extend([x for x in m if x not in metrics])
+        n_lanes = max([x[2].shape[0] for _, x in charts] or [0])
+        n_tiles = max([x[2].shape[1] for _, x in charts] or [0])
+        data = np.empty((len(charts), n_lanes, n_tiles, len(metrics)), dtype=np.float32)
+        data.fill(np.nan)
+        for i, (_, (_, m, a)) in enumerate(charts):
+            for j, name in enumerate(m):
+                data[i, :a.shape[0], :a.shape[1], metrics.index(name)] = a[:, :, j]
+        return cls(header, [x[0] for x in charts], metrics, data)
+
+    def get(self, index, lane, tile, metric):
+        """Get a value.
+
+        :param index: chart index
+        :param lane: lane number
+        :param tile: tile number
+        :param metric: metric name
+
+        :returns: value, or None if missing
+        """
+        v = self.data[self.indices.index(index), int(lane) - 1, int(tile) - 1, self.metrics.index(metric)]
+        return None if np.isnan(v) else float(v)
+
+    def to_dict(self):
+        """Serialize for storage in statusdb. The array is stored as
+        zlib compressed, base64 encoded little endian float32 values.
+
+        :returns: dictionary
+        """
+        return {"header" : self.header, "indices" : self.indices, "metrics" : self.metrics,
+                "shape" : list(self.data.shape), "dtype" : "<f4",
+                "data" : base64.b64encode(zlib.compress(self.data.astype("<f4").tostring()))}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Deserialize a dictionary created by to_dict.
+
+        :param d: dictionary
+
+        :returns: <TileMetrics> object
+        """
+        data = np.fromstring(zlib.decompress(base64.b64decode(d["data"])), dtype=d["dtype"]).reshape(d["shape"])
+        return cls(d["header"], d["indices"], d["metrics"], data.astype(np.float32))
+
 class IlluminaXMLParser():
     """Illumina xml data parser. Parses xml files in flowcell directory."""
     def __init__(self):
@@ -264,48 +386,28 @@ class IlluminaXMLParser():
         self._element = None
         self._tmp = None
         self._header = None
+        self.tile_metrics = {}
 
-    def _chart_start_element(self, name, attrs):
-        self._element = name
-        if name == "FlowCellData":
-            self._header = attrs
-        if name == "Layout":
-            n_tiles_per_lane = int(attrs['RowsPerLane']) * int(attrs['ColsPerLane'])
-            if self._tmp is None:
-                self._tmp = self._header
-                self._tmp.update(attrs)
-                for i in range(1,int(attrs['NumLanes'])+1):
-                    for j in range(1,n_tiles_per_lane+1):
-                        key = "%s_%s" % (i,j)
-                        self._tmp[key] = {}
-                     
-        if name == "TL":
-            self._tmp[attrs["Key"]][self._index] = {}
-            for k in attrs.keys():
-                if k == "Key":
-                    continue
-                if attrs[k] == "NaN":
-                    v = None
-                else:
-                    v = float(attrs[k])
-                                        
-                self._tmp[attrs["Key"]][self._index] = v
+    def _parse_charts(self, files, workers=1):
+        """Parse chart files, in parallel if more than one worker is
+        requested.
 
-    def _chart_end_element(self, name):
-        self._element = None
-    def _chart_char_data(self, data):
-        pass
+        :param files: list of chart files
+        :param workers: number of worker processes
 
-    def _parse_charts(self, files):
-        for f in files:
-            self._index = os.path.basename(f).rstrip(".xml").lstrip("Chart_")
-            p = xml.parsers.expat.ParserCreate()
-            p.StartElementHandler = self._chart_start_element
-            p.EndElementHandler = self._chart_end_element
-            p.CharacterDataHandler = self._chart_char_data
-            fp = open(f)
-            p.ParseFile(fp)
-            fp.close()
+        :returns: list of tuples (index, (header, metric names, array)), sorted by index
+        """
+        workers = min(workers, len(files))
+        if workers <= 1:
+            charts = map(_parse_rta_chart, files)
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                charts = pool.map(_parse_rta_chart, files)
+            finally:
+                pool.close()
+                pool.join()
+        return sorted(zip([_rta_chart_index(f) for f in files], charts), key=lambda x: [int(y) if y.isdigit() else y for y in re.split("([0-9]+)", x[0])])
 
     def _summary_start_element(self, name, attrs):
         self._element = name
@@ -352,71 +454,166 @@ class IlluminaXMLParser():
             fp.close()
 
     ## Caution: no assert statements for file existence
-    def parse(self, files, fullRTA=False):
-        """Full parsing includes all RTA files"""
+    def parse(self, files, fullRTA=False, workers=1):
+        """Parse RTA report files. Full parsing includes the RTA chart
+        files, whose tile level metrics are kept as <TileMetrics>
+        objects in self.tile_metrics and serialized in the returned
+        data.
+
+        :param files: list of xml files
+        :param fullRTA: parse chart files
+        :param workers: number of processes used to parse chart files
+
+        :returns: dictionary of metrics by file type
+        """
+        by_type = collections.defaultdict(list)
+        for f in files:
+            for t in _rta_file_types(f):
+                by_type[t].append(f)
         if fullRTA:
-            error_files = filter(lambda x: os.path.dirname(x).endswith("ErrorRate"), files)
-            self._parse_charts(error_files)
-            self._data["ErrorRate"] = self._tmp
-            self._tmp = None
-            FWHM_files = filter(lambda x: os.path.dirname(x).endswith("FWHM"), files)
-            self._parse_charts(FWHM_files)
-            self._data["FWHM"] = self._tmp
-            self._tmp = None
-            intensity_files = filter(lambda x: os.path.dirname(x).endswith("Intensity"), files)
-            self._parse_charts(intensity_files)
-            self._data["Intensity"] = self._tmp
-            self._tmp = None
-            numgt30_files = filter(lambda x: os.path.dirname(x).endswith("NumGT30"), files)
-            self._parse_charts(numgt30_files)
-            self._data["NumGT30"] = self._tmp
-            self._tmp = None
-            chart_files = filter(lambda x: os.path.basename(x).endswith("_Chart.xml"), files)
-            self._parse_charts(chart_files)
-            self._data["Charts"] = self._tmp
-            self._tmp = None
+            for t in RTA_CHART_DIRS + ["Charts"]:
+                self.tile_metrics[t] = TileMetrics.from_charts(self._parse_charts(by_type[t], workers))
+                self._data[t] = self.tile_metrics[t].to_dict()
 
         ## Parse Summary and clusters
         self._tmp = {}
-        summary_files = filter(lambda x: os.path.dirname(x).endswith("Summary"), files)
-        self._parse_summary(summary_files)
+        self._parse_summary(by_type["Summary"])
         self._data["Summary"] = self._tmp
         self._tmp = {}
-        cluster_files = filter(lambda x: os.path.basename(x).startswith("NumClusters By"), files)
-        self._parse_clusters(cluster_files)
+        self._parse_clusters(by_type["NumClusters"])
         self._data["NumClusters"] = self._tmp
 
         return self._data
 
+class HtmlTableParser(HTMLParser):
+    """Streaming html table parser. Collects the cells of all tables
+    in a document in a single pass.
+
+    After parsing, self.tables is a list of tables, each a list of
+    rows, each a list of (tag, text) tuples, where tag is 'th' or 'td'.
+    Text of elements nested in cells is included in the cell text.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.tables = []
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self.tables.append([])
+        elif tag == "tr" and self.tables:
+            self._row = []
+        elif tag in ["th", "td"] and self._row is not None:
+            self._cell = (tag, [])
+
+    def handle_endtag(self, tag):
+        if tag in ["th", "td"] and self._cell is not None:
+            self._row.append((self._cell[0], "".join(self._cell[1])))
+            self._cell = None
+        elif tag == "tr" and self._row is not None:
+            if self._row:
+                self.tables[-1].append(self._row)
+            self._row = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell[1].append(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]).encode("utf-8"))
+
+    def handle_charref(self, name):
+        try:
+            c = int(name[1:], 16) if name.lower().startswith("x") else int(name)
+        except ValueError:
+            return
+        self.handle_data(unichr(c).encode("utf-8"))
+
+    def parse_file(self, filename, chunksize=65536):
+        """Parse a file in chunks.
+
+        :param filename: file name
+        :param chunksize: number of bytes read at a time
+
+        :returns: list of tables
+        """
+        with open(filename) as fh:
+            for chunk in iter(lambda: fh.read(chunksize), ""):
+                self.feed(chunk)
+        self.close()
+        return self.tables
+
 class ExtendedFastQCParser(FastQCParser):
     def __init__(self, base_dir):
         FastQCParser.__init__(self, base_dir)
+        self._fastqc_data = os.path.join(base_dir, "fastqc_data.txt")
 
     def get_fastqc_summary(self):
+        """Get the fastqc modules as dictionaries of string columns.
+        fastqc_data.txt is read once for all modules.
+
+        :returns: dictionary mapping module name to dictionary of columns
+        """
         metric_labels = ["Per base sequence quality", "Basic Statistics", "Per sequence quality scores",
                          "Per base sequence content", "Per base GC content", "Per sequence GC content",
                          "Per base N content", "Sequence Length Distribution", "Sequence Duplication Levels",
                          "Overrepresented sequences", "Kmer Content"]
-        metrics = {x : self._to_dict(self._fastqc_data_section(x)) for x in metric_labels}
+        modules = read_fastqc_data(self._fastqc_data) if os.path.exists(self._fastqc_data) else {}
+        metrics = {x : modules[x].string_columns() if x in modules else {} for x in metric_labels}
         return metrics
 
-    def _to_dict(self, section):
-        if len(section) == 0:
-            return {}
-        header = [x.strip("#") for x in section[0].rstrip("\t").split("\t")]
-        d = []
-        for l in section[1:]:
-            d.append(l.split("\t"))
-        data = np.array(d)
-        df = {header[i]:data[:,i].tolist() for i in range(0,len(header))}
-        return df
 ##############################
 ##  objects
 ##############################
+## Sample run file names, as in 1_120924_AC003CCCXX_nophix_2-sort-dup.align_metrics
+re_sample_run_file = re.compile("^(?P<lane>[0-9]+)_(?P<date>[0-9]+)_(?P<fc>[0-9A-Za-z]+?)(?P<nophix>_nophix)?_(?P<barcode_id>[0-9A-Za-z]+?)(?P<nophix_bc>_nophix)?(?P<suffix>(-|_[12]_fastq_screen).*|)$")
+## Lane barcode metrics file names, as in 1_120924_AC003CCCXX_nophix.bc_metrics
+re_bc_metrics_file = re.compile("^(?P<lane>[0-9]+)_(?P<date>[0-9]+)_(?P<fc>[0-9A-Za-z]+?)(?P<nophix>_nophix)?[\._]bc[\._]metrics")
+re_picard_metrics_suffix = re.compile("-.*\.(align|hs|insert|dup)_metrics")
+re_fastq_screen_suffix = re.compile("^_[12]_fastq_screen\.txt")
+
+class DemultiplexStats(dict):
+    """Parsed demultiplex statistics, as returned by
+    FlowcellRunMetricsParser.parse_demultiplex_stats_htm.
+
+    The barcode lane statistics are indexed by sample and lane on
+    creation, with read counts converted to integers, so that the
+    object can be built once per flowcell and shared by the sample
+    parsers. Since it is a dictionary it is stored in statusdb as is.
+    """
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self._index = {}
+        for x in self.get('Barcode_lane_statistics', []):
+            if not x:
+                continue
+            try:
+                reads = int(str(x.get('# Reads', None)).replace(",", ""))
+            except ValueError:
+                reads = None
+            self._index[(str(x.get('Sample ID', None)), str(x.get('Lane', None)))] = reads
+
+    def read_count(self, sample, lane):
+        """Get the number of reads of a sample in a lane.
+
+        :param sample: sample id
+        :param lane: lane
+
+        :returns: number of reads, or None if missing
+        """
+        return self._index.get((str(sample), str(lane)), None)
+
+def _parse_file(parse_fn, f):
+    """Open a file and parse it with parse_fn"""
+    with open(f) as fh:
+        return parse_fn(fh)
+
 class RunMetricsParser(dict):
     """Generic Run Parser class"""
     _metrics = []
-    ## Following paths are ignored
+    ## Following paths, relative to the parser path, are ignored
     ignore = "|".join(["tmp", "tx", "-split", "log"])
     reignore = re.compile(ignore)
 
@@ -424,20 +621,51 @@ class RunMetricsParser(dict):
         super(RunMetricsParser, self).__init__()
         self.files = []
         self.path=None
+        self._file_index = None
+        self.input_files = []
         self.log = LOG
         if log:
             self.log = log
 
-    def _collect_files(self):
+    @property
+    def metrics_cache(self):
+        """Metrics cache of the run directory, shared by all parsers
+        of the directory, or None if metrics caching is disabled"""
+        return get_metrics_cache(self.path) if self.path else None
+
+    def _cached(self, key, files, fn, *args, **kw):
+        """Call a parsing function through the metrics cache of the
+        run directory, if metrics caching is enabled. Exceptions are
+        not cached. The files are added to the input files of the
+        parser.
+
+        :param key: name of the parsing operation
+        :param files: list of files parsed by fn
+        :param fn: parsing function
+        :param *args: arguments to fn
+        :param **kw: keyword arguments to fn
+
+        :returns: result of fn
+        """
+        self.input_files.extend([f for f in files if f not in self.input_files])
+        cache = self.metrics_cache
+        if cache is None:
+            return fn(*args, **kw)
+        return cache.get(key, files, fn, *args, **kw)
+
+    def _collect_files(self, workers=1):
+        """Collect the files below path, skipping ignored directories.
+
+        :param workers: number of threads used to walk top-level subdirectories
+        """
         if not self.path:
             return
         if not os.path.exists(self.path):
             raise IOError
-        self.files = []
-        for root, dirs, files in os.walk(self.path):
-            if re.search(self.reignore, root):
-                continue
-            self.files = self.files + [os.path.join(root, x) for x in files]
+        self._file_index = None
+        def exclude_fn(d):
+            return self.reignore.search(os.path.relpath(d, self.path))
+        self.files = [os.path.join(root, x) for root, dirs, files in fast_walk(self.path, exclude_fn, workers) for x in files]
 
     def filter_files(self, pattern, filter_fn=None):
         """Take file list and return those files that pass the filter_fn criterium"""
@@ -447,6 +675,70 @@ class RunMetricsParser(dict):
             filter_fn = filter_function
         return filter(filter_fn, self.files)
 
+    def _classify_file(self, f):
+        """Classify a file by the metrics it holds.
+
+        :param f: file name
+
+        :returns: tuple of (lane, date, flowcell, barcode_id, nophix, metric type), or None for unclassified files
+        """
+        fn = os.path.basename(f)
+        m = re_sample_run_file.match(fn)
+        if m:
+            suffix = m.group("suffix")
+            nophix = bool(m.group("nophix") or m.group("nophix_bc"))
+            if re_picard_metrics_suffix.search(suffix):
+                return (m.group("lane"), m.group("date"), m.group("fc"), m.group("barcode_id"), nophix, "picard_metrics")
+            if re_fastq_screen_suffix.match(suffix):
+                return (m.group("lane"), m.group("date"), m.group("fc"), m.group("barcode_id"), nophix, "fastq_screen")
+        m = re_bc_metrics_file.match(fn)
+        if m:
+            return (m.group("lane"), m.group("date"), m.group("fc"), None, bool(m.group("nophix")), "bc_metrics")
+        ## FastQC output is stored in directories fastqc/<sample run>-<suffix>
+        parts = f.split(os.sep)
+        for i in range(len(parts) - 2):
+            if parts[i] == "fastqc":
+                m = re_sample_run_file.match(parts[i + 1])
+                if m and not m.group("nophix_bc") and not m.group("suffix").startswith("_"):
+                    return (m.group("lane"), m.group("date"), m.group("fc"), m.group("barcode_id"), bool(m.group("nophix")), "fastqc")
+        return None
+
+    def file_index(self):
+        """Get the file classification index. Each file name is
+        classified once, on first use.
+
+        :returns: dictionary mapping (lane, barcode_id, metric type) to lists of files; barcode_id is None for lane level files
+        """
+        if self._file_index is None:
+            self._file_index = collections.defaultdict(list)
+            for f in self.files:
+                c = self._classify_file(f)
+                if c:
+                    self._file_index[(c[0], c[3], c[5])].append(f)
+        return self._file_index
+
+    def lookup_files(self, metric_type, lane, barcode_id=None):
+        """Look up files in the file classification index.
+
+        :param metric_type: one of picard_metrics, fastq_screen, fastqc and bc_metrics
+        :param lane: lane
+        :param barcode_id: barcode id; None for lane level files
+
+        :returns: list of files
+        """
+        return self.file_index().get((str(lane), None if barcode_id is None else str(barcode_id), metric_type), [])
+
+    def sample_input_files(self, lane, barcode_id, **kw):
+        """Get the metrics files of a sample run, i.e. the files that
+        the sample run metrics are parsed from.
+
+        :param lane: lane
+        :param barcode_id: barcode id
+
+        :returns: list of files
+        """
+        return [f for metric_type in ["picard_metrics", "fastq_screen", "fastqc"] for f in self.lookup_files(metric_type, lane, barcode_id)] + self.lookup_files("bc_metrics", lane)
+
 class SampleRunMetricsParser(RunMetricsParser):
     """Sample-level class for parsing run metrics data"""
 
@@ -458,15 +750,13 @@ class SampleRunMetricsParser(RunMetricsParser):
     def read_picard_metrics(self, barcode_name, sample_prj, lane, flowcell, barcode_id, **kw):
         self.log.debug("read_picard_metrics for sample {}, project {}, lane {} in run {}".format(barcode_name, sample_prj, lane, flowcell))
         picard_parser = ExtendedPicardMetricsParser()
-        pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?_{}-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id),
-                            "{}_[0-9]+_[0-9A-Za-z]+_{}(_nophix)?-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id)])
-        files = self.filter_files(pattern)
+        files = self.lookup_files("picard_metrics", lane, barcode_id)
         if len(files) == 0:
-            self.log.warn("no picard metrics files for sample {}; pattern {}".format(barcode_name, pattern))
+            self.log.warn("no picard metrics files for sample {}, lane {}, barcode id {}".format(barcode_name, lane, barcode_id))
             return {}
         try:
             self.log.debug("files {}".format(",".join(files)))
-            metrics = picard_parser.extract_metrics(files)
+            metrics = self._cached("picard_metrics", files, picard_parser.extract_metrics, files)
             return metrics
         except:
             self.log.warn("no picard metrics for sample {}".format(barcode_name))
@@ -475,14 +765,10 @@ class SampleRunMetricsParser(RunMetricsParser):
     def parse_fastq_screen(self, barcode_name, sample_prj, lane, flowcell, barcode_id, **kw):
         self.log.debug("parse_fastq_screen for sample {}, project {}, lane {} in run {}".format(barcode_name, sample_prj, lane, flowcell))
         parser = MetricsParser()
-        pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?_{}_[12]_fastq_screen.txt".format(lane, barcode_id),
-                            "{}_[0-9]+_[0-9A-Za-z]+_{}(_nophix)?_[12]_fastq_screen.txt".format(lane, barcode_id)])
-        files = self.filter_files(pattern)
+        files = self.lookup_files("fastq_screen", lane, barcode_id)
         self.log.debug("files {}".format(",".join(files)))
         try:
-            fp = open(files[0])
-            data = parser.parse_fastq_screen_metrics(fp)
-            fp.close()
+            data = self._cached("fastq_screen", files[0:1], _parse_file, parser.parse_fastq_screen_metrics, files[0])
             return data
         except:
             self.log.warn("no fastq screen metrics for sample {}".format(barcode_name))
@@ -492,17 +778,15 @@ class SampleRunMetricsParser(RunMetricsParser):
         self.log.debug("read_fastqc_metrics for sample {}, project {}, lane {} in run {}".format(barcode_name, sample_prj, lane, flowcell))
         if barcode_name == "unmatched":
             return
-        pattern = "fastqc/{}_[0-9]+_[0-9A-Za-z]+(_nophix)?_{}-*".format(lane, barcode_id)
-        files = self.filter_files(pattern)
+        files = self.lookup_files("fastqc", lane, barcode_id)
         self.log.debug("files {}".format(",".join(files)))
         try:
             fastqc_dir = os.path.dirname(files[0])
-            fqparser = ExtendedFastQCParser(fastqc_dir)
-            stats = fqparser.get_fastqc_summary()
+            stats = self._cached("fastqc", [os.path.join(fastqc_dir, "fastqc_data.txt")], lambda: ExtendedFastQCParser(fastqc_dir).get_fastqc_summary())
             return {'stats':stats}
         except Exception as e:
             self.log.warn("Exception: {}".format(e))
-            self.log.warn("no fastqc metrics for sample {} using pattern '{}'".format(barcode_name, pattern))
+            self.log.warn("no fastqc metrics for sample {}, lane {}, barcode id {}".format(barcode_name, lane, barcode_id))
             return {'stats':{}}
 
     def parse_filter_metrics(self, **kw):
@@ -522,26 +806,29 @@ class SampleRunMetricsParser(RunMetricsParser):
             return {"reads":None, "reads_aligned":None, "reads_fail_align":None}
 
     def get_bc_count(self, barcode_name, sample_prj, flowcell, lane, barcode_id, demultiplex_stats=None, **kw):
-        """Parse bc metrics at sample level and get *bc_count* for a sample run!"""
+        """Parse bc metrics at sample level and get *bc_count* for a sample run!
+
+        If demultiplex statistics are passed, the count is looked up
+        there. Pass a <DemultiplexStats> object when counting many
+        samples, so that the statistics are indexed only once.
+        """
         self.log.debug("get_bc_count for sample {}, project {} in flowcell {}".format(barcode_name, sample_prj, flowcell))
         # If demultiplex_stats passed use this info instead
         if demultiplex_stats:
-            demux_stats_dict = {"{}_{}".format(l.get('Sample ID', None), l.get('Lane', None)):l for l in demultiplex_stats.get('Barcode_lane_statistics', [])}
-            sample_lane = "{}_{}".format(barcode_name, lane)
-            if sample_lane in demux_stats_dict:
+            if not isinstance(demultiplex_stats, DemultiplexStats):
+                demultiplex_stats = DemultiplexStats(demultiplex_stats)
+            reads = demultiplex_stats.read_count(barcode_name, lane)
+            if reads is not None:
                 self.log.debug("sample {}, lane {} found in demultiplex_stats - using this information".format(barcode_name, lane))
-                return int(demux_stats_dict[sample_lane]["# Reads"].replace(",", ""))/2
-        pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)
-        files = self.filter_files(pattern)
+                return reads/2
+        files = self.lookup_files("bc_metrics", lane)
         if len(files) == 0:
-            self.log.debug("no bc metrics files for sample {}, lane {}; pattern {}".format(barcode_name, lane, pattern))
+            self.log.debug("no bc metrics files for sample {}, lane {}".format(barcode_name, lane))
             return None
         self.log.debug("files {}".format(",".join(files)))
         try:
             parser = MetricsParser()
-            fp = open(files[0])
-            data = parser.parse_bc_metrics(fp)
-            fp.close()
+            data = self._cached("bc_metrics", files[0:1], _parse_file, parser.parse_bc_metrics, files[0])
             return data[str(barcode_id)]
         except:
             self.log.warn("No bc_metrics info for lane {}".format(lane))
@@ -554,6 +841,7 @@ class FlowcellRunMetricsParser(RunMetricsParser):
     def __init__(self, path):
         RunMetricsParser.__init__(self)
         self.path = path
+        self._rta_files = None
         self._collect_files()
 
     def parseRunInfo(self, fn="RunInfo.xml", **kw):
@@ -563,10 +851,8 @@ class FlowcellRunMetricsParser(RunMetricsParser):
             self.log.warn("No such file {}".format(infile))
             return {}
         try:
-            fp = open(infile)
             parser = RunInfoParser()
-            data = parser.parse(fp)
-            fp.close()
+            data = self._cached("RunInfo", [infile], _parse_file, parser.parse, infile)
             return data
         except:
             self.log.warn("Reading file {} failed".format(os.path.join(os.path.abspath(self.path), fn)))
@@ -586,10 +872,7 @@ class FlowcellRunMetricsParser(RunMetricsParser):
             self.log.warn("No such files {}".format(infile))
             return {}
         try:
-            with open(infile) as fh:
-                tree = ET.parse(fh)
-            root = tree.getroot()
-            data = XmlToDict(root)
+            data = self._cached("RunParameters", [infile], lambda: XmlToDict(ET.parse(infile).getroot()))
             return data
         except:
             self.log.warn("Reading file {} failed".format(os.path.join(os.path.abspath(self.path), fn)))
@@ -602,9 +885,7 @@ class FlowcellRunMetricsParser(RunMetricsParser):
             self.log.warn("No such file {}".format(infile))
             return {}
         try:
-            fp = open(infile)
-            runinfo = [x for x in csv.DictReader(fp)]
-            fp.close()
+            runinfo = self._cached("samplesheet_csv", [infile], _parse_file, lambda fh: [x for x in csv.DictReader(fh)], infile)
             return runinfo
         except:
             self.log.warn("Reading file {} failed".format(infile))
@@ -617,25 +898,54 @@ class FlowcellRunMetricsParser(RunMetricsParser):
             self.log.warn("No such file {}".format(infile))
             return {}
         try:
-            fp = open(infile)
-            runinfo = yaml.load(fp)
-            fp.close()
+            runinfo = self._cached("run_info_yaml", [infile], _parse_file, yaml.load, infile)
             return runinfo
             return True
         except:
             self.log.warn("No such file {}".format(infile))
             return False
 
-    def parse_illumina_metrics(self, fullRTA=False, **kw):
+    def rta_files(self):
+        """Get the xml files below the run directory, which hold the
+        RTA metrics. The run directory is walked once.
+
+        :returns: list of files
+        """
+        if self._rta_files is None:
+            self._rta_files = [os.path.join(root, f) for root, dirs, files in os.walk(os.path.abspath(self.path)) for f in files if f.endswith(".xml")]
+        return self._rta_files
+
+    def input_file_candidates(self, fc_name, runinfo_csv="SampleSheet.csv", run_info_yaml=None, casava=True):
+        """Get the files that flowcell run metrics are parsed from.
+        Files that are expected but do not exist, e.g. because the run
+        has not finished, are included, so that an input manifest
+        notices when they appear.
+
+        :param fc_name: flowcell name
+        :param runinfo_csv: samplesheet file
+        :param run_info_yaml: run info yaml file, or None if not parsed
+        :param casava: include CASAVA demultiplexing results
+
+        :returns: sorted list of files
+        """
+        path = os.path.abspath(self.path)
+        files = [os.path.join(path, x) for x in ["RunInfo.xml", "runParameters.xml", runinfo_csv, run_info_yaml] if x]
+        files.extend(self.rta_files())
+        for lane in self._lanes:
+            files.extend(self.filter_files("{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)))
+            if not casava:
+                files.extend(self.filter_files("{}_[0-9]+_[0-9A-Za-z]+(_nophix)?.filter_metrics".format(lane)))
+        if casava:
+            files.extend(self.demultiplex_stats_files(fc_name))
+            files.extend(self.undemultiplexed_metrics_files(fc_name))
+        return sorted(set(files))
+
+    def parse_illumina_metrics(self, fullRTA=False, workers=1, **kw):
         self.log.debug("parse_illumina_metrics")
-        fn = []
-        for root, dirs, files in os.walk(os.path.abspath(self.path)):
-            for f in files:
-                if f.endswith(".xml"):
-                    fn.append(os.path.join(root, f))
+        fn = self.rta_files()
         self.log.debug("Found {} RTA files {}...".format(len(fn), ",".join(fn[0:10])))
         parser = IlluminaXMLParser()
-        metrics = parser.parse(fn, fullRTA)
+        metrics = self._cached("illumina_fullRTA" if fullRTA else "illumina", fn, parser.parse, fn, fullRTA, workers)
         return metrics
 
     def parse_filter_metrics(self, fc_name, **kw):
@@ -648,10 +958,8 @@ class FlowcellRunMetricsParser(RunMetricsParser):
             files = self.filter_files(pattern)
             self.log.debug("filter metrics files {}".format(",".join(files)))
             try:
-                fp = open(files[0])
                 parser = MetricsParser()
-                data = parser.parse_filter_metrics(fp)
-                fp.close()
+                data = self._cached("filter_metrics", files[0:1], _parse_file, parser.parse_filter_metrics, files[0])
                 lanes[str(lane)]["filter_metrics"] = data
             except:
                 self.log.warn("No filter nophix metrics for lane {}".format(lane))
@@ -668,9 +976,7 @@ class FlowcellRunMetricsParser(RunMetricsParser):
             self.log.debug("bc metrics files {}".format(",".join(files)))
             try:
                 parser = MetricsParser()
-                fp = open(files[0])
-                data = parser.parse_bc_metrics(fp)
-                fp.close()
+                data = self._cached("bc_metrics", files[0:1], _parse_file, parser.parse_bc_metrics, files[0])
                 lanes[str(lane)]["bc_metrics"] = data
             except:
                 self.log.warn("No bc_metrics info for lane {}".format(lane))
@@ -681,80 +987,76 @@ class FlowcellRunMetricsParser(RunMetricsParser):
         """
         
         lanes = {str(k):{} for k in self._lanes}
-        # Use a glob to allow for multiple fastq folders
-        metrics_file_pattern = os.path.join(self.path, "Unaligned*", "Basecall_Stats_{}".format(fc_name[1:]), "Undemultiplexed_stats.metrics")
-        for metrics_file in glob.glob(metrics_file_pattern):
+        for metrics_file in self.undemultiplexed_metrics_files(fc_name):
             self.log.debug("parsing {}".format(metrics_file))
             if not os.path.exists(metrics_file):
                 self.log.warn("No such file {}".format(metrics_file))
                 continue
             
-            with open(metrics_file) as fh:
-                parser = MetricsParser()
-                in_handle = csv.DictReader(fh, dialect=csv.excel_tab)
-                data = parser.parse_undemultiplexed_barcode_metrics(in_handle)
-                for k in lanes.keys():
-                    lanes[str(k)]["undemultiplexed_barcodes"] = collections.defaultdict(list)
-                    try:
-                        for barcode in data[str(k)]:
-                            # Warn that we are replacing previously parsed results
-                            if len(lanes[str(k)]) > 0:
-                                self.log.warn("Conflicting undemultiplexed barcode metrics for lane {}. Using values parsed from {}".format(k,metrics_file))
-                            for key, val in barcode.items():
-                                lanes[str(k)]["undemultiplexed_barcodes"][key].append(val)
-                    except KeyError:
-                        self.log.warn("No undemultiplexed barcode metrics for lane {}".format(k))
+            parser = MetricsParser()
+            data = self._cached("undemultiplexed_barcodes", [metrics_file], _parse_file, lambda fh: parser.parse_undemultiplexed_barcode_metrics(csv.DictReader(fh, dialect=csv.excel_tab)), metrics_file)
+            for k in lanes.keys():
+                lanes[str(k)]["undemultiplexed_barcodes"] = collections.defaultdict(list)
+                try:
+                    for barcode in data[str(k)]:
+                        # Warn that we are replacing previously parsed results
+                        if len(lanes[str(k)]) > 0:
+                            self.log.warn("Conflicting undemultiplexed barcode metrics for lane {}. Using values parsed from {}".format(k,metrics_file))
+                        for key, val in barcode.items():
+                            lanes[str(k)]["undemultiplexed_barcodes"][key].append(val)
+                except KeyError:
+                    self.log.warn("No undemultiplexed barcode metrics for lane {}".format(k))
         return lanes
     
+    def undemultiplexed_metrics_files(self, fc_name, **kw):
+        """Get the Unaligned*/Basecall_Stats_*/Undemultiplexed_stats.metrics files.
+
+        :returns: list of files
+        """
+        # Use a glob to allow for multiple fastq folders
+        return glob.glob(os.path.join(self.path, "Unaligned*", "Basecall_Stats_{}".format(fc_name[1:]), "Undemultiplexed_stats.metrics"))
+
+    def demultiplex_stats_files(self, fc_name, **kw):
+        """Get the Unaligned*/Basecall_Stats_*/Demultiplex_Stats.htm files.
+
+        :returns: list of files
+        """
+        # Use a glob to allow for multiple fastq directories
+        return glob.glob(os.path.join(self.path, "Unaligned*", "Basecall_Stats_{}".format(fc_name[1:]), "Demultiplex_Stats.htm"))
+
     def parse_demultiplex_stats_htm(self, fc_name, **kw):
         """Parse the Unaligned*/Basecall_Stats_*/Demultiplex_Stats.htm file
         generated from CASAVA demultiplexing and returns barcode metrics.
+
+        :returns: <DemultiplexStats> object
         """
         metrics = {"Barcode_lane_statistics": [],
                    "Sample_information": []}
-        # Use a glob to allow for multiple fastq directories
-        htm_file_pattern = os.path.join(self.path, "Unaligned*", "Basecall_Stats_{}".format(fc_name[1:]), "Demultiplex_Stats.htm")
-        for htm_file in glob.glob(htm_file_pattern):
+        for htm_file in self.demultiplex_stats_files(fc_name):
             self.log.debug("parsing {}".format(htm_file))
             if not os.path.exists(htm_file):
                 self.log.warn("No such file {}".format(htm_file))
                 continue
-            with open(htm_file) as fh:
-                htm_doc = fh.read()
-            soup = BeautifulSoup(htm_doc)
-            ## 
+            tables = self._cached("demultiplex_stats", [htm_file], HtmlTableParser().parse_file, htm_file)
             ## Find headers
-            allrows = soup.findAll("tr")
-            column_gen=(row.findAll("th") for row in allrows)
-            parse_row = lambda row: row 
-            headers = [h for h in map(parse_row, column_gen) if h]
-            bc_header = [str(x.string) for x in headers[0]]
-            smp_header = [str(x.string) for x in headers[1]]
+            headers = [[text for tag, text in row if tag == "th"] for table in tables for row in table if row[0][0] == "th"]
+            bc_header = headers[0]
+            smp_header = headers[1]
             ## 'Known' headers from a Demultiplex_Stats.htm document
             bc_header_known = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads', '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of >= Q30 Bases (PF)', 'Mean Quality Score (PF)']
-            smp_header_known = ['None', 'Recipe', 'Operator', 'Directory']
+            smp_header_known = ['SampleID', 'Recipe', 'Operator', 'Directory']
             if not bc_header == bc_header_known:
                 self.log.warn("Barcode lane statistics header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in bc_header_known])), ",".join(["'{}'".format(x) for x in bc_header])))
             if not smp_header == smp_header_known:
                 self.log.warn("Sample header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in smp_header_known])), ",".join(["'{}'".format(x) for x in smp_header])))
             ## Fix first header name in smp_header since htm document is mal-formatted: <th>Sample<p></p>ID</th>
             smp_header[0] = "Sample ID"
-    
-            ## Parse Barcode lane statistics
-            soup = BeautifulSoup(htm_doc)
-            table = soup.findAll("table")[1]
-            rows = table.findAll("tr")
-            column_gen = (row.findAll("td") for row in rows)
-            parse_row = lambda row: {bc_header[i]:str(row[i].string) for i in range(0, len(bc_header)) if row}
-            metrics["Barcode_lane_statistics"].extend(map(parse_row, column_gen))
-    
-            ## Parse Sample information
-            soup = BeautifulSoup(htm_doc)
-            table = soup.findAll("table")[3]
-            rows = table.findAll("tr")
-            column_gen = (row.findAll("td") for row in rows)
-            parse_row = lambda row: {smp_header[i]:str(row[i].string) for i in range(0, len(smp_header)) if row}
-            metrics["Sample_information"].extend(map(parse_row, column_gen))
-            
+
+            ## Parse Barcode lane statistics and Sample information;
+            ## rows without data cells give empty dictionaries
+            parse_row = lambda header, row: dict(zip(header, [text for tag, text in row if tag == "td"]))
+            metrics["Barcode_lane_statistics"].extend([parse_row(bc_header, row) for row in tables[1]])
+            metrics["Sample_information"].extend([parse_row(smp_header, row) for row in tables[3]])
+
         ## Set data
-        return metrics
+        return DemultiplexStats(metrics)
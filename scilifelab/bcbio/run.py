@@ -3,7 +3,8 @@ import os
 import re
 import yaml
 import glob
-from itertools import chain
+import multiprocessing
+from itertools import chain, izip
 import pandas as pd
 import datetime
 
@@ -12,6 +13,7 @@ from scilifelab.utils.dry import dry_write, dry_backup, dry_unlink, dry_rmdir, d
 from scilifelab.log import minimal_logger
 from scilifelab.bcbio import sort_sample_config_fastq, update_sample_config, update_pp_platform_args, merge_sample_config
 from scilifelab.bcbio.flowcell import Flowcell
+from scilifelab.utils.metrics_cache import file_signature
 
 LOG = minimal_logger(__name__)
 
@@ -25,6 +27,10 @@ PROCESS_YAML = True
 FC_SPECIFIC_AMPQ = True
 ## Name of merged sample output directory
 MERGED_SAMPLE_OUTPUT_DIR = "TOTAL"
+## Use the C yaml loader if libyaml is available
+YAML_LOADER = getattr(yaml, "CLoader", yaml.Loader)
+## Columns of the sample table
+SAMPLE_TABLE_COLUMNS = ["sample", "lane", "barcode_id", "fc_name", "fc_date", "path"]
 
 def _sample_status(x):
     """Find the status of a sample.
@@ -46,11 +52,9 @@ def _group_samples(flist, include_merged=False):
     :returns: dictionary of samples grouped by name and flowcell
     """
     sample_d = {}
-    for f in flist:
-        if not include_merged and os.path.dirname(f).endswith(MERGED_SAMPLE_OUTPUT_DIR):
-            continue
-        with open(f) as fh:
-            conf = yaml.load(fh)
+    if not include_merged:
+        flist = [f for f in flist if not os.path.dirname(f).endswith(MERGED_SAMPLE_OUTPUT_DIR)]
+    for f, conf in izip(flist, CONFIG_INDEX.load(flist)):
         if conf.get("details", [])[0].get("multiplex", []):
             sample_id = conf.get("details", [])[0].get("multiplex", [])[0].get("name", None)
         else:
@@ -71,37 +75,120 @@ def _group_samples(flist, include_merged=False):
             sample_d[sample_id][fc_id] = f
     return sample_d
 
-## FIXME: make pandas data frame of all samples, with info about lane,
-## flowcell, date, barcode_id, path, sample name -> makes searching for files much easier
-def sample_table(flist):
+def _sample_table_rows(f, conf):
+    """Get the sample table rows of a bcbb-config yaml file.
+
+    :param f: config file name
+    :param conf: config
+
+    :returns: list of rows
+    """
+    samples = []
+    path = os.path.dirname(f)
+    runinfo = conf.get("details") if conf.get("details", None) else conf
+    for info in runinfo:
+        lane = info.get("lane", None)
+        fc_name = info.get("flowcell_id", None)
+        fc_date = info.get("fc_date", None)
+        if info.get("multiplex", None):
+            for mp in info.get("multiplex"):
+                barcode_id = mp.get("barcode_id", None)
+                sample = mp.get("name", None)
+                samples.append([sample, lane, barcode_id, fc_name, fc_date, path])
+        else:
+            barcode_id = None
+            sample = info.get("description", None)
+            fc_name = conf.get("fc_name", None)
+            fc_date = conf.get("fc_date", None)
+            samples.append([sample, lane, barcode_id, fc_name, fc_date, path])
+    return samples
+
+def _read_config(f):
+    """Read a bcbb-config yaml file. Module level so that it can be
+    run in worker processes.
+
+    :param f: config file name
+
+    :returns: tuple of (file name, file signature, config)
+    """
+    sig = file_signature([f])
+    with open(f) as fh:
+        return (f, sig, yaml.load(fh, Loader=YAML_LOADER))
+
+class ConfigIndex(object):
+    """Index of parsed bcbb-config yaml files.
+
+    Configs are kept with the size and modification time of their
+    files, so that a config is only parsed again when its file has
+    changed. Configs that need parsing are parsed in parallel if more
+    than one worker is requested. Configs are shared between callers
+    and must not be modified.
+    """
+    def __init__(self):
+        self._entries = {}
+
+    def load(self, flist, workers=1):
+        """Get the configs of a list of files.
+
+        :param flist: list of config files
+        :param workers: number of processes used to parse configs
+
+        :returns: list of configs, in the order of flist
+        """
+        stale = [f for f in set(flist) if not f in self._entries or self._entries[f][0] != file_signature([f])]
+        workers = min(workers, len(stale))
+        if workers <= 1:
+            res = map(_read_config, stale)
+        else:
+            LOG.info("Reading {} config files with {} worker processes".format(len(stale), workers))
+            pool = multiprocessing.Pool(workers)
+            try:
+                res = pool.map(_read_config, stale)
+            finally:
+                pool.close()
+                pool.join()
+        for f, sig, conf in res:
+            self._entries[f] = [sig, conf, None]
+        return [self._entries[f][1] for f in flist]
+
+    def get(self, f):
+        """Get the config of a file.
+
+        :param f: config file
+
+        :returns: config
+        """
+        return self.load([f])[0]
+
+    def sample_table(self, flist, workers=1):
+        """Make a table of the samples of a list of config files.
+
+        :param flist: list of config files
+        :param workers: number of processes used to parse configs
+
+        :returns: data frame with columns sample, lane, barcode_id, fc_name, fc_date and path
+        """
+        self.load(flist, workers)
+        samples = []
+        for f in flist:
+            entry = self._entries[f]
+            if entry[2] is None:
+                entry[2] = _sample_table_rows(f, entry[1])
+            samples.extend(entry[2])
+        return pd.DataFrame(samples, columns=SAMPLE_TABLE_COLUMNS)
+
+## Index shared by the functions that read bcbb-config yaml files
+CONFIG_INDEX = ConfigIndex()
+
+def sample_table(flist, workers=1):
     """Make a table from bcbb-config yaml files.
 
     :param flist: file list of config files
+    :param workers: number of processes used to parse configs
 
     :returns: data frame
     """
-    samples = []
-    for f in flist:
-        path = os.path.dirname(f)
-        with open(f) as fh:
-            conf = yaml.load(fh)
-        runinfo = conf.get("details") if conf.get("details", None) else conf
-        for info in runinfo:
-            lane = info.get("lane", None)
-            fc_name = info.get("flowcell_id", None)
-            fc_date = info.get("fc_date", None)
-            if info.get("multiplex", None):
-                for mp in info.get("multiplex"):
-                    barcode_id = mp.get("barcode_id", None)
-                    sample = mp.get("name", None)
-                    samples.append([sample, lane, barcode_id, fc_name, fc_date, path])
-            else:
-                barcode_id = None
-                sample = info.get("description", None)
-                fc_name = conf.get("fc_name", None)
-                fc_date = conf.get("fc_date", None)
-                samples.append([sample, lane, barcode_id, fc_name, fc_date, path])
-    return pd.DataFrame(samples, columns=["sample", "lane", "barcode_id", "fc_name", "fc_date", "path"])
+    return CONFIG_INDEX.sample_table(flist, workers)
                                   
 def get_vcf_files(flist, vcfext="sort-gatkrecal-realign-variants-combined-phased-annotated", **kw):
     """Get dictionary of vcf files.
@@ -110,7 +197,7 @@ def get_vcf_files(flist, vcfext="sort-gatkrecal-realign-variants-combined-phased
 
     """
     vcf_d = {}
-    samples = sample_table(flist)
+    samples = sample_table(flist, kw.get("workers", 1))
     grouped = samples.groupby("sample")
     for name, group in grouped:
         LOG.debug("Getting vcf file for sample {}".format(name))
@@ -218,6 +305,7 @@ def find_samples(path, sample=None, pattern = "-bcbb-config.yaml$", only_failed=
     """
     def bcbb_yaml_filter(f):
         return re.search(pattern, f) != None
+    workers = kw.get("workers", None) or 1
     flist = []
     if sample:
         if os.path.exists(sample):
@@ -227,15 +315,14 @@ def find_samples(path, sample=None, pattern = "-bcbb-config.yaml$", only_failed=
             if len(flist) == 0:
                 flist = [os.path.join(path, x.rstrip()) for x in samplelist if len(x) > 1]
                 # Make sure there actually is a config file in path
-                flist = list(chain.from_iterable([filtered_walk(x, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None)) for x in flist]))
+                flist = list(chain.from_iterable([filtered_walk(x, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None), workers=workers) for x in flist]))
             if len(flist) == 0:
                 return flist
         else:
             pattern = "{}{}".format(sample, pattern)
     if not flist:
-        flist = filtered_walk(path, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None))
+        flist = filtered_walk(path, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None), workers=workers)
     if only_failed:
-        status = {x:_sample_status(x) for x in flist}
         flist = [x for x in flist if _sample_status(x)=="FAIL"]
     if len(flist) == 0 and sample:
         LOG.info("No such sample {}".format(sample))
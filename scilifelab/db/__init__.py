@@ -1,10 +1,27 @@
 """Database module"""
 import os
 import sys
+import copy
+import time
+import json
+import socket
 import couchdb
+import urlparse
+from multiprocessing.pool import ThreadPool
 
 from scilifelab.log import minimal_logger
 from scilifelab.utils.http import check_url
+from scilifelab.db.local import LocalServer, is_local_url
+from scilifelab.db.profile import PROFILE, ProfiledDatabase
+
+# Defaults for concurrent document fetching
+FETCH_WORKERS = 8
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.5
+
+# Defaults for incremental syncing via the _changes feed
+CHANGES_STATEFILE = os.path.join(os.path.expanduser("~"), ".pm", "changes.json")
+CHANGES_BATCH_SIZE = 1000
 
 class ConnectionError(Exception):
     """Exception raised for connection errors.
@@ -44,11 +61,12 @@ class Couch(Database):
 
     def __init__(self, log=None, url="localhost", **kwargs):
         self.db = None
+        self._entry_cache = {}
         self.url = url
         self.port = 5984
         self.user = kwargs.get("username", None)
         self.pw = kwargs.get("password", None)
-        self.url_string = "http://{}:{}".format(self.url, self.port)
+        self.url_string = url if is_local_url(url) else "http://{}:{}".format(self.url, self.port)
         if log:
             self.log = log
         super(Couch, self).__init__(**kwargs)        
@@ -56,6 +74,10 @@ class Couch(Database):
             raise ConnectionError("Connection failed for url {}".format(self.url_string))
 
     def connect(self, username=None, password=None, url="localhost", port=5984, **kw):
+        if is_local_url(self.url_string):
+            self.con = LocalServer(self.url_string)
+            self.log.debug("Using local database directory {}".format(self.con.path))
+            return
         if not username or not password or not url:
             self.log.warn("please supply username, password, and url")
             return None
@@ -67,13 +89,23 @@ class Couch(Database):
         self.user = username
         self.pw = password
 
+    @property
+    def db(self):
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        """Set database, instrumented if database profiling is enabled"""
+        self._db = ProfiledDatabase(db, PROFILE) if PROFILE.enabled and db is not None else db
+
     def set_db(self, dbname):
         """Set database to use
 
         :param dbname: database name
         """
         try:
-            self.db = self.con[dbname]
+            with PROFILE.timer(dbname, "set_db"):
+                self.db = self.con[dbname]
         except:
             return None
 
@@ -87,10 +119,15 @@ class Couch(Database):
         if not self._doc_type:
             return
         self.log.debug("retrieving field entry in field '{}' for name '{}'".format(field, name))
-        if self.name_view.get(name, None) is None:
+        if name in self._entry_cache:
+            PROFILE.record(self.db.name, "get_entry", cached=True)
+            doc = self._doc_type(**copy.deepcopy(self._entry_cache[name]))
+        elif self.name_view.get(name, None) is None:
             self.log.warn("no field '{}' for name '{}'".format(field, name))
             return None
-        doc = self._doc_type(**self.db.get(self.name_view.get(name)))
+        else:
+            PROFILE.record(self.db.name, "get_entry")
+            doc = self._doc_type(**self.db.get(self.name_view.get(name)))
         if field:
             return doc[field]
         else:
@@ -104,16 +141,148 @@ class Couch(Database):
         :param obj: database object to save
         """
         if not self._update_fn:
+            self._invalidate(obj)
             self.db.save(obj)
             self.log.info("Saving object {} with id {}".format(repr(obj), obj["_id"]))
         else:
             (new_obj, dbid) = self._update_fn(self.db, obj, **kwargs)
             if not new_obj is None:
+                self._invalidate(new_obj)
                 self.log.info("Saving object {} with id '{}'".format(repr(new_obj), new_obj["_id"]))
                 self.db.save(new_obj)
             else:
                 self.log.info("Object {} with id '{}' present and not in need of updating".format(repr(obj), dbid.id))
 
+    def save_many(self, objs, unchanged=None, **kwargs):
+        """Save/update several database objects in one bulk request.
+        As in save, objects that are already present are only saved
+        if they have been modified.
+
+        :param objs: list of database objects to save
+        :param unchanged: list to which objects that are present and not in need of updating are appended
+
+        :returns: list of saved objects
+        """
+        new_objs = []
+        for obj in objs:
+            if not self._update_fn:
+                self._invalidate(obj)
+                new_objs.append(obj)
+                continue
+            (new_obj, dbid) = self._update_fn(self.db, obj, **kwargs)
+            if new_obj is None:
+                self.log.info("Object {} with id '{}' present and not in need of updating".format(repr(obj), dbid.id))
+                if unchanged is not None:
+                    unchanged.append(obj)
+            else:
+                self._invalidate(new_obj)
+                new_objs.append(new_obj)
+        if not new_objs:
+            return []
+        saved = []
+        for obj, (success, docid, res) in zip(new_objs, self.db.update(new_objs)):
+            if success:
+                self.log.info("Saving object {} with id '{}'".format(repr(obj), docid))
+                saved.append(obj)
+            else:
+                self.log.warn("Failed to save object {} with id '{}': {}".format(repr(obj), docid, res))
+        return saved
+
+    def _invalidate(self, obj):
+        """Remove cached copies of <obj> so that subsequent get_entry
+        calls see the saved version. Copies are matched by id, and by
+        name since objects saved by <update_fn> are mapped onto the
+        database object of the same name, which has a different id.
+
+        :param obj: database object
+        """
+        for name in [k for k, v in self._entry_cache.iteritems() if v.get("_id") == obj.get("_id") or (obj.get("name") is not None and k == obj.get("name"))]:
+            del self._entry_cache[name]
+
+    def fetch_document(self, name, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF):
+        """Fetch a document from the database, retrying on connection
+        errors with exponential backoff.
+
+        :param name: unique name identifier (primary key, not the uuid)
+        :param retries: number of retries
+        :param backoff: initial backoff time in seconds, doubled for each retry
+
+        :returns: document of type _doc_type, or None if no such name
+        """
+        dbid = self.name_view.get(name, None)
+        if dbid is None:
+            return None
+        for attempt in range(retries + 1):
+            try:
+                obj = self.db.get(dbid)
+                return self._doc_type(**obj) if obj is not None else None
+            except (socket.error, couchdb.ServerError) as e:
+                if attempt == retries:
+                    raise
+                wait = backoff * 2 ** attempt
+                self.log.warn("fetching document '{}' failed ({}); retrying in {} seconds".format(name, e, wait))
+                time.sleep(wait)
+
+    def prefetch(self, names, **kw):
+        """Concurrently fetch documents and cache them for subsequent
+        calls to get_entry.
+
+        :param names: list of unique name identifiers
+        :param kw: keyword arguments passed to fetch_entries
+        """
+        prefetch_entries([(self, x) for x in names], **kw)
+
+    def changes_tracker(self, **kw):
+        """Get a tracker for changes to the database since a previous run.
+
+        :param kw: keyword arguments passed to ChangesTracker
+
+        :returns: <ChangesTracker> object
+        """
+        return ChangesTracker(self.db, **kw)
+
+
+def _fetch_entry(args):
+    """Worker function for fetch_entries"""
+    (con, name, retries, backoff) = args
+    return (con, name, con.fetch_document(name, retries=retries, backoff=backoff))
+
+def fetch_entries(keys, workers=FETCH_WORKERS, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF):
+    """Concurrently fetch documents from one or more databases.
+
+    Documents are yielded as they complete, so the order of the output
+    does not follow the order of *keys*.
+
+    :param keys: list of (connection, name) tuples, where connection is a <Couch> object
+    :param workers: maximum number of concurrent requests
+    :param retries: number of retries per document on connection errors
+    :param backoff: initial backoff time in seconds, doubled for each retry
+
+    :returns: generator of (connection, name, document) tuples; document is None for missing names
+    """
+    keys = list(set(keys))
+    if not keys:
+        return
+    pool = ThreadPool(max(1, min(workers, len(keys))))
+    try:
+        for res in pool.imap_unordered(_fetch_entry, [(con, name, retries, backoff) for con, name in keys]):
+            yield res
+    finally:
+        pool.terminate()
+
+def prefetch_entries(keys, **kw):
+    """Concurrently fetch documents from one or more databases and
+    cache them in their connections. Names that are already cached are
+    not fetched again.
+
+    :param keys: list of (connection, name) tuples, where connection is a <Couch> object
+    :param kw: keyword arguments passed to fetch_entries
+    """
+    keys = [(con, name) for con, name in keys if name is not None and name not in con._entry_cache]
+    for (con, name, doc) in fetch_entries(keys, **kw):
+        if doc is not None:
+            con._entry_cache[name] = doc
+
 
 class GenoLogics(Database):
     def __init__(**kwargs):
@@ -121,3 +290,98 @@ class GenoLogics(Database):
 
     def connect(self, username=None, password=None):
         pass
+
+
+class ChangesTracker(object):
+    """Track the changes of a couch database between runs.
+
+    The last processed sequence number of the _changes feed is
+    persisted per database, identified by server url and database
+    name, in a json state file, so that a consumer
+    only needs to process documents that have changed since its
+    previous run. Consumers that should track changes independently
+    must use separate state files.
+
+    :param db: couch database
+    :param statefile: file in which processed sequence numbers are stored
+    :param batch_size: number of changes to retrieve per request
+    """
+
+    def __init__(self, db, statefile=CHANGES_STATEFILE, batch_size=CHANGES_BATCH_SIZE):
+        self.db = db
+        self.statefile = statefile
+        self.batch_size = batch_size
+        self.log = minimal_logger(repr(self))
+        self.key = self._state_key(db)
+        self.last_seq = self._read_state().get(self.key, 0)
+        self.seq = self.last_seq
+
+    def __repr__(self):
+        return "{}".format(self.__class__)
+
+    @staticmethod
+    def _state_key(db):
+        """Get the state file key of a database, its url without
+        credentials, or its name if the url is unknown."""
+        resource = getattr(db, "resource", None)
+        url = resource.url if resource is not None else getattr(db, "url", None)
+        if not url:
+            return db.name
+        url = urlparse.urlsplit(url)
+        netloc = url.netloc.rpartition("@")[2]
+        return urlparse.urlunsplit((url.scheme, netloc, url.path.rstrip("/"), "", ""))
+
+    def _read_state(self):
+        if not os.path.exists(self.statefile):
+            return {}
+        with open(self.statefile) as fh:
+            try:
+                return json.load(fh)
+            except ValueError:
+                self.log.warn("could not parse state file {}; processing all changes".format(self.statefile))
+                return {}
+
+    def changes(self, include_docs=False, **kw):
+        """Get changes since the last committed sequence number.
+
+        Changes are retrieved in batches of batch_size. After a batch
+        has been consumed, seq holds the sequence number up to which
+        changes have been seen; call commit to persist it.
+
+        :param include_docs: include documents in the change rows
+        :param kw: keyword arguments passed to db.changes, e.g. filter
+
+        :returns: generator of change rows, dictionaries with keys 'id', 'seq', 'changes', and optionally 'deleted' and 'doc'
+        """
+        since = self.seq
+        while True:
+            res = self.db.changes(since=since, limit=self.batch_size, include_docs=include_docs, **kw)
+            for row in res["results"]:
+                yield row
+            since = res["last_seq"]
+            self.seq = since
+            if len(res["results"]) < self.batch_size:
+                break
+
+    def commit(self, seq=None):
+        """Persist the sequence number up to which changes have been processed.
+
+        :param seq: sequence number; defaults to the last seen sequence number
+        """
+        seq = self.seq if seq is None else seq
+        state = self._read_state()
+        state[self.key] = seq
+        dirname = os.path.dirname(self.statefile)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmpfile = "{}.tmp".format(self.statefile)
+        with open(tmpfile, "w") as fh:
+            json.dump(state, fh, indent=1)
+        os.rename(tmpfile, self.statefile)
+        self.log.debug("committed sequence number {} for database {}".format(seq, self.key))
+        self.last_seq = seq
+
+    def reset(self):
+        """Forget the processed sequence number so that all documents are processed on the next run"""
+        self.seq = 0
+        self.commit(0)
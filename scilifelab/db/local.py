@@ -0,0 +1,449 @@
+"""Embedded database backend for running without a couchdb server.
+
+Documents are stored in one SQLite file per database. The classes
+implement the subset of the couchdb-python Server and Database
+interfaces that the statusdb connections use, so that a <Couch>
+connection with an url of the form sqlite:///path/to/directory works
+on local disk. Views are python map functions, defined with
+LocalDatabase.define_views, whose rows are kept in an indexed table
+and updated whenever a document is saved.
+"""
+import os
+import json
+import uuid
+import sqlite3
+import hashlib
+import marshal
+import struct
+import threading
+import collections
+
+import couchdb
+
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+LOCAL_URL_PREFIX = "sqlite://"
+
+SCHEMA = ["CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, rev TEXT, seq INTEGER, deleted INTEGER DEFAULT 0, doc TEXT)",
+          "CREATE INDEX IF NOT EXISTS docs_seq ON docs (seq)",
+          "CREATE TABLE IF NOT EXISTS views (view TEXT PRIMARY KEY, signature TEXT)",
+          "CREATE TABLE IF NOT EXISTS view_rows (view TEXT, key TEXT, id TEXT, value TEXT, ckey BLOB)",
+          "DROP INDEX IF EXISTS view_rows_key",
+          "CREATE INDEX IF NOT EXISTS view_rows_ckey ON view_rows (view, ckey, id)",
+          "CREATE INDEX IF NOT EXISTS view_rows_id ON view_rows (view, id)",
+          ]
+
+Row = collections.namedtuple("Row", ["id", "key", "value", "doc"])
+
+def is_local_url(url):
+    """Check whether an url points to an embedded database directory.
+
+    :param url: database url
+
+    :returns: True if url starts with sqlite://
+    """
+    return url is not None and str(url).startswith(LOCAL_URL_PREFIX)
+
+def _collate(value):
+    """Encode a key so that byte order follows the couchdb view
+    collation order: null, false, true, numbers, strings, arrays,
+    objects. Strings compare by code point. Each value starts with a
+    nonzero type byte so that a zero byte ends arrays and objects."""
+    if value is None:
+        return "\x01"
+    if value is False:
+        return "\x02"
+    if value is True:
+        return "\x03"
+    if isinstance(value, (int, long, float)):
+        bits = struct.pack(">d", float(value) or 0.0)
+        if ord(bits[0]) & 0x80:
+            bits = "".join(chr(~ord(x) & 0xff) for x in bits)
+        else:
+            bits = chr(ord(bits[0]) | 0x80) + bits[1:]
+        return "\x04" + bits
+    if isinstance(value, basestring):
+        return "\x05" + _collate_string(value)
+    if isinstance(value, (list, tuple)):
+        return "\x06" + "".join(_collate(x) for x in value) + "\x00"
+    if isinstance(value, dict):
+        return "\x07" + "".join("\x01" + _collate_string(k) + _collate(v) for k, v in sorted(value.iteritems())) + "\x00"
+    raise TypeError("can not collate value {}".format(value))
+
+def _collate_string(value):
+    """UTF-8 preserves code point order; zero bytes are escaped so that
+    the terminator sorts before any content"""
+    value = value.encode("utf-8") if isinstance(value, unicode) else value
+    return value.replace("\x00", "\x00\xff") + "\x00\x00"
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True)
+
+def _signature(fn):
+    """Signature of a map function, used to detect changed view definitions"""
+    return hashlib.md5(marshal.dumps(fn.func_code)).hexdigest()
+
+
+class ViewResults(list):
+    """List of view rows; rows is provided for compatibility with couchdb-python"""
+    @property
+    def rows(self):
+        return self
+
+
+class LocalDatabase(object):
+    """SQLite backed document database.
+
+    :param filename: database file
+    :param name: database name
+    """
+    def __init__(self, filename, name):
+        self.filename = filename
+        self.name = name
+        self._views = {}
+        self._reduce_funs = {}
+        self._lock = threading.RLock()
+        self._con = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock:
+            columns = [x[1] for x in self._con.execute("PRAGMA table_info(view_rows)")]
+            if columns and "ckey" not in columns:
+                # Rows written before keys were collated; rebuild all indexes
+                self._con.execute("DROP TABLE view_rows")
+                self._con.execute("DELETE FROM views")
+            for stmt in SCHEMA:
+                self._con.execute(stmt)
+            self._con.commit()
+
+    def __repr__(self):
+        return "<{} '{}'>".format(self.__class__.__name__, self.name)
+
+    @property
+    def url(self):
+        """Database url, the server url followed by the database name"""
+        return "{}{}/{}".format(LOCAL_URL_PREFIX, os.path.abspath(os.path.dirname(self.filename)), self.name)
+
+    def __contains__(self, docid):
+        return self.get(docid) is not None
+
+    def __getitem__(self, docid):
+        doc = self.get(docid)
+        if doc is None:
+            raise couchdb.ResourceNotFound(("not_found", "missing"))
+        return doc
+
+    def __iter__(self):
+        with self._lock:
+            return iter([x[0] for x in self._con.execute("SELECT id FROM docs WHERE deleted=0 ORDER BY id")])
+
+    def __len__(self):
+        with self._lock:
+            return self._con.execute("SELECT COUNT(*) FROM docs WHERE deleted=0").fetchone()[0]
+
+    def get(self, docid, default=None):
+        """Get a document.
+
+        :param docid: document id
+        :param default: value to return if no such document
+
+        :returns: document dictionary
+        """
+        with self._lock:
+            res = self._con.execute("SELECT doc FROM docs WHERE id=? AND deleted=0", (docid,)).fetchone()
+        return json.loads(res[0]) if res else default
+
+    def save(self, doc):
+        """Save a document. The document must have the current revision
+        of an existing document with the same id. _id and _rev are
+        updated in place.
+
+        :param doc: document dictionary
+
+        :returns: tuple of document id and revision
+        """
+        with self._lock:
+            docid = doc.get("_id", None) or uuid.uuid4().hex
+            res = self._con.execute("SELECT rev, deleted FROM docs WHERE id=?", (docid,)).fetchone()
+            if res and not res[1] and res[0] != doc.get("_rev", None):
+                raise couchdb.ResourceConflict(("conflict", "Document update conflict."))
+            n = int(res[0].split("-")[0]) + 1 if res else 1
+            doc["_id"] = docid
+            doc.pop("_rev", None)
+            rev = "{}-{}".format(n, hashlib.md5(_dumps(doc)).hexdigest())
+            doc["_rev"] = rev
+            self._write(docid, rev, doc)
+            self._con.commit()
+        return (docid, rev)
+
+    def update(self, documents):
+        """Save several documents. As in couchdb bulk updates,
+        documents with _deleted set are deleted.
+
+        :param documents: list of document dictionaries
+
+        :returns: list of (success, id, rev or exception) tuples
+        """
+        results = []
+        for doc in documents:
+            try:
+                results.append((True,) + (self.delete(doc) if doc.get("_deleted", False) else self.save(doc)))
+            except (couchdb.ResourceConflict, couchdb.ResourceNotFound) as e:
+                results.append((False, doc.get("_id", None), e))
+        return results
+
+    def delete(self, doc):
+        """Delete a document.
+
+        :param doc: document dictionary with _id and _rev
+
+        :returns: tuple of document id and revision of the deletion
+        """
+        with self._lock:
+            res = self._con.execute("SELECT rev FROM docs WHERE id=? AND deleted=0", (doc["_id"],)).fetchone()
+            if not res:
+                raise couchdb.ResourceNotFound(("not_found", "missing"))
+            if res[0] != doc.get("_rev", None):
+                raise couchdb.ResourceConflict(("conflict", "Document update conflict."))
+            rev = "{}-deleted".format(int(res[0].split("-")[0]) + 1)
+            self._write(doc["_id"], rev, None)
+            self._con.commit()
+        return (doc["_id"], rev)
+
+    def _write(self, docid, rev, doc):
+        """Store a document revision and update view rows; doc is None
+        for deletions. Must be called with the lock held."""
+        seq = self._con.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM docs").fetchone()[0]
+        self._con.execute("INSERT OR REPLACE INTO docs (id, rev, seq, deleted, doc) VALUES (?, ?, ?, ?, ?)",
+                          (docid, rev, seq, 1 if doc is None else 0, None if doc is None else _dumps(doc)))
+        self._con.execute("DELETE FROM view_rows WHERE id=?", (docid,))
+        # Indexes of views that are not defined in this process can
+        # not be updated; they are rebuilt when next defined
+        self._con.execute("DELETE FROM views WHERE view NOT IN ({})".format(",".join("?" * len(self._views))), self._views.keys())
+        if doc is not None:
+            for viewname, fn in self._views.iteritems():
+                self._index(viewname, fn, docid, doc)
+
+    def _index(self, viewname, fn, docid, doc):
+        try:
+            rows = [(viewname, _dumps(k), docid, _dumps(v), buffer(_collate(k))) for k, v in fn(doc)]
+        except Exception as e:
+            LOG.debug("map function of view {} failed for document {}: {}".format(viewname, docid, e))
+            return
+        self._con.executemany("INSERT INTO view_rows (view, key, id, value, ckey) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def define_views(self, views):
+        """Define views. Indexes of new or modified views are built.
+
+        :param views: dictionary mapping view names (design/view) to
+          map functions, or to dictionaries with keys 'map' and
+          'reduce'. A map function takes a document and returns an
+          iterable of (key, value) tuples. Supported reduce functions
+          are '_count' and '_sum'.
+        """
+        with self._lock:
+            for viewname, view in views.iteritems():
+                view = view if isinstance(view, dict) else {'map':view}
+                self._views[viewname] = view["map"]
+                self._reduce_funs[viewname] = view.get("reduce", None)
+            stored = dict(self._con.execute("SELECT view, signature FROM views").fetchall())
+            for viewname, fn in self._views.iteritems():
+                if stored.get(viewname, None) == _signature(fn):
+                    continue
+                LOG.debug("building index of view {} in database {}".format(viewname, self.name))
+                self._con.execute("DELETE FROM view_rows WHERE view=?", (viewname,))
+                for docid, doc in self._con.execute("SELECT id, doc FROM docs WHERE deleted=0").fetchall():
+                    self._index(viewname, fn, docid, json.loads(doc))
+                self._con.execute("INSERT OR REPLACE INTO views (view, signature) VALUES (?, ?)", (viewname, _signature(fn)))
+            self._con.commit()
+
+    def view(self, name, wrapper=None, reduce=True, group=False, include_docs=False, descending=False, skip=0, limit=None, **options):
+        """Query a view. Arguments follow couchdb-python Database.view;
+        the stale option is accepted and ignored since indexes are
+        always up to date.
+
+        :param name: view name (design/view)
+
+        :returns: list of rows with attributes id, key, value and doc
+        """
+        if name not in self._views:
+            raise couchdb.ResourceNotFound(("not_found", "missing_named_view"))
+        reduce = reduce and self._reduce_funs[name]
+        order = "DESC" if descending else "ASC"
+        with self._lock:
+            if "key" in options or "keys" in options:
+                res = []
+                for key in [options["key"]] if "key" in options else options["keys"]:
+                    res.extend(self._con.execute("SELECT key, id, value FROM view_rows WHERE view=? AND ckey=? ORDER BY id {}".format(order),
+                                                 (name, buffer(_collate(key)))).fetchall())
+                if not reduce:
+                    res = res[skip:None if limit is None else skip + limit]
+            else:
+                where, args = ["view=?"], [name]
+                (lower, upper) = ("endkey", "startkey") if descending else ("startkey", "endkey")
+                if lower in options:
+                    where.append("ckey>=?")
+                    args.append(buffer(_collate(options[lower])))
+                if upper in options:
+                    where.append("ckey<=?")
+                    args.append(buffer(_collate(options[upper])))
+                query = "SELECT key, id, value FROM view_rows WHERE {} ORDER BY ckey {}, id {}".format(" AND ".join(where), order, order)
+                if not reduce:
+                    query += " LIMIT ? OFFSET ?"
+                    args.extend([-1 if limit is None else limit, skip])
+                res = self._con.execute(query, args).fetchall()
+        rows = [(json.loads(k), docid, json.loads(v)) for k, docid, v in res]
+        if reduce:
+            return self._reduce(reduce, rows, group)
+        return ViewResults([Row(docid, k, v, self.get(docid) if include_docs else None) for k, docid, v in rows])
+
+    def _reduce(self, reduce_fun, rows, group):
+        groups = collections.OrderedDict()
+        for k, docid, v in rows:
+            groups.setdefault(_dumps(k) if group else None, []).append(v)
+        if reduce_fun == "_count":
+            reduced = [(k, len(v)) for k, v in groups.iteritems()]
+        elif reduce_fun == "_sum":
+            reduced = [(k, sum(v)) for k, v in groups.iteritems()]
+        else:
+            raise ValueError("unsupported reduce function {}".format(reduce_fun))
+        return ViewResults([Row(None, json.loads(k) if group else None, v, None) for k, v in reduced])
+
+    def changes(self, since=0, limit=None, include_docs=False, **opts):
+        """Get the changes feed.
+
+        :param since: sequence number to start from
+        :param limit: maximum number of changes
+        :param include_docs: include documents
+
+        :returns: dictionary with keys results and last_seq
+        """
+        with self._lock:
+            res = self._con.execute("SELECT id, rev, seq, deleted, doc FROM docs WHERE seq > ? ORDER BY seq LIMIT ?",
+                                    (since, -1 if limit is None else limit)).fetchall()
+        results = []
+        for docid, rev, seq, deleted, doc in res:
+            row = {"id":docid, "seq":seq, "changes":[{"rev":rev}]}
+            if deleted:
+                row["deleted"] = True
+            if include_docs:
+                row["doc"] = json.loads(doc) if doc else None
+            results.append(row)
+        return {"results":results, "last_seq":results[-1]["seq"] if results else since}
+
+
+class LocalServer(object):
+    """Directory of embedded databases, one SQLite file per database.
+
+    Databases are created on first access.
+
+    :param url: directory path, optionally prefixed with sqlite://
+    """
+    def __init__(self, url):
+        self.path = url[len(LOCAL_URL_PREFIX):] if is_local_url(url) else url
+        self._dbs = {}
+        self._lock = threading.Lock()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def __repr__(self):
+        return "<{} '{}'>".format(self.__class__.__name__, self.path)
+
+    def _filename(self, name):
+        return os.path.join(self.path, "{}.sqlite".format(name))
+
+    def __contains__(self, name):
+        return os.path.exists(self._filename(name))
+
+    def __iter__(self):
+        return iter(sorted([os.path.splitext(x)[0] for x in os.listdir(self.path) if x.endswith(".sqlite")]))
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._dbs:
+                self._dbs[name] = LocalDatabase(self._filename(name), name)
+            return self._dbs[name]
+
+    def create(self, name):
+        """Create a database.
+
+        :param name: database name
+        """
+        if name in self:
+            raise couchdb.PreconditionFailed(("file_exists", "The database could not be created, the file already exists."))
+        return self[name]
+
+    def delete(self, name):
+        """Delete a database.
+
+        :param name: database name
+        """
+        if name not in self:
+            raise couchdb.ResourceNotFound(("not_found", "missing"))
+        with self._lock:
+            db = self._dbs.pop(name, None)
+            if db:
+                db._con.close()
+            os.unlink(self._filename(name))
+
+    def tasks(self):
+        """Running tasks; view indexes are updated on save so there are none"""
+        return []
+
+
+def replicate(source, target, update_fn, tracker=None, **kw):
+    """Copy documents from one database to another, e.g. from a local
+    database to statusdb. Documents are matched to target documents
+    by name with update_fn, as when they are saved by a statusdb
+    connection, so that only new and modified documents are written.
+    They are written in one bulk request. Documents deleted in the
+    source are deleted in the target if they were copied under their
+    source id.
+
+    :param source: source database
+    :param target: target database
+    :param update_fn: function (db, doc, **kw) returning the document to write, or None if the target is up to date, and the target id, e.g. the _update_fn of a statusdb connection
+    :param tracker: <ChangesTracker> for source; if given, only changes since its last commit are copied, and the tracker is committed up to the last change that was copied
+    :param kw: keyword arguments passed to update_fn
+
+    :returns: number of copied documents
+    """
+    if tracker:
+        rows = tracker.changes(include_docs=True)
+    else:
+        rows = source.changes(include_docs=True)["results"]
+    docs = []
+    ## Sequence number of each change and index of its document in docs, or None
+    changes = []
+    for row in rows:
+        doc = None
+        if row["id"].startswith("_design/"):
+            pass
+        elif row.get("deleted", False):
+            current = target.get(row["id"], None)
+            if current is not None:
+                doc = {"_id":current["_id"], "_rev":current["_rev"], "_deleted":True}
+        else:
+            doc = dict(row["doc"])
+            doc.pop("_rev", None)
+            (doc, dbid) = update_fn(target, doc, **kw)
+        changes.append((row["seq"], None if doc is None else len(docs)))
+        if doc is not None:
+            docs.append(doc)
+    results = target.update(docs) if docs else []
+    failed = [i for i, (success, docid, res) in enumerate(results) if not success]
+    for i in failed:
+        LOG.warn("failed to copy document {} to {}: {}".format(results[i][1], target.name, results[i][2]))
+    if tracker:
+        if failed:
+            seq = tracker.last_seq
+            for s, i in changes:
+                if i is not None and i >= failed[0]:
+                    break
+                seq = s
+            tracker.commit(seq)
+        else:
+            tracker.commit()
+    n = len(results) - len(failed)
+    LOG.info("copied {} documents from {} to {}".format(n, source.name, target.name))
+    return n
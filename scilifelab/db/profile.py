@@ -0,0 +1,176 @@
+"""Instrumentation of database requests.
+
+When profiling is enabled, the databases of <Couch> connections are
+wrapped in a <ProfiledDatabase> that records the number of requests,
+their latencies and payload sizes per database and operation. Cache
+hits of Couch.get_entry are recorded as well. The collected data is
+summarized with DbProfile.summary.
+"""
+import json
+import time
+import threading
+import contextlib
+import collections
+
+class DbProfile(object):
+    """Collects statistics of database requests"""
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._stats = collections.OrderedDict()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def record(self, database, operation, elapsed=0.0, size=0, cached=False):
+        """Record a database request.
+
+        :param database: database name
+        :param operation: operation, e.g. 'get' or 'view names/name'
+        :param elapsed: request time in seconds
+        :param size: payload size in bytes
+        :param cached: True if the request was served from a cache
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            s = self._stats.setdefault((database, operation), {'calls':0, 'hits':0, 'time':0.0, 'max':0.0, 'bytes':0})
+            s['calls'] += 1
+            s['hits'] += 1 if cached else 0
+            s['time'] += elapsed
+            s['max'] = max(s['max'], elapsed)
+            s['bytes'] += size
+
+    @contextlib.contextmanager
+    def timer(self, database, operation):
+        """Context manager that records the time spent in its block.
+        Set the key 'size' of the yielded dictionary to record the
+        payload size."""
+        res = {'size':0}
+        t0 = time.time()
+        try:
+            yield res
+        finally:
+            self.record(database, operation, time.time() - t0, res['size'])
+
+    def stats(self):
+        """Get the collected statistics.
+
+        :returns: dictionary mapping (database, operation) to dictionaries with keys calls, hits, time, max and bytes
+        """
+        with self._lock:
+            return {k:dict(v) for k, v in self._stats.iteritems()}
+
+    def summary(self):
+        """Summarize the collected statistics in a table, sorted by
+        total request time.
+
+        :returns: table as string
+        """
+        stats = self.stats()
+        if not stats:
+            return "No database requests recorded"
+        header = ["database", "operation", "calls", "cache_hits", "total_s", "mean_ms", "max_ms", "kbytes"]
+        rows = []
+        for (database, operation), s in sorted(stats.iteritems(), key=lambda x: x[1]['time'], reverse=True):
+            rows.append([str(database), operation, str(s['calls']), str(s['hits']),
+                         "{:.3f}".format(s['time']), "{:.1f}".format(1000 * s['time'] / s['calls']),
+                         "{:.1f}".format(1000 * s['max']), "{:.1f}".format(s['bytes'] / 1024.0)])
+        total = sum(s['calls'] - s['hits'] for s in stats.values())
+        widths = [max(len(x[i]) for x in [header] + rows) for i in range(len(header))]
+        lines = ["  ".join(x.ljust(w) for x, w in zip(row, widths)) for row in [header] + rows]
+        lines.append("{} database requests in {:.3f} seconds".format(total, sum(s['time'] for s in stats.values())))
+        return "\n".join(lines)
+
+PROFILE = DbProfile()
+
+def _size(obj):
+    try:
+        return len(json.dumps(obj))
+    except (TypeError, ValueError):
+        return 0
+
+class ProfiledDatabase(object):
+    """Database wrapper that records requests in a <DbProfile>.
+
+    Attributes that are not instrumented are delegated to the wrapped
+    database.
+
+    :param db: couch database
+    :param profile: <DbProfile> object
+    """
+    def __init__(self, db, profile=PROFILE):
+        self._db = db
+        self._profile = profile
+
+    def __getattr__(self, attr):
+        return getattr(self._db, attr)
+
+    def __nonzero__(self):
+        return bool(self._db)
+
+    def __iter__(self):
+        return iter(self._db)
+
+    def __len__(self):
+        return len(self._db)
+
+    def _record(self, operation, t0, payload=None):
+        """Record a request started at t0. The payload size is
+        calculated after the elapsed time has been taken."""
+        elapsed = time.time() - t0
+        self._profile.record(self._db.name, operation, elapsed, _size(payload) if payload is not None else 0)
+
+    def __contains__(self, docid):
+        t0 = time.time()
+        res = docid in self._db
+        self._record("head", t0)
+        return res
+
+    def __getitem__(self, docid):
+        t0 = time.time()
+        doc = self._db[docid]
+        self._record("get", t0, doc)
+        return doc
+
+    def get(self, docid, default=None, **kw):
+        t0 = time.time()
+        doc = self._db.get(docid, default, **kw)
+        self._record("get", t0, doc)
+        return doc
+
+    def save(self, doc, **kw):
+        t0 = time.time()
+        res = self._db.save(doc, **kw)
+        self._record("save", t0, doc)
+        return res
+
+    def update(self, documents, **kw):
+        t0 = time.time()
+        res = self._db.update(documents, **kw)
+        self._record("update", t0, documents)
+        return res
+
+    def delete(self, doc):
+        t0 = time.time()
+        self._db.delete(doc)
+        self._record("delete", t0)
+
+    def view(self, name, **options):
+        """Query a view. The request is issued immediately so that its
+        latency can be recorded."""
+        t0 = time.time()
+        view = self._db.view(name, **options)
+        rows = list(view.rows)
+        self._record("view {}".format(name), t0, rows)
+        return view
+
+    def changes(self, **opts):
+        t0 = time.time()
+        changes = self._db.changes(**opts)
+        self._record("changes", t0, changes)
+        return changes
@@ -1,8 +1,14 @@
 """Database backend for connecting to statusdb"""
 import re
+import json
+import math
+import hashlib
 import collections
 from itertools import izip
+import couchdb
+from couchdb.design import ViewDefinition
 from scilifelab.db import Couch
+from scilifelab.db.local import LocalDatabase, LocalServer
 from scilifelab.utils.timestamp import utc_time
 from scilifelab.utils.misc import query_yes_no
 from uuid import uuid4
@@ -10,22 +16,167 @@ from scilifelab.log import minimal_logger
 
 LOG = minimal_logger(__name__)
 
-# Statusdb views essential for pm qc functionality
-# FIXME: import ViewDefinition from couchdb.design and create views if not present
+# Statusdb views essential for pm qc functionality. A view is either
+# a map function or a dictionary with keys 'map' and 'reduce'. Views
+# are installed with sync_views.
 VIEWS = {'samples' : {'names': {'name' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], null);}}''',
                                 'name_fc' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], doc["flowcell"]);}}''',
                                 'name_fc_proj' : '''var list; function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {list = [doc["flowcell"], doc["sample_prj"]];emit(doc["name"], list);}}''',
                                 'name_proj' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], doc["sample_prj"]);}}''',
                                 'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}''',
-                                }},
+                                'name_hash' : '''function(doc) {emit(doc["name"], doc["content_hash"] || null);}''',
+                                },
+                      'qc' : {'project_flowcell' : {'map' : '''function(doc) {
+    if (!doc["name"] || doc["name"].match(/_[0-9]+$/)) {return;}
+    var pm = doc["picard_metrics"] || {};
+    var num = function(section, key) {
+        var v = (pm[section] || {})[key];
+        if (typeof v === "string") {
+            v = v.replace(/,/g, ".");
+            v = /^[+-]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][+-]?[0-9]+)?$/.test(v) ? Number(v) : NaN;
+        }
+        return (typeof v === "number" && isFinite(v)) ? v : -1;
+    };
+    emit([doc["sample_prj"], doc["flowcell"]],
+         [doc["name"], doc["barcode_name"], doc["sample_prj"], doc["lane"], doc["flowcell"], doc["date"],
+          num("AL_PAIR", "TOTAL_READS"), 100 * num("DUP_metrics", "PERCENT_DUPLICATION"),
+          num("INS_metrics", "MEAN_INSERT_SIZE"), num("HS_metrics", "GENOME_SIZE"),
+          num("HS_metrics", "FOLD_ENRICHMENT"), 100 * num("HS_metrics", "PCT_USABLE_BASES_ON_TARGET"),
+          100 * num("HS_metrics", "PCT_TARGET_BASES_10X"), 100 * num("AL_PAIR", "PCT_PF_READS_ALIGNED"),
+          num("HS_metrics", "TARGET_TERRITORY")]);
+}''',
+                                                    'reduce' : '_count'}},
+                      },
          'flowcells' : {'names' : {'name' : '''function(doc) {emit(doc["name"], null);}''',
-                                   'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}'''}},
+                                   'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}''',
+                                   'name_hash' : '''function(doc) {emit(doc["name"], doc["content_hash"] || null);}'''}},
          'projects' : {'project' : {'project_id' : '''function(doc) {emit(doc.project_id, doc._id)}''',
                                     'project_name' : '''function(doc) {emit(doc.project_name, doc._id)}'''},
                        'names' : {'id_to_name' : '''function(doc) {emit(doc["_id"], doc["project_name"]);}''',
-                                  'name' : '''function(doc) {emit(doc["project_name"], null);}'''}},
+                                  'name' : '''function(doc) {emit(doc["project_name"], null);}''',
+                                  'name_hash' : '''function(doc) {emit(doc["project_name"], doc["content_hash"] || null);}'''}},
          }
 
+# Order of values emitted by the qc/project_flowcell view
+QC_VIEW_FIELDS = ["name", "sample", "project", "lane", "flowcell", "date",
+                  "TOTAL_READS", "PERCENT_DUPLICATION", "MEAN_INSERT_SIZE", "GENOME_SIZE",
+                  "FOLD_ENRICHMENT", "PCT_USABLE_BASES_ON_TARGET", "PCT_TARGET_BASES_10X",
+                  "PCT_PF_READS_ALIGNED", "TARGET_TERRITORY"]
+
+# Python equivalents of VIEWS, used by the embedded database backend
+# Numbers in picard metrics strings, which may use decimal commas;
+# matches the test in the num function of qc/project_flowcell
+RE_QC_NUMBER = re.compile(r"[+-]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][+-]?[0-9]+)?\Z")
+
+def _is_run_name(doc):
+    return re.search("_[0-9]+$", doc["name"]) is None
+
+def _map_name(doc):
+    if _is_run_name(doc):
+        yield (doc["name"], None)
+
+def _map_name_fc(doc):
+    if _is_run_name(doc):
+        yield (doc["name"], doc.get("flowcell", None))
+
+def _map_name_fc_proj(doc):
+    if _is_run_name(doc):
+        yield (doc["name"], [doc.get("flowcell", None), doc.get("sample_prj", None)])
+
+def _map_name_proj(doc):
+    if _is_run_name(doc):
+        yield (doc["name"], doc.get("sample_prj", None))
+
+def _map_qc_project_flowcell(doc):
+    if doc.get("name", None) and _is_run_name(doc):
+        yield ([doc.get("sample_prj", None), doc.get("flowcell", None)], _sample_qc_row(doc))
+
+LOCAL_VIEWS = {'samples' : {'names/name' : _map_name,
+                            'names/name_fc' : _map_name_fc,
+                            'names/name_fc_proj' : _map_name_fc_proj,
+                            'names/name_proj' : _map_name_proj,
+                            'names/id_to_name' : lambda doc: [(doc["_id"], doc.get("name", None))],
+                            'names/name_hash' : lambda doc: [(doc.get("name", None), doc.get("content_hash", None))],
+                            'qc/project_flowcell' : {'map' : _map_qc_project_flowcell, 'reduce' : '_count'},
+                            },
+               'flowcells' : {'names/name' : lambda doc: [(doc.get("name", None), None)],
+                              'names/id_to_name' : lambda doc: [(doc["_id"], doc.get("name", None))],
+                              'names/name_hash' : lambda doc: [(doc.get("name", None), doc.get("content_hash", None))]},
+               'projects' : {'project/project_id' : lambda doc: [(doc.get("project_id", None), doc["_id"])],
+                             'project/project_name' : lambda doc: [(doc.get("project_name", None), doc["_id"])],
+                             'names/id_to_name' : lambda doc: [(doc["_id"], doc.get("project_name", None))],
+                             'names/name' : lambda doc: [(doc.get("project_name", None), None)],
+                             'names/name_hash' : lambda doc: [(doc.get("project_name", None), doc.get("content_hash", None))]},
+               }
+
+def sync_views(db, label, views=VIEWS):
+    """Install or update the design documents defined in views for a
+    database. Design documents that are up to date are left untouched.
+
+    :param db: couch database
+    :param label: database label in views, one of 'samples', 'flowcells' and 'projects'
+    :param views: view dictionary
+
+    :returns: list of view definitions
+    """
+    if isinstance(db, LocalDatabase):
+        db.define_views(LOCAL_VIEWS.get(label, {}))
+        return []
+    viewdefs = []
+    for design, v in views.get(label, {}).iteritems():
+        for title, view in v.iteritems():
+            if isinstance(view, dict):
+                viewdefs.append(ViewDefinition(design, title, view["map"], reduce_fun=view.get("reduce", None)))
+            else:
+                viewdefs.append(ViewDefinition(design, title, view))
+    ViewDefinition.sync_many(db, viewdefs)
+    return viewdefs
+
+def update_views(db, label, views=VIEWS, wait=False):
+    """Trigger index builds for the design documents of a database.
+
+    Querying one view per design document updates the index of all
+    views in that design document. Unless wait is set, the queries
+    return immediately and the indexes are built in the background,
+    so that subsequent queries need not wait for them.
+
+    :param db: couch database
+    :param label: database label in views, one of 'samples', 'flowcells' and 'projects'
+    :param views: view dictionary
+    :param wait: block until the indexes are up to date
+
+    :returns: list of queried view names; views missing in the database are skipped
+    """
+    viewnames = []
+    opts = dict(limit=0) if wait else dict(limit=0, stale="update_after")
+    for design, v in views.get(label, {}).iteritems():
+        viewname = "{}/{}".format(design, sorted(v.keys())[0])
+        LOG.debug("updating index of view {} in database {}".format(viewname, db.name))
+        try:
+            db.view(viewname, **opts).rows
+        except couchdb.ResourceNotFound:
+            LOG.warn("no view {} in database {}; install it with 'pm statusdb sync-views'".format(viewname, db.name))
+            continue
+        viewnames.append(viewname)
+    return viewnames
+
+def get_view_build_progress(server, dbnames=None):
+    """Get the progress of running view index builds.
+
+    :param server: couch server
+    :param dbnames: only report builds for these databases
+
+    :returns: list of (database, design document, progress) tuples
+    """
+    progress = []
+    for task in server.tasks():
+        if not "indexer" in task.get("type", "").lower():
+            continue
+        if dbnames and task.get("database", None) not in dbnames:
+            continue
+        progress.append((task.get("database", task.get("task", None)), task.get("design_document", None), task.get("progress", task.get("status", None))))
+    return progress
+
 # Regular expressions for general use
 re_project_id = "^(P[0-9][0-9][0-9])"
 re_project_id_nr = "^P([0-9][0-9][0-9])"
@@ -60,74 +211,121 @@ def _match_barcode_name_to_project_sample(barcode_name, project_samples, extensi
     
     :returns: dictionary with keys project sample name and project sample or None
     """
-    if barcode_name in project_samples.keys():
-        return {'sample_name':barcode_name, 'project_sample':project_samples[barcode_name]}
-    for project_sample_name in project_samples.keys():
-        # Look for cases where barcode name is formatted in a way that does not conform to convention
-        # NB: only do this interactively!!!
-        if not re.search(re_project_id_nr, barcode_name):
-            if not extensive_matching:
-                return None
-            # Project id could be project number without a P, i.e. XXX_XXX_indexXX
-            sample_id = re.search("(\d+_)?(\d+)_?([A-Z])?_",barcode_name)
-            # Fall back if no hit
-            if not sample_id:
-                LOG.warn("No regular expression match for barcode name {}; implement new case".format(barcode_name))
-                return None
-            (prj_id, smp_id, _) = sample_id.groups()
-            if not prj_id:
-                prj_id=""
-            if str(smp_id) == str(project_sample_name):
-                return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-            elif str("P{}_{}".format(prj_id.rstrip("_"), smp_id)) == str(project_sample_name):
-                return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-
-            # Sometimes barcode name is of format XX_indexXX, where the number is the sample number
-            m = re.search("(_index[0-9]+)", barcode_name)
-            if not m:
-                index = ""
-            else:
-                index = m.group(1)
-                sample_id = re.search("([A-Za-z0-9\_]+)(\_index[0-9]+)?", barcode_name.replace(index, ""))
-                if str(sample_id.group(1)) == str(project_sample_name):
-                    return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-                if str(sample_id.group(1)) == str(project_samples[project_sample_name].get("customer_name", None)):
-                    return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-                # customer well names contain a 0, as in 11A07; run names don't always
-                # FIXME: a function should convert customer name to standard forms in cases like these
-                if str(sample_id.group(1)) == str(project_samples[project_sample_name].get("customer_name", "").replace("0", "")):
-                    return _return_extensive_match_result({'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}, barcode_name, force=force)
-        else:
-            prj_id = barcode_name.split("_")[0]
+    return ProjectSampleMatcher(project_samples).match(barcode_name, extensive_matching=extensive_matching, force=force)
+
+class ProjectSampleMatcher(object):
+    """Match barcode names to project sample names.
+
+    The lookup tables are built once per project so that each barcode
+    name can be matched in (near) constant time. Matching rules are
+    applied in the following order:
+
+    1. exact match of barcode name to project sample name
+    2. barcode names conforming to project id naming convention
+       (PXXX_): longest project sample name, or project sample name
+       with a trailing F, B, C, D or E stripped, that is a prefix of
+       the barcode name, and as a fallback a prefix of the barcode
+       name with the project id removed
+    3. other barcode names, only if extensive matching is requested:
+       sample number, sample number prefixed by project id, barcode
+       name with index removed, and customer names
+
+    :param project_samples: dictionary of project samples as obtained from statusdb project_summary
+    """
+    _strip_suffixes = ["F", "B", "C", "D", "E"]
+    re_sample_id = re.compile("(\d+_)?(\d+)_?([A-Z])?_")
+    re_index = re.compile("(_index[0-9]+)")
+    re_index_sample_id = re.compile("([A-Za-z0-9\_]+)(\_index[0-9]+)?")
+    re_project = re.compile(re_project_id_nr)
+
+    def __init__(self, project_samples):
+        self.project_samples = project_samples or {}
+        names = sorted(self.project_samples.keys())
+        # Prefix table; unmodified names take precedence over names with stripped suffixes
+        self._prefix = {}
+        for name in names:
+            self._prefix.setdefault(name, name)
+        for name in names:
+            for x in self._strip_suffixes:
+                if name.rstrip(x):
+                    self._prefix.setdefault(name.rstrip(x), name)
+        self._max_prefix_len = max([len(k) for k in self._prefix.keys()] + [0])
+        # Equality tables for extensive matching
+        self._customer_name = {}
+        self._customer_name_nozero = {}
+        for name in names:
+            customer_name = self.project_samples[name].get("customer_name", None)
+            if customer_name is None:
+                continue
+            self._customer_name.setdefault(customer_name, name)
+            self._customer_name_nozero.setdefault(customer_name.replace("0", ""), name)
+
+    def _result(self, name):
+        return {'sample_name':name, 'project_sample':self.project_samples[name]}
+
+    def _match_prefix(self, barcode_name):
+        """Return the project sample name with the longest prefix match"""
+        for i in range(min(len(barcode_name), self._max_prefix_len), 0, -1):
+            name = self._prefix.get(barcode_name[:i], None)
+            if name is not None:
+                return name
+        return None
+
+    def match(self, barcode_name, extensive_matching=False, force=False):
+        """Map a barcode name to a project sample.
+
+        :param barcode_name: barcode name as it appears in sample sheet
+        :param extensive_matching: perform extensive matching of barcode to project sample names
+        :param force: override interactive queries
+
+        :returns: dictionary with keys project sample name and project sample or None
+        """
+        if barcode_name in self.project_samples:
+            return self._result(barcode_name)
+        if not self.project_samples:
+            return None
+        if self.re_project.search(barcode_name):
             # Matches project id naming convention PXXX_
             # Look for case barcode: PXXX_XXX[BCDEF]_indexXX, project_sample_name: PXXX_XXX
-            if str(barcode_name).startswith(str(project_sample_name)):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("F")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("B")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("C")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("D")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name).startswith(str(project_sample_name).rstrip("E")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            
-            # Look for cases barcode: PXXX_XX[BCDEF]_indexXX matching to project_sample_name: XX_indexXX
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name)):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("F")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("B")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("C")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("D")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-            elif str(barcode_name.replace("{}_".format(prj_id), "")).startswith(str(project_sample_name).rstrip("E")):
-                return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
-    return None
+            name = self._match_prefix(barcode_name)
+            if name is None:
+                # Look for cases barcode: PXXX_XX[BCDEF]_indexXX matching to project_sample_name: XX_indexXX
+                prj_id = barcode_name.split("_")[0]
+                name = self._match_prefix(barcode_name.replace("{}_".format(prj_id), ""))
+            return self._result(name) if name is not None else None
+
+        # Look for cases where barcode name is formatted in a way that does not conform to convention
+        # NB: only do this interactively!!!
+        if not extensive_matching:
+            return None
+        # Project id could be project number without a P, i.e. XXX_XXX_indexXX
+        sample_id = self.re_sample_id.search(barcode_name)
+        # Fall back if no hit
+        if not sample_id:
+            LOG.warn("No regular expression match for barcode name {}; implement new case".format(barcode_name))
+            return None
+        (prj_id, smp_id, _) = sample_id.groups()
+        if not prj_id:
+            prj_id = ""
+        for name in [str(smp_id), "P{}_{}".format(prj_id.rstrip("_"), smp_id)]:
+            if name in self.project_samples:
+                return _return_extensive_match_result(self._result(name), barcode_name, force=force)
+
+        # Sometimes barcode name is of format XX_indexXX, where the number is the sample number
+        m = self.re_index.search(barcode_name)
+        if not m:
+            return None
+        sample_id = self.re_index_sample_id.search(barcode_name.replace(m.group(1), ""))
+        if not sample_id:
+            return None
+        # customer well names contain a 0, as in 11A07; run names don't always
+        # FIXME: a function should convert customer name to standard forms in cases like these
+        name = sample_id.group(1)
+        if not name in self.project_samples:
+            name = self._customer_name.get(name, self._customer_name_nozero.get(name, None))
+        if name is None:
+            return None
+        return _return_extensive_match_result(self._result(name), barcode_name, force=force)
 
 ##############################
 # Documents
@@ -205,26 +403,51 @@ class SampleRunMetricsDocument(StatusDocument):
             self["project_id"] = m.group(1)
         return 
 
+# Fields that are not part of the document content
+META_FIELDS = ["_id", "_rev", "creation_time", "modification_time", "content_hash"]
+
+def content_hash(obj):
+    """Calculate a digest of the content of a database object. Meta
+    fields are ignored, as are fields whose value is None.
+
+    :param obj: database object
+
+    :returns: hex digest
+    """
+    content = {k:v for k, v in obj.iteritems() if k not in META_FIELDS and v is not None}
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
 # Updating function for object comparison        
-def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
+def update_fn(cls, db, obj, viewname = "names/name_hash", key="name"):
     """Compare object with object in db if present.
 
+    The content hash of obj is stored in the field content_hash and
+    compared to the hash emitted by viewname, so that the database
+    object is only fetched if the content differs. Databases without
+    viewname fall back on the id_to_name view of the same design
+    document and compare with the full database object. Objects
+    saved without a content hash get it written back once.
+
     :param cls: calling class
     :param db: couch database
     :param obj: database object to save
+    :param viewname: view emitting the content hash of objects by key
+    :param key: object field emitted as key by viewname
 
     :returns: database object to save and database id if present
     """
     t_utc = utc_time()
-    def equal(a, b):
-        a_keys = [str(x) for x in a.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
-        b_keys = [str(x) for x in b.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
-        keys = list(set(a_keys + b_keys))
-        return {k:a.get(k, None) for k in keys} == {k:b.get(k, None) for k in keys}
-
-    view = db.view(viewname)
-    d_view = {k.value:k for k in view}
-    dbid =  d_view.get(obj[key], None)
+    obj["content_hash"] = content_hash(obj)
+    try:
+        rows = db.view(viewname, key=obj[key]).rows
+        dbid = rows[0] if rows else None
+        if dbid and dbid.value == obj["content_hash"]:
+            return (None, dbid)
+    except couchdb.ResourceNotFound:
+        fallback = "{}/id_to_name".format(viewname.split("/")[0])
+        LOG.debug("no view {} in database {}; install it with 'pm statusdb sync-views'; using {}".format(viewname, db.name, fallback))
+        d_view = {k.value:k for k in db.view(fallback)}
+        dbid = d_view.get(obj[key], None)
     dbobj = None
 
     if dbid:
@@ -232,14 +455,18 @@ def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
     if dbobj is None:
         obj["creation_time"] = t_utc
         return (obj, dbid)
-    if equal(obj, dbobj):
-        return (None, dbid)
-    else:
-        obj["creation_time"] = dbobj.get("creation_time")
-        obj["modification_time"] = t_utc
-        obj["_rev"] = dbobj.get("_rev")
-        obj["_id"] = dbobj.get("_id")
+    obj["creation_time"] = dbobj.get("creation_time")
+    obj["_rev"] = dbobj.get("_rev")
+    obj["_id"] = dbobj.get("_id")
+    if content_hash(dbobj) == obj["content_hash"]:
+        if dbobj.get("content_hash", None) == obj["content_hash"]:
+            return (None, dbid)
+        # Objects saved before content hashes were introduced; store
+        # the hash so that later comparisons need not fetch them
+        obj["modification_time"] = dbobj.get("modification_time")
         return (obj, dbid)
+    obj["modification_time"] = t_utc
+    return (obj, dbid)
 
 ##############################
 # functions that operate on status_document objects
@@ -263,8 +490,36 @@ def calc_avg_qv(srm):
         return None
 
 
+def _sample_qc_row(s):
+    """Extract the qc values of the qc/project_flowcell view from a
+    sample run metrics document.
+
+    :param s: sample run metrics document
+
+    :returns: list of values ordered as QC_VIEW_FIELDS
+    """
+    picard_metrics = s.get("picard_metrics", {})
+    def num(section, key):
+        v = picard_metrics.get(section, {}).get(key, None)
+        if isinstance(v, basestring):
+            v = v.replace(",", ".")
+            v = float(v) if RE_QC_NUMBER.match(v) else None
+        if isinstance(v, bool) or not isinstance(v, (int, long, float)) or math.isinf(v) or math.isnan(v):
+            return -1
+        return v
+    return [s.get("name", None), s.get("barcode_name", None), s.get("sample_prj", None),
+            s.get("lane", None), s.get("flowcell", None), s.get("date", None),
+            num("AL_PAIR", "TOTAL_READS"), 100 * num("DUP_metrics", "PERCENT_DUPLICATION"),
+            num("INS_metrics", "MEAN_INSERT_SIZE"), num("HS_metrics", "GENOME_SIZE"),
+            num("HS_metrics", "FOLD_ENRICHMENT"), 100 * num("HS_metrics", "PCT_USABLE_BASES_ON_TARGET"),
+            100 * num("HS_metrics", "PCT_TARGET_BASES_10X"), 100 * num("AL_PAIR", "PCT_PF_READS_ALIGNED"),
+            num("HS_metrics", "TARGET_TERRITORY")]
+
 def get_qc_data(sample_prj, p_con, s_con, fc_id=None):
     """Get qc data for a project, possibly subset by flowcell.
+
+    The data is read from the qc/project_flowcell view. If the view
+    has not been installed, the full sample documents are used.
     
     :param sample_prj: project identifier
     :param p_con: object of type <ProjectSummaryConnection>
@@ -274,32 +529,21 @@ def get_qc_data(sample_prj, p_con, s_con, fc_id=None):
     """
     project = p_con.get_entry(sample_prj)
     application = project.get("application", None) if project else None
-    samples = s_con.get_samples(fc_id=fc_id, sample_prj=sample_prj)
+    try:
+        rows = s_con.get_qc_rows(sample_prj=sample_prj, fc_id=fc_id)
+    except couchdb.ResourceNotFound:
+        LOG.warn("No view 'qc/project_flowcell' in samples database; reading full sample documents. Install the statusdb views to speed up qc reports.")
+        rows = [_sample_qc_row(s) for s in s_con.get_samples(fc_id=fc_id, sample_prj=sample_prj)]
     qcdata = {}
-    for s in samples:
-        qcdata[s["name"]]={"sample":s.get("barcode_name", None),
-                           "project":s.get("sample_prj", None),
-                           "lane":s.get("lane", None),
-                           "flowcell":s.get("flowcell", None),
-                           "date":s.get("date", None),
-                           "application":application,
-                           "TOTAL_READS":int(s.get("picard_metrics", {}).get("AL_PAIR", {}).get("TOTAL_READS", -1)),
-                           "PERCENT_DUPLICATION":s.get("picard_metrics", {}).get("DUP_metrics", {}).get("PERCENT_DUPLICATION", "-1.0"),
-                           "MEAN_INSERT_SIZE":float(s.get("picard_metrics", {}).get("INS_metrics", {}).get("MEAN_INSERT_SIZE", "-1.0").replace(",", ".")),
-                           "GENOME_SIZE":int(s.get("picard_metrics", {}).get("HS_metrics", {}).get("GENOME_SIZE", -1)),
-                           "FOLD_ENRICHMENT":float(s.get("picard_metrics", {}).get("HS_metrics", {}).get("FOLD_ENRICHMENT", "-1.0").replace(",", ".")),
-                           "PCT_USABLE_BASES_ON_TARGET":s.get("picard_metrics", {}).get("HS_metrics", {}).get("PCT_USABLE_BASES_ON_TARGET", "-1.0"),
-                           "PCT_TARGET_BASES_10X":s.get("picard_metrics", {}).get("HS_metrics", {}).get("PCT_TARGET_BASES_10X", "-1.0"),
-                           "PCT_PF_READS_ALIGNED":s.get("picard_metrics", {}).get("AL_PAIR", {}).get("PCT_PF_READS_ALIGNED", "-1.0"),
-                           }
-        target_territory = float(s.get("picard_metrics", {}).get("HS_metrics", {}).get("TARGET_TERRITORY", -1))
-        pct_labels = ["PERCENT_DUPLICATION", "PCT_USABLE_BASES_ON_TARGET", "PCT_TARGET_BASES_10X",
-                      "PCT_PF_READS_ALIGNED"]
-        for l in pct_labels:
-            if qcdata[s["name"]][l]:
-                qcdata[s["name"]][l] = float(qcdata[s["name"]][l].replace(",", ".")) * 100
-        if qcdata[s["name"]]["FOLD_ENRICHMENT"] and qcdata[s["name"]]["GENOME_SIZE"] and target_territory:
-            qcdata[s["name"]]["PERCENT_ON_TARGET"] = float(qcdata[s["name"]]["FOLD_ENRICHMENT"]/ (float(qcdata[s["name"]]["GENOME_SIZE"]) / float(target_territory))) * 100
+    for row in rows:
+        d = dict(zip(QC_VIEW_FIELDS, row))
+        target_territory = d.pop("TARGET_TERRITORY")
+        d["application"] = application
+        d["TOTAL_READS"] = int(d["TOTAL_READS"])
+        d["GENOME_SIZE"] = int(d["GENOME_SIZE"])
+        if d["FOLD_ENRICHMENT"] and d["GENOME_SIZE"] and target_territory:
+            d["PERCENT_ON_TARGET"] = float(d["FOLD_ENRICHMENT"]/ (float(d["GENOME_SIZE"]) / float(target_territory))) * 100
+        qcdata[d.pop("name")] = d
     return qcdata
 
 def get_scilife_to_customer_name(project_name, p_con, s_con):
@@ -313,9 +557,10 @@ def get_scilife_to_customer_name(project_name, p_con, s_con):
     :returns: dictionary with keys scilife name and values customer name
     """
     barcode_names = [s.get("barcode_name", None) for s in s_con.get_samples(sample_prj=project_name)]
+    matcher = p_con.get_project_sample_matcher(project_name)
     name_d = {}
     for bcname in barcode_names:
-        s = p_con.get_project_sample(project_name, bcname)
+        s = matcher.match(bcname) if matcher and bcname else None
         name_d[bcname] = {'scilife_name': s['project_sample'].get('scilife_name', bcname),
                           'customer_name' : s['project_sample'].get('customer_name', None)
                           }
@@ -331,6 +576,8 @@ class SampleRunMetricsConnection(Couch):
     def __init__(self, dbname="samples", **kwargs):
         super(SampleRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
+        if isinstance(self.con, LocalServer):
+            sync_views(self.con[dbname], "samples")
         self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
         self.name_fc_view = {k.key:k for k in self.db.view("names/name_fc", reduce=False)}
         self.name_proj_view = {k.key:k for k in self.db.view("names/name_proj", reduce=False)}
@@ -368,6 +615,21 @@ class SampleRunMetricsConnection(Couch):
         self.log.debug("Number of samples: {}, number of fc samples: {}, number of project samples: {}".format(len(sample_ids), len(fc_sample_ids), len(prj_sample_ids)))
         return sample_ids
 
+    def get_qc_rows(self, sample_prj, fc_id=None):
+        """Retrieve qc values from the qc/project_flowcell view
+
+        :param sample_prj: sample project name
+        :param fc_id: flowcell id
+
+        :returns: list of value lists ordered as QC_VIEW_FIELDS
+        """
+        self.log.debug("retrieving qc view rows for sample_prj '{}' and flowcell '{}'".format(sample_prj, fc_id))
+        if fc_id:
+            view = self.db.view("qc/project_flowcell", reduce=False, key=[sample_prj, fc_id])
+        else:
+            view = self.db.view("qc/project_flowcell", reduce=False, startkey=[sample_prj], endkey=[sample_prj, {}])
+        return [row.value for row in view]
+
     def get_samples(self, fc_id=None, sample_prj=None):
         """Retrieve samples subset by fc_id and/or sample_prj
 
@@ -380,6 +642,7 @@ class SampleRunMetricsConnection(Couch):
         sample_ids = self.get_sample_ids(fc_id, sample_prj)
         inv_view = {v:k for k,v in self.name_view.iteritems()}
         sample_names = [inv_view[x] for x in sample_ids]
+        self.prefetch(sample_names)
         return [self.get_entry(x) for x in sample_names]
 
 class FlowcellRunMetricsConnection(Couch):
@@ -388,6 +651,8 @@ class FlowcellRunMetricsConnection(Couch):
     def __init__(self, dbname="flowcells", **kwargs):
         super(FlowcellRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
+        if isinstance(self.con, LocalServer):
+            sync_views(self.con[dbname], "flowcells")
         self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
 
     def set_db(self):
@@ -438,7 +703,10 @@ class ProjectSummaryConnection(Couch):
     def __init__(self, dbname="projects", **kwargs):
         super(ProjectSummaryConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
+        if isinstance(self.con, LocalServer):
+            sync_views(self.con[dbname], "projects")
         self.name_view = {k.key:k.id for k in self.db.view("project/project_name", reduce=False)}
+        self._matchers = {}
 
     def set_db(self, dbname):
         """Make sure we don't change db from projects"""
@@ -455,11 +723,29 @@ class ProjectSummaryConnection(Couch):
         """
         if not barcode_name:
             return None
-        project = self.get_entry(project_name)
+        matcher = self.get_project_sample_matcher(project_name)
+        if not matcher:
+            return None
+        return matcher.match(barcode_name, extensive_matching)
+
+    def get_project_sample_matcher(self, project_name):
+        """Get a barcode name to project sample matcher for a project.
+        Matchers are reused as long as the project document revision
+        is unchanged.
+
+        :param project_name: the project name
+
+        :returns: object of type <ProjectSampleMatcher> or None
+        """
+        # Read prefetched documents directly; the matcher does not modify them
+        project = self._entry_cache.get(project_name, None) or self.get_entry(project_name)
         if not project:
             return None
-        project_samples = project.get('samples', None)
-        return _match_barcode_name_to_project_sample(barcode_name, project_samples, extensive_matching)
+        (rev, matcher) = self._matchers.get(project_name, (None, None))
+        if matcher is None or rev != project.get("_rev", None):
+            matcher = ProjectSampleMatcher(project.get('samples', None))
+            self._matchers[project_name] = (project.get("_rev", None), matcher)
+        return matcher
 
     def _get_sample_run_metrics(self, v):
         if v.get('library_prep', None):
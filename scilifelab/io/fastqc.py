@@ -0,0 +1,84 @@
+"""FastQC data reader.
+
+fastqc_data.txt consists of a number of modules, each a table
+delimited by a module line and an end line:
+
+  >>Per sequence quality scores	pass
+  #Quality	Count
+  2	12.0
+  3	108.0
+  >>END_MODULE
+
+All modules are read in a single pass over the file. As for picard
+metrics, each table column is converted to a typed numpy array on
+demand, so that numeric columns are stored as integers or floats and
+only columns such as base ranges ('10-11') or sequences remain
+strings.
+"""
+import collections
+
+from scilifelab.io.picard import PicardTable
+
+class FastQCModule(PicardTable):
+    """A module of a fastqc_data.txt file. The first line of the
+    module is taken as the header, with leading '#' removed.
+
+    :param name: module name, e.g. 'Per base sequence quality'
+    :param status: module status, e.g. 'pass'
+    """
+    def __init__(self, name, status=None):
+        PicardTable.__init__(self, None, [])
+        self.name = name
+        self.status = status
+
+    def string_columns(self):
+        """Get the columns as lists of strings, as written in the file.
+
+        :returns: dictionary mapping column name to list of strings
+        """
+        return {h:[row[i] if i < len(row) else "" for row in self.rows] for i, h in enumerate(self.header)}
+
+def parse_fastqc_data(in_handle):
+    """Parse a fastqc_data.txt file.
+
+    :param in_handle: file handle
+
+    :returns: ordered dictionary mapping module name to <FastQCModule>
+    """
+    modules = collections.OrderedDict()
+    module = None
+    for line in in_handle:
+        line = line.rstrip("\r\n")
+        if line.startswith(">>"):
+            if line.startswith(">>END"):
+                module = None
+            else:
+                fields = line[2:].split("\t")
+                module = FastQCModule(fields[0], fields[1] if len(fields) > 1 else None)
+                ## Keep the first of duplicated modules
+                if module.name in modules:
+                    module = FastQCModule(module.name)
+                else:
+                    modules[module.name] = module
+            continue
+        if module is None:
+            continue
+        if module.header is None:
+            module.header = [x.strip("#") for x in line.rstrip("\t").split("\t")]
+        else:
+            module.rows.append(line.split("\t"))
+    ## Modules without content, e.g. passed overrepresented sequences
+    for module in modules.values():
+        if module.header is None:
+            module.header = []
+    return modules
+
+def read_fastqc_data(f):
+    """Read a fastqc_data.txt file.
+
+    :param f: file name
+
+    :returns: ordered dictionary mapping module name to <FastQCModule>
+    """
+    with open(f) as fh:
+        return parse_fastqc_data(fh)
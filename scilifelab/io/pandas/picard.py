@@ -1,8 +1,7 @@
 """pm picard lib"""
 import os
-import re
 import pandas as pd
-from scilifelab.io import index_containing_substring
+from scilifelab.io.picard import read_picard_metrics
 import scilifelab.log
 
 LOG = scilifelab.log.minimal_logger(__name__)
@@ -12,33 +11,17 @@ METRICS_TYPES=['align', 'hs', 'dup', 'insert']
 def _raw(x):
     return (x, None)
 
-def _convert_input(x):
-    if re.match("^[0-9]+$", x):
-        return int(x)
-    elif re.match("^[0-9,.]+$", x):
-        return float(x.replace(",", "."))
-    else:
-        return str(x)
+def _to_data_frame(table):
+    if table is None:
+        return None
+    return pd.DataFrame(table.columns, columns=table.header)
 
 def _read_picard_metrics(f):
     if not os.path.exists(f):
         LOG.warn("IO failure: no such file {}".format(f))
         return (None, None)
-    with open(f) as fh:
-        data = fh.readlines()
-        # Find histogram line
-        i_hist = index_containing_substring(data, "## HISTOGRAM")
-        if i_hist == -1:
-            i = len(data)
-        else:
-            i = i_hist
-        tmp = [[_convert_input(y) for y in x.rstrip("\n").split("\t")] for x in data[0:i] if not re.match("^[ #\n]", x)]
-        metrics = pd.DataFrame(tmp[1:], columns=tmp[0])
-        if i_hist == -1:
-            return (metrics, None)
-        tmp = [[_convert_input(y) for y in x.rstrip("\n").split("\t")] for x in data[i_hist:len(data)] if not re.match("^[ #\n]", x)]
-        hist = pd.DataFrame(tmp[1:], columns=tmp[0])
-    return (metrics, hist)
+    data = read_picard_metrics(f)
+    return (_to_data_frame(data.metrics), _to_data_frame(data.hist))
 
 # For now: extension maps to tuple (label, description). Label should
 # be reused for analysis definitions
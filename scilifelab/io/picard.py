@@ -0,0 +1,147 @@
+"""Picard metrics reader.
+
+Picard metrics files consist of a header with the command line, a
+metrics table and, for some metrics types, a histogram table:
+
+  ## net.sf.picard.metrics.StringHeader
+  # net.sf.picard.analysis.CollectInsertSizeMetrics INPUT=...
+  ## METRICS CLASS	net.sf.picard.analysis.InsertSizeMetrics
+  MEDIAN_INSERT_SIZE	MEDIAN_ABSOLUTE_DEVIATION	...
+  180	23	...
+
+  ## HISTOGRAM	java.lang.Integer
+  insert_size	All_Reads.fr_count
+  2	1
+
+Files are tokenised once and each table column is converted to a
+typed numpy array. The column type is inferred per column: integer,
+float (with ',' accepted as decimal separator) or string. Empty and
+'?' cells are missing values, NaN in numeric columns.
+"""
+import re
+import collections
+import numpy as np
+
+## Prefixes of the command line in the file header
+COMMAND_PREFIXES = ["# net.sf.picard.", "# picard."]
+
+re_int = re.compile("^-?[0-9]+$")
+MISSING = ["", "?"]
+
+def _convert_column(values):
+    """Convert a column of strings to a typed array.
+
+    :param values: list of strings
+
+    :returns: numpy array of dtype int64, float64 or object
+    """
+    col = np.array(values, dtype=str)
+    missing = np.in1d(col, MISSING)
+    if missing.all():
+        return np.array([None] * len(values), dtype=object)
+    present = col[~missing]
+    try:
+        if not missing.any() and re_int.match(present[0]):
+            return present.astype(np.int64)
+    except ValueError:
+        pass
+    try:
+        data = np.empty(len(col), dtype=np.float64)
+        data[missing] = np.nan
+        data[~missing] = np.char.replace(present, ",", ".").astype(np.float64)
+        return data
+    except ValueError:
+        return np.array(values, dtype=object)
+
+class PicardTable(object):
+    """A table of a picard metrics file.
+
+    :param header: column names
+    :param rows: list of rows, each a list of strings
+    """
+    def __init__(self, header, rows):
+        self.header = header
+        self.rows = rows
+        self._columns = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def columns(self):
+        """Typed columns, as an ordered dictionary mapping column name
+        to numpy array. Converted on first access."""
+        if self._columns is None:
+            raw = zip(*[row + [""] * (len(self.header) - len(row)) for row in self.rows]) if self.rows else [[] for _ in self.header]
+            self._columns = collections.OrderedDict((h, _convert_column(list(x))) for h, x in zip(self.header, raw))
+        return self._columns
+
+    def row(self, i):
+        """Get a row as a dictionary of strings.
+
+        :param i: row index
+
+        :returns: dictionary mapping column name to value
+        """
+        return dict(zip(self.header, self.rows[i]))
+
+    def to_dict(self):
+        """Get the typed columns as lists, with missing values as None.
+
+        :returns: dictionary mapping column name to list of values
+        """
+        return {h:[None if isinstance(x, float) and np.isnan(x) else x for x in col.tolist()] for h, col in self.columns.iteritems()}
+
+class PicardMetrics(object):
+    """Contents of a picard metrics file.
+
+    :param command: command line, or None
+    :param metrics: <PicardTable> of metrics, or None
+    :param hist: <PicardTable> of histogram, or None
+    """
+    def __init__(self, command=None, metrics=None, hist=None):
+        self.command = command
+        self.metrics = metrics
+        self.hist = hist
+
+def parse_picard_metrics(in_handle):
+    """Parse a picard metrics file.
+
+    :param in_handle: file handle
+
+    :returns: <PicardMetrics> object
+    """
+    res = PicardMetrics()
+    tables = {}
+    section = None
+    for line in in_handle:
+        line = line.rstrip("\r\n")
+        if line.startswith("#"):
+            if line.startswith("## METRICS"):
+                section = "metrics"
+            elif line.startswith("## HISTOGRAM"):
+                section = "hist"
+            elif res.command is None and any(line.startswith(x) for x in COMMAND_PREFIXES):
+                res.command = line
+            continue
+        if not line.strip():
+            section = None
+            continue
+        if section is None:
+            continue
+        tables.setdefault(section, []).append(line.split("\t"))
+    if tables.get("metrics"):
+        res.metrics = PicardTable(tables["metrics"][0], tables["metrics"][1:])
+    if tables.get("hist"):
+        res.hist = PicardTable(tables["hist"][0], tables["hist"][1:])
+    return res
+
+def read_picard_metrics(f):
+    """Read a picard metrics file.
+
+    :param f: file name
+
+    :returns: <PicardMetrics> object
+    """
+    with open(f) as fh:
+        return parse_picard_metrics(fh)
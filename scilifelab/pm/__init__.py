@@ -18,6 +18,9 @@ from scilifelab.pm.core import command
 from scilifelab.pm.core import shell
 from scilifelab.pm.core.controller import PmController
 from scilifelab.pm.core.log import PmLogHandler
+from scilifelab.db.profile import PROFILE
+from scilifelab.utils.manifest import enable_manifest_cache, save_manifests
+from scilifelab.utils.metrics_cache import enable_metrics_cache, save_metrics_caches
 
 LOG = backend.minimal_logger(__name__)    
 
@@ -42,6 +45,24 @@ class PmApp(foundation.CementApp):
         self._setup_cmd_handler()
         ## FIXME: look at backend in cement
         self._output_data = dict(stdout=StringIO(), stderr=StringIO(), debug=StringIO())
+        self.args.add_argument('--profile-db', dest='profile_db', help="profile database requests and print a summary at exit", action="store_true", default=False)
+        if self.config.has_option("config", "manifest_cache") and self.config.get("config", "manifest_cache"):
+            enable_manifest_cache(self.config.get("config", "manifest_cache"))
+        if self.config.has_option("config", "metrics_cache") and self.config.get("config", "metrics_cache"):
+            enable_metrics_cache(self.config.get("config", "metrics_cache"))
+
+    def _parse_args(self):
+        super(PmApp, self)._parse_args()
+        # Enable before the command runs so that all connections are instrumented
+        if self.pargs.profile_db:
+            PROFILE.enable()
+
+    def close(self):
+        save_manifests()
+        save_metrics_caches()
+        if PROFILE.enabled:
+            print >> sys.stderr, PROFILE.summary()
+        super(PmApp, self).close()
 
     def _setup_cmd_handler(self):
         """Setup a command handler"""
@@ -38,6 +38,7 @@ class BcbioRunController(AbstractBaseController):
         group.add_argument('--new_config', help="make new config file", action="store_true", default=False)
         group.add_argument('--hs_file_type', help="File type glob", default="sort-dup")
         group.add_argument('--from_ssheet', help="setup analysis from SampleSheet.csv file", default=False, action="store_true")
+        group.add_argument('--workers', help="number of processes used to read config and metrics files, and threads used to find config files. Defaults to 1.", default=1, action="store", type=int)
 
         group = app.args.add_argument_group('Bcbio variant annotation group', 'Options for bcbio variant annotation')
         group.add_argument('--vcfext', help="vcf extension to search for and merge. Default 'sort-gatkrecal-realign-variants-combined-phased-annotated'", default="sort-gatkrecal-realign-variants-combined-phased-annotated", action="store")
@@ -280,6 +280,9 @@ class PmController(controller.CementBaseController):
 
     [config]
     ignore = slurm*, tmp*
+    ## Cache directory listings between runs
+    manifest_cache = ~/.pm/manifests
+    metrics_cache = ~/.pm/metrics
 
     [archive]
     root = /path/to/archive
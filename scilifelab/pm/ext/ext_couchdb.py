@@ -1,5 +1,105 @@
 """Couchdb extension."""
-from cement.core import hook
+import time
+
+from cement.core import controller, handler, hook
+from scilifelab.pm.core.controller import AbstractBaseController
+from scilifelab.db import Couch, ChangesTracker, CHANGES_STATEFILE
+from scilifelab.db.statusdb import sync_views, update_views, get_view_build_progress
+from scilifelab.utils.dry import dry
+
+class StatusDBController(AbstractBaseController):
+    """
+    This class is an implementation of the :ref:`ICommand
+    <scilifelab.pm.core.command>` interface.
+
+    Functionality for maintaining statusdb design documents.
+    """
+    class Meta:
+        label = 'statusdb'
+        description = "Extension for maintaining statusdb design documents and views"
+        arguments = [
+            (['--wait'], dict(help="Wait until view indexes have been built", default=False, action="store_true")),
+            (['--poll'], dict(help="Poll interval (seconds) when waiting for view indexes. Defaults to 10 seconds.", default=10, action="store", type=int)),
+            (['--db'], dict(help="Database label for changes. Defaults to samples.", default="samples", action="store", choices=["samples", "flowcells", "projects"])),
+            (['--statefile'], dict(help="File in which processed change sequence numbers are stored. Defaults to {}".format(CHANGES_STATEFILE), default=CHANGES_STATEFILE, action="store")),
+            (['--reset'], dict(help="Forget processed changes so that all documents are listed on the next run", default=False, action="store_true")),
+            ]
+
+    def _databases(self):
+        """Map view labels to configured database names"""
+        return {label:self.app.config.get("db", label) for label in ["samples", "flowcells", "projects"]}
+
+    def _connect(self):
+        url = self.pargs.url if self.pargs.url else self.app.config.get("db", "url")
+        if not url:
+            self.app.log.warn("Please provide a valid url: got {}".format(url))
+            return None
+        return Couch(**vars(self.app.pargs))
+
+    @controller.expose(hide=True)
+    def default(self):
+        print self._help_text
+
+    @controller.expose(help="Install or update statusdb design documents and start building their view indexes")
+    def sync_views(self):
+        con = self._connect()
+        if not con:
+            return
+        for label, dbname in self._databases().iteritems():
+            db = con.con[dbname]
+            dry("Syncing design documents for database {}".format(dbname), sync_views, self.pargs.dry_run, db, label)
+            viewnames = dry("Updating view indexes for database {}".format(dbname), update_views, self.pargs.dry_run, db, label)
+            self.app.log.info("Triggered index builds for views {} in database {}".format(viewnames, dbname))
+        if self.pargs.wait and not self.pargs.dry_run:
+            self._wait_for_views(con)
+
+    @controller.expose(help="Query statusdb views so that their indexes are up to date, e.g. after bulk uploads")
+    def warm_views(self):
+        con = self._connect()
+        if not con:
+            return
+        for label, dbname in self._databases().iteritems():
+            update_views(con.con[dbname], label, wait=self.pargs.wait)
+            self.app.log.info("Updated view indexes for database {}".format(dbname))
+
+    @controller.expose(help="Report progress of running statusdb view index builds")
+    def view_status(self):
+        con = self._connect()
+        if not con:
+            return
+        self._write_progress(get_view_build_progress(con.con, self._databases().values()))
+
+    @controller.expose(help="List documents that have changed since the previous run and record the processed changes")
+    def changes(self):
+        con = self._connect()
+        if not con:
+            return
+        dbname = self._databases()[self.pargs.db]
+        tracker = ChangesTracker(con.con[dbname], statefile=self.pargs.statefile)
+        if self.pargs.reset:
+            dry("Resetting processed changes for database {}".format(dbname), tracker.reset, self.pargs.dry_run)
+            return
+        for row in tracker.changes(include_docs=True):
+            doc = row.get("doc", {}) or {}
+            name = doc.get("name", doc.get("project_name", ""))
+            self.app._output_data['stdout'].write("{}\t{}\t{}\n".format(row["id"], name, "deleted" if row.get("deleted", False) else "updated"))
+        dry("Recording processed changes up to sequence {} for database {}".format(tracker.seq, dbname), tracker.commit, self.pargs.dry_run)
+
+    def _write_progress(self, progress):
+        if not progress:
+            self.app._output_data['stdout'].write("No view index builds running\n")
+            return
+        self.app._output_data['stdout'].write("\n".join(["\t".join([str(r) for r in row]) for row in progress]) + "\n")
+
+    def _wait_for_views(self, con):
+        while True:
+            progress = get_view_build_progress(con.con, self._databases().values())
+            if not progress:
+                self.app.log.info("All view indexes are up to date")
+                return
+            for row in progress:
+                self.app.log.info("Building view index {} in database {}: {}".format(row[1], row[0], row[2]))
+            time.sleep(self.pargs.poll)
 
 def add_shared_couchdb_options(app):
     """
@@ -18,11 +118,12 @@ def add_shared_couchdb_options(app):
     if app.config.has_option("db", "url"):
         url = app.config.get("db", "url") 
     group = app.args.add_argument_group('couchdb', 'Options for couchdb connections')
-    group.add_argument('--url', help="Database url (excluding http://). Default '{}'".format(url), default=url, nargs="?", type=str)
+    group.add_argument('--url', help="Database url (excluding http://), or sqlite:///path/to/directory for a local database. Default '{}'".format(url), default=url, nargs="?", type=str)
     group.add_argument('--port', help="Database port. Default 5984", nargs="?", default="5984", type=str)
     group.add_argument('--username', help="Database user. Default '{}'".format(user), nargs="?", default=user, type=str)
     group.add_argument('--password', help="Database password.", default=password, type=str)
 
 def load():
     """Called by the framework when the extension is 'loaded'."""
+    handler.register(StatusDBController)
     hook.register('post_setup', add_shared_couchdb_options)
@@ -3,21 +3,117 @@ import os
 import csv
 import yaml
 import ast
+import glob
 import itertools
-from collections import defaultdict
+import traceback
+import multiprocessing
+from multiprocessing.util import Finalize
+from itertools import izip
 
 from cement.core import backend, controller, handler, hook
 from scilifelab.utils.misc import query_yes_no
 from scilifelab.pm.core.controller import AbstractBaseController
 from scilifelab.utils.timestamp import modified_within_days
-from scilifelab.bcbio.qc import FlowcellRunMetricsParser, SampleRunMetricsParser
+from scilifelab.bcbio.qc import FlowcellRunMetricsParser, SampleRunMetricsParser, DemultiplexStats
 from scilifelab.pm.bcbio.utils import validate_fc_directory_format, fc_id, fc_parts, fc_fullname
-from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection, SampleRunMetricsDocument, FlowcellRunMetricsDocument
+from scilifelab.report.qc import multiplex_qc
+from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection, SampleRunMetricsDocument, FlowcellRunMetricsDocument, update_views
 from scilifelab.utils.dry import dry
+from scilifelab.utils.journal import Journal
+from scilifelab.utils.manifest import get_input_manifest, save_manifests
+from scilifelab.utils.metrics_cache import save_metrics_caches
 import scilifelab.log
 
 LOG = scilifelab.log.minimal_logger(__name__)
 
+## Demultiplex statistics of the flowcell whose samples are collected,
+## set once per process by _set_demultiplex_stats
+_demultiplex_stats = None
+
+def _set_demultiplex_stats(demultiplex_stats):
+    """Set the demultiplex statistics used by _collect_sample_metrics.
+    Used as initializer of worker processes, so that the statistics are
+    passed to each worker once instead of with every sample.
+
+    :param demultiplex_stats: <DemultiplexStats> object or None
+    """
+    global _demultiplex_stats
+    _demultiplex_stats = demultiplex_stats
+
+def _init_sample_worker(demultiplex_stats):
+    """Initialize a worker process collecting sample metrics. Worker
+    processes do not run the application close hooks, so the metrics
+    caches of a worker are saved once, when it exits at pool teardown.
+
+    :param demultiplex_stats: <DemultiplexStats> object or None
+    """
+    _set_demultiplex_stats(demultiplex_stats)
+    Finalize(None, save_metrics_caches, exitpriority=10)
+
+def _sample_key(sample_kw):
+    """Get the input manifest key of a sample run"""
+    return "_".join(str(sample_kw.get(k, None)) for k in ["lane", "barcode_id", "barcode_name"])
+
+def _manifest_key(obj):
+    """Get the input manifest key of a qc object"""
+    if isinstance(obj, FlowcellRunMetricsDocument):
+        return "flowcell"
+    return _sample_key(obj)
+
+def _collect_sample_metrics(args, catch=True):
+    """Parse the metrics files of a sample. Module level so that it can
+    be run in worker processes.
+
+    :param args: tuple of (sample flowcell directory, sample keyword arguments)
+    :param catch: return errors instead of raising them, so that a failing sample does not stop the other workers
+
+    :returns: tuple of (metrics dictionary, error); metrics is None and error a traceback if parsing failed
+    """
+    (path, sample_kw) = args
+    try:
+        parser = SampleRunMetricsParser(path)
+        metrics = {"picard_metrics" : parser.read_picard_metrics(**sample_kw),
+                   "fastq_scr" : parser.parse_fastq_screen(**sample_kw),
+                   "bc_count" : parser.get_bc_count(demultiplex_stats=_demultiplex_stats, **sample_kw),
+                   "fastqc" : parser.read_fastqc_metrics(**sample_kw)}
+        return (metrics, None)
+    except Exception:
+        if not catch:
+            raise
+        return (None, traceback.format_exc())
+
+## Controller whose flowcells are collected, set once per process by
+## _set_controller
+_controller = None
+
+def _set_controller(controller):
+    """Set the controller used by _collect_flowcell_qc. Used as
+    initializer of worker processes, which are forked and so inherit
+    the controller without pickling it.
+
+    :param controller: <RunMetricsController> object or None
+    """
+    global _controller
+    _controller = controller
+
+def _collect_flowcell_qc(flowcell):
+    """Collect the qc objects of a flowcell. Module level so that it
+    can be run in worker processes.
+
+    :param flowcell: flowcell directory
+
+    :returns: tuple of (flowcell, qc objects, input manifest, error); qc objects is None and error a traceback if collecting failed
+    """
+    try:
+        (qc_objects, manifest) = _controller._collect_qc(flowcell)
+        return (flowcell, qc_objects, manifest, None)
+    except Exception:
+        return (flowcell, None, None, traceback.format_exc())
+    finally:
+        ## Worker processes do not run the application close hooks
+        save_manifests()
+        save_metrics_caches()
+
 class RunMetricsController(AbstractBaseController):
     """
     This class is an implementation of the :ref:`ICommand
@@ -39,6 +135,9 @@ class RunMetricsController(AbstractBaseController):
             (['--names'], dict(help="Sample name mapping from barcode name to project name as a JSON string, as in \"{'sample_run_name':'project_run_name'}\". Mapping can also be given in a file", default=None, action="store", type=str)),
             (['--extensive_matching'], dict(help="Perform extensive barcode to project sample name matcing", default=False, action="store_true")),
             (['--project_alias'], dict(help="True project name as defined in project summary, as in 'J.Doe_00_01'.", default=None, action="store", type=str)),
+            (['--workers'], dict(help="Number of processes used to parse sample metrics files. Defaults to 1.", default=1, action="store", type=int)),
+            (['--flowcells'], dict(help="Additional flowcell directories for multiplex_qc and upload_qc. Glob patterns are matched relative to the runqc root", default=None, nargs="+")),
+            (['--journal'], dict(help="Journal file of flowcells uploaded by upload_qc. Flowcells in the journal are skipped, so that an interrupted upload can be resumed", default=None, action="store", type=str)),
             ]
 
 
@@ -97,8 +196,9 @@ class RunMetricsController(AbstractBaseController):
             project_name = self.pargs.sample_prj
             if self.pargs.project_alias:
                 project_name = self.pargs.project_alias
+            matcher = p_con.get_project_sample_matcher(project_name)
             for s in samples:
-                project_sample = p_con.get_project_sample(project_name, s["barcode_name"], extensive_matching=True)
+                project_sample = matcher.match(s["barcode_name"], extensive_matching=True) if matcher and s["barcode_name"] else None
                 if project_sample:
                     self.app.log.info("using mapping '{} : {}'...".format(s["barcode_name"], project_sample["sample_name"]))
                     s["project_sample_name"] = project_sample["sample_name"]
@@ -107,8 +207,37 @@ class RunMetricsController(AbstractBaseController):
     ##############################
     ## New structures
     ##############################
-    def _parse_samplesheet(self, runinfo, qc_objects, fc_date, fc_name, fcdir, as_yaml=False, demultiplex_stats=None):
-        """Parse samplesheet information and populate sample run metrics object"""
+    def _get_flowcells(self):
+        """Get the flowcell argument and the flowcells given with
+        --flowcells, with glob patterns expanded.
+
+        :returns: list of flowcell directories
+        """
+        flowcells = [self.pargs.flowcell] if self.pargs.flowcell else []
+        for flowcell in self.pargs.flowcells or []:
+            if glob.has_magic(flowcell):
+                matches = sorted(glob.glob(os.path.join(self._meta.root_path, flowcell)))
+                if not matches:
+                    self.app.log.warn("No flowcell directories match {}".format(flowcell))
+                flowcells.extend(matches)
+            else:
+                flowcells.append(flowcell)
+        return flowcells
+
+    def _parse_samplesheet(self, runinfo, qc_objects, fc_date, fc_name, fcdir, flowcell, as_yaml=False, demultiplex_stats=None, manifest=None, inputs=None):
+        """Parse samplesheet information and populate sample run metrics object.
+
+        If an input manifest is passed, only samples whose input files
+        have changed are parsed, instead of samples whose directories
+        have been modified within --mtime days.
+
+        :param manifest: <InputManifest> object or None
+        :param inputs: input files shared by all samples
+        """
+        samples = []
+        config_files = []
+        if demultiplex_stats and not isinstance(demultiplex_stats, DemultiplexStats):
+            demultiplex_stats = DemultiplexStats(demultiplex_stats)
         if as_yaml:
             for info in runinfo:
                 if not info.get("multiplex", None):
@@ -121,14 +250,8 @@ class RunMetricsController(AbstractBaseController):
                     sample.update({k: info.get(k, None) for k in ('analysis', 'description', 'flowcell_id', 'lane')})
                     sample_kw = dict(flowcell=fc_name, date=fc_date, lane=sample['lane'], barcode_name=sample['name'], sample_prj=sample.get('sample_prj', None),
                                      barcode_id=sample['barcode_id'], sequence=sample.get('sequence', "NoIndex"))
-                
-                    parser = SampleRunMetricsParser(fcdir)
-                    obj = SampleRunMetricsDocument(**sample_kw)
-                    obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
-                    obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
-                    obj["bc_count"] = parser.get_bc_count(**sample_kw)
-                    obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
-                    qc_objects.append(obj)
+                    samples.append((fcdir, sample_kw))
+                    config_files.append(None)
         else:
             for sample in runinfo[1:]:
                 LOG.debug("Getting information for sample defined by {}".format(sample))
@@ -142,11 +265,11 @@ class RunMetricsController(AbstractBaseController):
                 if not os.path.exists(sampledir):
                     self.app.log.warn("No such sample directory: {}".format(sampledir))
                     continue
-                sample_fcdir = os.path.join(sampledir, fc_fullname(self.pargs.flowcell))
+                sample_fcdir = os.path.join(sampledir, fc_fullname(flowcell))
                 if not os.path.exists(sample_fcdir):
                     self.app.log.warn("No such sample flowcell directory: {}".format(sample_fcdir))
                     continue
-                if not modified_within_days(sample_fcdir, self.pargs.mtime):
+                if manifest is None and not modified_within_days(sample_fcdir, self.pargs.mtime):
                     continue
                 runinfo_yaml_file = os.path.join(sample_fcdir, "{}-bcbb-config.yaml".format(d['SampleID']))
                 if not os.path.exists(runinfo_yaml_file):
@@ -158,23 +281,65 @@ class RunMetricsController(AbstractBaseController):
                     self.app.log.warn("No multiplex information for sample {}".format(d['SampleID']))
                     continue
                 sample_kw = dict(flowcell=fc_name, date=fc_date, lane=d['Lane'], barcode_name=d['SampleID'], sample_prj=d['SampleProject'].replace("__", "."), barcode_id=runinfo_yaml['details'][0]['multiplex'][0]['barcode_id'], sequence=runinfo_yaml['details'][0]['multiplex'][0]['sequence'])
-                parser = SampleRunMetricsParser(sample_fcdir)
-                obj = SampleRunMetricsDocument(**sample_kw)
-                obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
-                obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
-                obj["bc_count"] = parser.get_bc_count(demultiplex_stats=demultiplex_stats, **sample_kw)
-                obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
-                qc_objects.append(obj)
+                samples.append((sample_fcdir, sample_kw))
+                config_files.append(runinfo_yaml_file)
+        sample_inputs = {}
+        if manifest is not None:
+            parsers = {}
+            for (path, sample_kw), config_file in izip(samples, config_files):
+                parser = parsers.setdefault(path, SampleRunMetricsParser(path))
+                files = parser.sample_input_files(**sample_kw) + (inputs or []) + ([config_file] if config_file else [])
+                if manifest.changed(_sample_key(sample_kw), files):
+                    sample_inputs[_sample_key(sample_kw)] = files
+            self.log.info("Input files changed for {} of {} samples".format(len(sample_inputs), len(samples)))
+            samples = [(path, sample_kw) for path, sample_kw in samples if _sample_key(sample_kw) in sample_inputs]
+        for (path, sample_kw), (metrics, error) in izip(samples, self._map_samples(_collect_sample_metrics, samples, demultiplex_stats)):
+            if error:
+                self.app.log.warn("Failed to collect metrics for sample {} in {}; skipping:\n{}".format(sample_kw['barcode_name'], path, error))
+                continue
+            if manifest is not None:
+                manifest.record(_sample_key(sample_kw), sample_inputs[_sample_key(sample_kw)])
+            obj = SampleRunMetricsDocument(**sample_kw)
+            for k in ["picard_metrics", "fastq_scr", "bc_count", "fastqc"]:
+                obj[k] = metrics[k]
+            qc_objects.append(obj)
         return qc_objects
 
-    def _collect_pre_casava_qc(self):
+    def _map_samples(self, fn, samples, demultiplex_stats=None):
+        """Apply fn to samples, in parallel if more than one worker is
+        requested. Errors are only caught in worker processes; run
+        serially, a failing sample stops the collection.
+
+        :param fn: function to apply, taking a catch keyword argument
+        :param samples: list of arguments to fn
+        :param demultiplex_stats: <DemultiplexStats> object shared by all samples
+
+        :returns: list of results, in the order of samples
+        """
+        workers = min(self.pargs.workers, len(samples))
+        ## Worker processes collecting flowcells cannot start pools of their own
+        if workers <= 1 or multiprocessing.current_process().daemon:
+            _set_demultiplex_stats(demultiplex_stats)
+            try:
+                return [fn(x, catch=False) for x in samples]
+            finally:
+                _set_demultiplex_stats(None)
+        self.app.log.info("Collecting metrics for {} samples with {} worker processes".format(len(samples), workers))
+        pool = multiprocessing.Pool(workers, _init_sample_worker, (demultiplex_stats,))
+        try:
+            return pool.map(fn, samples, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _collect_pre_casava_qc(self, flowcell, manifest=None):
         qc_objects = []
         as_yaml = False
-        runinfo_csv = os.path.join(os.path.join(self._meta.root_path, self.pargs.flowcell), "{}.csv".format(fc_id(self.pargs.flowcell)))
+        runinfo_csv = os.path.join(os.path.join(self._meta.root_path, flowcell), "{}.csv".format(fc_id(flowcell)))
         if not os.path.exists(runinfo_csv):
             LOG.warn("No such file {}: trying fallback SampleSheet.csv".format(runinfo_csv))
-            runinfo_csv = os.path.join(os.path.join(self._meta.root_path, self.pargs.flowcell), "SampleSheet.csv")
-        runinfo_yaml = os.path.join(os.path.abspath(self.pargs.flowcell), "run_info.yaml")
+            runinfo_csv = os.path.join(os.path.join(self._meta.root_path, flowcell), "SampleSheet.csv")
+        runinfo_yaml = os.path.join(os.path.abspath(flowcell), "run_info.yaml")
         try:
             if os.path.exists(runinfo_csv):
                 with open(runinfo_csv) as fh:
@@ -187,12 +352,19 @@ class RunMetricsController(AbstractBaseController):
         except IOError as e:
             self.app.log.warn(str(e))
             raise e
-        fcdir = os.path.abspath(self.pargs.flowcell)
-        (fc_date, fc_name) = fc_parts(self.pargs.flowcell)
-        ## Check modification time
-        if modified_within_days(fcdir, self.pargs.mtime):
-            fc_kw = dict(fc_date = fc_date, fc_name=fc_name)
+        fcdir = os.path.abspath(flowcell)
+        (fc_date, fc_name) = fc_parts(flowcell)
+        ## Check input files, or modification time
+        parser = None
+        if manifest is not None:
             parser = FlowcellRunMetricsParser(fcdir)
+            inputs = parser.input_file_candidates(fc_name, runinfo_csv=runinfo_csv, run_info_yaml="run_info.yaml", casava=False)
+        if manifest is not None and not manifest.changed("flowcell", inputs):
+            self.log.info("Input files unchanged for flowcell {}".format(fc_id(flowcell)))
+        elif manifest is not None or modified_within_days(fcdir, self.pargs.mtime):
+            fc_kw = dict(fc_date = fc_date, fc_name=fc_name)
+            if parser is None:
+                parser = FlowcellRunMetricsParser(fcdir)
             fcobj = FlowcellRunMetricsDocument(**fc_kw)
             fcobj["RunInfo"] = parser.parseRunInfo(**fc_kw)
             fcobj["RunParameters"] = parser.parseRunParameters(**fc_kw)
@@ -202,17 +374,19 @@ class RunMetricsController(AbstractBaseController):
             fcobj["samplesheet_csv"] = parser.parse_samplesheet_csv(runinfo_csv=runinfo_csv, **fc_kw)
             fcobj["run_info_yaml"] = parser.parse_run_info_yaml(**fc_kw)
             qc_objects.append(fcobj)
+            if manifest is not None:
+                manifest.record("flowcell", inputs)
         else:
             return qc_objects
-        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, fc_name, fcdir, as_yaml=as_yaml)
+        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, fc_name, fcdir, flowcell, as_yaml=as_yaml, manifest=manifest)
         return qc_objects
 
-    def _collect_casava_qc(self):
+    def _collect_casava_qc(self, flowcell, manifest=None):
         qc_objects = []
-        runinfo_csv = os.path.join(os.path.join(self._meta.root_path, self.pargs.flowcell), "{}.csv".format(fc_id(self.pargs.flowcell)))
+        runinfo_csv = os.path.join(os.path.join(self._meta.root_path, flowcell), "{}.csv".format(fc_id(flowcell)))
         if not os.path.exists(runinfo_csv):
             LOG.warn("No such file {}: trying fallback SampleSheet.csv".format(runinfo_csv))
-            runinfo_csv = os.path.join(os.path.join(self._meta.root_path, self.pargs.flowcell), "SampleSheet.csv")
+            runinfo_csv = os.path.join(os.path.join(self._meta.root_path, flowcell), "SampleSheet.csv")
         try:
             with open(runinfo_csv) as fh:
                 runinfo_reader = csv.reader(fh)
@@ -220,13 +394,18 @@ class RunMetricsController(AbstractBaseController):
         except IOError as e:
             self.app.log.warn(str(e))
             raise e
-        fcdir = os.path.join(os.path.abspath(self._meta.root_path), self.pargs.flowcell)
-        (fc_date, fc_name) = fc_parts(self.pargs.flowcell)
-        ## Check modification time
+        fcdir = os.path.join(os.path.abspath(self._meta.root_path), flowcell)
+        (fc_date, fc_name) = fc_parts(flowcell)
+        ## Check input files, or modification time
         demux_stats = None
-        if modified_within_days(fcdir, self.pargs.mtime):
-            fc_kw = dict(fc_date = fc_date, fc_name=fc_name)
-            parser = FlowcellRunMetricsParser(fcdir)
+        fc_kw = dict(fc_date = fc_date, fc_name=fc_name)
+        parser = FlowcellRunMetricsParser(fcdir)
+        if manifest is not None:
+            inputs = parser.input_file_candidates(fc_name, runinfo_csv=runinfo_csv)
+        if manifest is not None and not manifest.changed("flowcell", inputs):
+            self.log.info("Input files unchanged for flowcell {}".format(fc_id(flowcell)))
+            demux_stats = parser.parse_demultiplex_stats_htm(**fc_kw)
+        elif manifest is not None or modified_within_days(fcdir, self.pargs.mtime):
             fcobj = FlowcellRunMetricsDocument(fc_date, fc_name)
             fcobj["RunInfo"] = parser.parseRunInfo(**fc_kw)
             fcobj["RunParameters"] = parser.parseRunParameters(**fc_kw)
@@ -237,268 +416,173 @@ class RunMetricsController(AbstractBaseController):
             fcobj["samplesheet_csv"] = parser.parse_samplesheet_csv(runinfo_csv=runinfo_csv, **fc_kw)
             demux_stats = fcobj["illumina"]["Demultiplex_Stats"]
             qc_objects.append(fcobj)
-        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, fc_name, fcdir, demultiplex_stats=demux_stats)
+            if manifest is not None:
+                manifest.record("flowcell", inputs)
+        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, fc_name, fcdir, flowcell, demultiplex_stats=demux_stats,
+                                             manifest=manifest, inputs=parser.demultiplex_stats_files(fc_name))
         return qc_objects
 
-    @controller.expose(help="Upload run metrics to statusdb")
-    def upload_qc(self):
-        if not self._check_pargs(['flowcell']):
-            return
-        url = self.pargs.url if self.pargs.url else self.app.config.get("db", "url")
-        if not url:
-            self.app.log.warn("Please provide a valid url: got {}".format(url))
-            return
-        if not validate_fc_directory_format(self.pargs.flowcell):
-            self.app.log.warn("Path '{}' does not conform to bcbio flowcell directory format; aborting".format(self.pargs.flowcell))
-            return
-            
-        runinfo_csv = os.path.join(os.path.abspath(self.pargs.flowcell), "{}.csv".format(fc_id(self.pargs.flowcell)))
-        runinfo_yaml = os.path.join(os.path.abspath(self.pargs.flowcell), "run_info.yaml")
-        (fc_date, fc_name) = fc_parts(self.pargs.flowcell)
+    def _collect_qc(self, flowcell):
+        """Collect the qc objects of a flowcell.
+
+        :param flowcell: flowcell directory
+
+        :returns: tuple of (list of flowcell and sample run metrics objects, <InputManifest> object or None)
+        """
+        (fc_date, fc_name) = fc_parts(flowcell)
+        ## Input manifests are used instead of modification times if manifest caching is enabled
+        manifest = get_input_manifest(fc_fullname(flowcell))
         if int(fc_date) < 120815:
-            self.log.info("Assuming pre-casava based file structure for {}".format(fc_id(self.pargs.flowcell)))
-            qc_objects = self._collect_pre_casava_qc()
+            self.log.info("Assuming pre-casava based file structure for {}".format(fc_id(flowcell)))
+            return (self._collect_pre_casava_qc(flowcell, manifest), manifest)
         else:
-            self.log.info("Assuming casava based file structure for {}".format(fc_id(self.pargs.flowcell)))
-            qc_objects = self._collect_casava_qc()
+            self.log.info("Assuming casava based file structure for {}".format(fc_id(flowcell)))
+            return (self._collect_casava_qc(flowcell, manifest), manifest)
+
+    def _map_flowcells(self, flowcells):
+        """Collect the qc objects of flowcells, in parallel if more than
+        one worker is requested. Samples are then collected serially
+        within each worker.
 
-        if len(qc_objects) == 0:
-            self.log.info("No out-of-date qc objects for {}".format(fc_id(self.pargs.flowcell)))
+        :param flowcells: list of flowcell directories
+
+        :returns: generator of (flowcell, qc objects, input manifest, error) tuples, in the order of completion
+        """
+        workers = min(self.pargs.workers, len(flowcells))
+        if workers <= 1:
+            _set_controller(self)
+            try:
+                for flowcell in flowcells:
+                    yield _collect_flowcell_qc(flowcell)
+            finally:
+                _set_controller(None)
             return
-        else:
-            self.log.info("Retrieved {} updated qc objects".format(len(qc_objects)))
+        self.app.log.info("Collecting qc objects for {} flowcells with {} worker processes".format(len(flowcells), workers))
+        pool = multiprocessing.Pool(workers, _set_controller, (self,))
+        try:
+            for res in pool.imap_unordered(_collect_flowcell_qc, flowcells):
+                yield res
+            pool.close()
+        finally:
+            ## Stop outstanding work if interrupted
+            pool.terminate()
+            pool.join()
 
-        s_con = SampleRunMetricsConnection(dbname=self.app.config.get("db", "samples"), **vars(self.app.pargs))
-        fc_con = FlowcellRunMetricsConnection(dbname=self.app.config.get("db", "flowcells"), **vars(self.app.pargs))
-        p_con = ProjectSummaryConnection(dbname=self.app.config.get("db", "projects"), **vars(self.app.pargs))
+    def _save_qc_objects(self, qc_objects, s_con, fc_con, p_con):
+        """Save qc objects, with one bulk request per database.
+
+        :param qc_objects: list of flowcell and sample run metrics objects
+        :param s_con: <SampleRunMetricsConnection> object
+        :param fc_con: <FlowcellRunMetricsConnection> object
+        :param p_con: <ProjectSummaryConnection> object
+
+        :returns: list of objects that were saved or already up to date, or None in dry runs
+        """
+        p_con.prefetch([obj.get("sample_prj", None) for obj in qc_objects if isinstance(obj, SampleRunMetricsDocument)])
         for obj in qc_objects:
             if self.app.pargs.debug:
                 self.log.debug("{}: {}".format(str(obj), obj["_id"]))
-            if isinstance(obj, FlowcellRunMetricsDocument):
-                dry("Saving object {}".format(repr(obj)), fc_con.save(obj))
             if isinstance(obj, SampleRunMetricsDocument):
                 project_sample = p_con.get_project_sample(obj.get("sample_prj", None), obj.get("barcode_name", None), self.pargs.extensive_matching)
                 if project_sample:
                     obj["project_sample_name"] = project_sample['sample_name']
-                dry("Saving object {}".format(repr(obj)), s_con.save(obj))
+        fc_objects = [obj for obj in qc_objects if isinstance(obj, FlowcellRunMetricsDocument)]
+        s_objects = [obj for obj in qc_objects if isinstance(obj, SampleRunMetricsDocument)]
+        stored = []
+        for con, objects in [(fc_con, fc_objects), (s_con, s_objects)]:
+            saved = dry("Saving objects {}".format(", ".join(repr(obj) for obj in objects)), con.save_many, self.pargs.dry_run, objects, unchanged=stored)
+            if not self.pargs.dry_run:
+                stored.extend(saved)
+        return None if self.pargs.dry_run else stored
 
-    @controller.expose(help="Perform a multiplex QC")
-    def multiplex_qc(self):
-        
-        MAX_UNDEMULTIPLEXED_INDEX_COUNT = 1000000
-        EXPECTED_LANE_YIELD = 143000000
-        MAX_PHIX_ERROR_RATE = 2.0
-        MIN_PHIX_ERROR_RATE = 0.0
-        read_pairs = True
-        
-        out_data = []
-        
-        if not self._check_pargs(['flowcell']):
+    @controller.expose(help="Upload run metrics to statusdb. Several flowcells can be uploaded with --flowcells, collected in parallel by --workers processes; use --journal to be able to resume an interrupted upload.")
+    def upload_qc(self):
+        flowcells = self._get_flowcells()
+        if not flowcells:
+            self.app.log.warn("Required argument 'flowcell' lacking")
             return
         url = self.pargs.url if self.pargs.url else self.app.config.get("db", "url")
         if not url:
             self.app.log.warn("Please provide a valid url: got {}".format(url))
             return
-        
-        # Construct the short form of the fcid
-        sp = os.path.basename(self.pargs.flowcell).split("_")
-        fcid = "_".join([sp[0],sp[-1]])
-        
-        # Get a connection to the flowcell database and fetch the corresponding document
-        self.log.debug("Connecting to flowcell database".format(fcid))
+        for flowcell in flowcells:
+            if not validate_fc_directory_format(flowcell):
+                self.app.log.warn("Path '{}' does not conform to bcbio flowcell directory format; aborting".format(flowcell))
+                return
+        ## In batch mode, failing flowcells are skipped instead of aborting the upload
+        batch = len(flowcells) > 1 or self.pargs.journal
+        journal = Journal(self.pargs.journal) if self.pargs.journal else None
+        if journal is not None:
+            done = [x for x in flowcells if fc_fullname(x) in journal]
+            if done:
+                self.log.info("Skipping {} flowcells recorded in journal {}".format(len(done), journal.filename))
+            flowcells = [x for x in flowcells if fc_fullname(x) not in journal]
+            if not flowcells:
+                return
+
+        s_con = SampleRunMetricsConnection(dbname=self.app.config.get("db", "samples"), **vars(self.app.pargs))
         fc_con = FlowcellRunMetricsConnection(dbname=self.app.config.get("db", "flowcells"), **vars(self.app.pargs))
-        self.log.debug("Fetching run metrics entry for flowcell {}".format(fcid))
-        fc_doc = fc_con.get_entry(fcid)
-        if not fc_doc:
-            self.log.warn("Could not fetch run metrics entry for flowcell {}".format(fcid))
-            return
-   
-        # Get the yield per sample from the Demultiplex_Stats
-        self.log.debug("Getting yield for flowcell {}".format(fcid))
-        sample_yield = self._get_yield_per_sample(fc_doc, read_pairs)
-        
-        # Get the yield per lane from the Demultiplex_Stats
-        self.log.debug("Getting lane yield for flowcell {}".format(fcid))
-        lane_yield = self._get_yield_per_lane(fc_doc, read_pairs)
-        lanes = lane_yield.keys()
-        
-        # Get the number of samples in the pools from the Demultiplex_Stats
-        self.log.debug("Getting lane pool sizes for flowcell {}".format(fcid))
-        pool_size = self._get_pool_size(fc_doc)
-        
-        # Get the sample information from the csv samplesheet
-        self.log.debug("Getting csv samplesheet data for flowcell {}".format(fcid))
-        ssheet_samples = self._get_samplesheet_sample_data(fc_doc)
-        if len(ssheet_samples) == 0: 
-            self.log.warn("No samplesheet data available for flowcell {}".format(fcid))
-        
-        # Verify that all samples in samplesheet have reported metrics
-        for id in ssheet_samples.keys():
-            for key in ssheet_samples[id].keys():
-                lane, index = key.split("_")
-                project = ssheet_samples[id][key][0]
-                if id not in sample_yield or \
-                key not in sample_yield[id]: 
-                    self.log.warn("Sample {} from project {} is in samplesheet but no yield was reported in " \
-                                  "Demultiplex_Stats.htm for lane {} and index {}".format(id,
-                                                                                          project,
-                                                                                          lane,
-                                                                                          index))
-                    continue
-                sample_yield[id][key].append('verified')
-        
-        # Check that all samples in Demultiplex_Stats have entries in Samplesheet
-        for id in sample_yield.keys():
-            for key in sample_yield[id].keys():
-                lane, index = key.split("_")
-                if "verified" not in sample_yield[id][key] and \
-                index != "Undetermined":
-                    self.log.warn("Sample {} from project {}, with index {} on lane {} is in Demultiplex_Stats " \
-                                  "but no corresponding entry is present in SampleSheet".format(id,
-                                                                                                sample_yield[id][key][1],
-                                                                                                index,
-                                                                                                lane))
-                        
-        # Check the PhiX error rate for each lane
-        self.log.debug("Getting PhiX error rates for flowcell {}".format(fcid))
-        for lane in lanes:
-            status = "N/A"
-            err_rate = fc_con.get_phix_error_rate(fcid,lane)
-            if err_rate < 0:
-                self.log.warn("Could not get PhiX error rate for lane {} on flowcell {}".format(lane,fcid))
-            elif err_rate <= MIN_PHIX_ERROR_RATE or err_rate > MAX_PHIX_ERROR_RATE:
-                status = "FAIL"
-            else:
-                status = "PASS"
-            out_data.append([status,
-                             "PhiX error rate",
-                             lane,
-                             err_rate,
-                             "{} < PhiX e (%) <= {}".format(MIN_PHIX_ERROR_RATE,
-                                                            MAX_PHIX_ERROR_RATE)])
-                
-        # Check that each lane received the minimum amount of reads
-        for lane, reads in lane_yield.items():
-            status = "FAIL"
-            if reads >= EXPECTED_LANE_YIELD:
-                status = "PASS"
-            out_data.append([status,"Lane yield",lane,reads,"[Yield >= {}]".format(EXPECTED_LANE_YIELD)])
-                
-        # Check that all samples in the pool have received a minimum number of reads
-        for id in sample_yield.keys():
-            for key in sample_yield[id].keys():
-                lane, index = key.split("_")
-                if index == "Undetermined":
-                    continue
-                
-                status = "FAIL"
-                mplx_min = int(0.5*EXPECTED_LANE_YIELD/pool_size[lane])
-                if sample_yield[id][key][0] >= mplx_min:
-                    status = "PASS"
-                out_data.append([status,"Sample yield",lane,sample_yield[id][key][1],id,sample_yield[id][key][0],"[Yield >= {}]".format(mplx_min)])
-        
-        # Check that the number of undetermined reads in each lane is below 10% of the total yield for the lane
-        for lane, reads in lane_yield.items():
-            status = "FAIL"
-            key = "_".join([lane,"Undetermined"])
-            undetermined = sum([counts.get(key,[0])[0] for counts in sample_yield.values()])
-            cutoff = 0.1*reads
-            if undetermined < cutoff:
-                status = "PASS"
-            out_data.append([status,"Index read",lane,undetermined,"[Undetermined < {}]".format(cutoff)])
-        
-        # Check that no overrepresented index sequence exists in undemultiplexed output
-        self.log.debug("Fetching undemultiplexed barcode data for flowcell {}".format(fcid))
-        undemux_data = self._get_undetermined_index_counts(fc_doc)
-        if len(undemux_data) == 0:
-            self.log.warn("No undemultiplexed barcode data available for flowcell {}".format(fcid))
-        
-        for lane, counts in undemux_data.items():
-            mplx_min = int(min(MAX_UNDEMULTIPLEXED_INDEX_COUNT,
-                               0.5*EXPECTED_LANE_YIELD/max(1,pool_size[lane])))
-            status = "N/A"
-            if len(counts) > 0:
-                for i in range(len(counts)):
-                    status = "FAIL"
-                    if int(counts[i][0]) < mplx_min:
-                        status = "PASS"
-                    out_data.append([status,"Index",lane,counts[i][1],counts[i][2],counts[i][0],"[Undetermined index < {}]".format(mplx_min)])
+        p_con = ProjectSummaryConnection(dbname=self.app.config.get("db", "projects"), **vars(self.app.pargs))
+        if batch:
+            results = self._map_flowcells(flowcells)
+        else:
+            results = [(flowcells[0],) + self._collect_qc(flowcells[0]) + (None,)]
+        for flowcell, qc_objects, manifest, error in results:
+            if error:
+                self.app.log.warn("Failed to collect qc objects for {}; skipping:\n{}".format(fc_id(flowcell), error))
+                continue
+            failed = set()
+            if len(qc_objects) == 0:
+                self.log.info("No out-of-date qc objects for {}".format(fc_id(flowcell)))
             else:
-                out_data.append([status,"Index",lane,"","",mplx_min,"-"])
-                    
+                self.log.info("Retrieved {} updated qc objects for {}".format(len(qc_objects), fc_id(flowcell)))
+                stored = self._save_qc_objects(qc_objects, s_con, fc_con, p_con)
+                if stored is not None:
+                    failed = set(_manifest_key(obj) for obj in qc_objects) - set(_manifest_key(obj) for obj in stored)
+            if failed:
+                self.app.log.warn("Failed to save {} qc objects for {}; they are collected again by the next upload".format(len(failed), fc_id(flowcell)))
+            # Record the input files of the stored objects only
+            if manifest is not None and not self.pargs.dry_run:
+                for key in failed:
+                    manifest.discard(key)
+                manifest.save()
+            if journal is not None and not self.pargs.dry_run and not failed:
+                journal.record(fc_fullname(flowcell))
+        # Start rebuilding view indexes so that subsequent reports need not wait for them
+        if not self.pargs.dry_run:
+            update_views(s_con.db, "samples")
+            update_views(fc_con.db, "flowcells")
+
+    @controller.expose(help="Perform a multiplex QC. Additional flowcells can be given with --flowcells, in which case each row is prefixed with the flowcell id.")
+    def multiplex_qc(self):
+        flowcells = self._get_flowcells()
+        if not flowcells:
+            self.app.log.warn("Required argument 'flowcell' lacking")
+            return
+        url = self.pargs.url if self.pargs.url else self.app.config.get("db", "url")
+        if not url:
+            self.app.log.warn("Please provide a valid url: got {}".format(url))
+            return
+
+        # Get a connection to the flowcell database
+        self.log.debug("Connecting to flowcell database")
+        fc_con = FlowcellRunMetricsConnection(dbname=self.app.config.get("db", "flowcells"), **vars(self.app.pargs))
+        out_data = []
+        for flowcell in flowcells:
+            # Construct the short form of the fcid
+            sp = os.path.basename(flowcell.rstrip(os.sep)).split("_")
+            fcid = "_".join([sp[0],sp[-1]])
+            self.log.debug("Fetching run metrics entry for flowcell {}".format(fcid))
+            fc_doc = fc_con.get_entry(fcid)
+            if not fc_doc:
+                self.log.warn("Could not fetch run metrics entry for flowcell {}".format(fcid))
+                continue
+            rows = multiplex_qc(fc_doc)
+            if len(flowcells) > 1:
+                rows = [[fcid] + row for row in rows]
+            out_data.extend(rows)
         self.app._output_data['stdout'].write("\n".join(["\t".join([str(r) for r in row]) for row in out_data]))
 
-    def _get_undetermined_index_counts(self, fc_doc):
-        """Get the top 10 undetermined index counts for each lane"""
-        
-        undetermined_indexes = defaultdict(list)
-        undemux_data = fc_doc.get("undemultiplexed_barcodes",{})
-        for lane, barcodes in undemux_data.items():
-            for key, data in barcodes.items():
-                if key != "undemultiplexed_barcodes":
-                    continue
-                for i in range(len(data.get("count",[]))):
-                    undetermined_indexes[lane].append([data["count"][i],
-                                                       data["sequence"][i],
-                                                       data["index_name"][i]])
-        return undetermined_indexes
-        
-    def _get_yield_per_sample(self, fc_doc, read_pairs=True):
-        """
-        Extract the yield per sample, keyed on SampleId and "Lane_Index"
-        Returns a dictionary of dictionaries    
-        """     
-        
-        # Get the yield for each sample, lane, index
-        sample_yield = {}
-        counts = fc_doc.get("illumina",{}).get("Demultiplex_Stats",{}).get("Barcode_lane_statistics",[])
-        for sample in counts:
-            id = sample['Sample ID']
-            lane = sample['Lane']
-            index = sample['Index']
-            reads = int(sample['# Reads'].replace(',',''))
-            if read_pairs:
-                reads /= 2
-            if id not in sample_yield:
-                sample_yield[id] = {}
-            sample_yield[id]["_".join([lane,index])] = [reads,sample['Project']]
-            
-        return sample_yield
-    
-    def _get_yield_per_lane(self, fc_doc, read_pairs=True):
-        """
-        Extract the yield per lane.
-        Returns a dictionary with key-value pairs of lane and yield    
-        """     
-        
-        # Get the yield for each lane
-        lane_yield = defaultdict(int)
-        counts = fc_doc.get("illumina",{}).get("Demultiplex_Stats",{}).get("Barcode_lane_statistics",[])
-        for sample in counts:
-            lane = sample['Lane']
-            reads = int(sample['# Reads'].replace(',',''))
-            if read_pairs:
-                reads /= 2
-            lane_yield[lane] += reads
-            
-        return lane_yield
-    
-    def _get_pool_size(self, fc_doc):
-        """
-        Extract the pool size for each lane.
-        Returns a dictionary with key-value pairs of lane and size    
-        """     
-        
-        pool_size = defaultdict(int)
-        counts = fc_doc.get("illumina",{}).get("Demultiplex_Stats",{}).get("Barcode_lane_statistics",[])
-        for sample in counts:
-            lane = sample['Lane']
-            index = sample['Index']
-            if index != "Undetermined":
-                pool_size[lane] += 1
-                
-        return pool_size
-       
     def _get_samplesheet_sample_data(self, fc_doc):
         """
         Extract the sample data from the csv samplesheet into a dictionary of dictionaries,
@@ -11,6 +11,8 @@ config_defaults['project']['root']  = None
 config_defaults['project']['repos']  = None
 config_defaults['project']['finished']  = None
 config_defaults['config']['ignore'] = ["slurm*", "tmp*"]
+config_defaults['config']['manifest_cache'] = None
+config_defaults['config']['metrics_cache'] = None
 config_defaults['log']['level']  = "INFO"
 config_defaults['log']['file']  = os.path.join(os.getenv("HOME"), "log", "pm.log")
 config_defaults['distributed']['jobaccount'] = None
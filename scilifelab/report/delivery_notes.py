@@ -7,6 +7,7 @@ import json
 import math
 from cStringIO import StringIO
 from collections import Counter
+from scilifelab.db import prefetch_entries
 from scilifelab.db.statusdb import SampleRunMetricsConnection, ProjectSummaryConnection, FlowcellRunMetricsConnection, calc_avg_qv
 from scilifelab.utils.misc import query_ok
 from scilifelab.report import sequencing_success
@@ -263,6 +264,9 @@ def sample_status_note(project_name=None, flowcell=None, username=None, password
     if len(sample_run_list) == 0:
         LOG.warn("No samples for project '{}', flowcell '{}'. Maybe there are no sample run metrics in statusdb?".format(project_name, flowcell))
         return output_data
+
+    # Prefetch the flowcell documents used for instrument, run mode and phix error rates
+    prefetch_entries([(fc_con, "{}_{}".format(s.get("date"), s.get("flowcell"))) for s in sample_run_list])
     
     # Set options
     ordered_million_reads = _literal_eval_option(ordered_million_reads)
@@ -540,13 +544,13 @@ def project_status_note(project_name=None, username=None, password=None, url=Non
 
     # Loop through samples in sample_dict for which there is no sample run information
     samples_in_table_or_excluded = list(set([x[0] for x in sample_table])) + samples_excluded
-    samples_not_in_table = list(set(sample_dict.keys()) - set(samples_in_table_or_excluded))
+    samples_not_in_table = [x for x in set(sample_dict.keys()) - set(samples_in_table_or_excluded) if not re.search("Unexpected", x)]
+    # Set project_sample_d: a dictionary mapping from sample run metrics name to sample run metrics database id
+    project_sample_ds = {sample:_set_project_sample_dict(sample_dict[sample]) for sample in samples_not_in_table}
+    s_con.prefetch([k for d in project_sample_ds.values() for k in d.keys()])
     for sample in samples_not_in_table:
-        if re.search("Unexpected", sample):
-            continue
         project_sample = sample_dict[sample]
-        # Set project_sample_d: a dictionary mapping from sample run metrics name to sample run metrics database id
-        project_sample_d = _set_project_sample_dict(project_sample)
+        project_sample_d = project_sample_ds[sample]
         if project_sample_d:
             for k,v in project_sample_d.iteritems():
                 barcode_seq = s_con.get_entry(k, "sequence")
@@ -1,6 +1,9 @@
 """report qc module"""
 import os
-import yaml
+import multiprocessing
+from itertools import izip
+import numpy as np
+import pandas as pd
 
 from collections import OrderedDict
 from cStringIO import StringIO
@@ -8,7 +11,8 @@ from cStringIO import StringIO
 from scilifelab.db.statusdb import SampleRunMetricsConnection, ProjectSummaryConnection, FlowcellRunMetricsConnection, get_qc_data
 from scilifelab.bcbio.qc import SampleRunMetricsParser
 from scilifelab.log import minimal_logger
-from scilifelab.bcbio.run import find_samples
+from scilifelab.bcbio.run import find_samples, CONFIG_INDEX
+from scilifelab.utils.metrics_cache import save_metrics_caches
 
 LOG = minimal_logger(__name__)
 
@@ -75,63 +79,128 @@ def _get_sample_qc_data(sample_prj, application, s_con, fc_id=None):
         qcdata[s["name"]]=_srm_to_qc(s)
     return qcdata
 
-def assess_qc(x, application):
-    status = "PASS"
-    dup_status = "OK"
-    for k in QC_CUTOFF[application].keys():
+## Numeric columns of qc tables
+QC_METRICS = ["TOTAL_READS", "MEAN_INSERT_SIZE", "GENOME_SIZE", "PERCENT_ON_TARGET",
+              "PERCENT_DUPLICATION", "PCT_TARGET_BASES_10X", "PCT_PF_READS_ALIGNED"]
+
+def qc_table(qcdata):
+    """Collect qc data of sample runs in a data frame.
+
+    :param qcdata: list of qc data dictionaries, as returned by _srm_to_qc
+
+    :returns: data frame with one row per sample run
+    """
+    df = pd.DataFrame(list(qcdata), columns=HEADER[0:4] + QC_METRICS)
+    for k in QC_METRICS:
+        df[k] = df[k].astype(float)
+    return df
+
+def assess_qc(df, application):
+    """Assess qc of sample runs by comparing the metrics columns to the
+    cutoffs of an application.
+
+    :param df: data frame as returned by qc_table
+    :param application: application, a key of QC_CUTOFF
+
+    :returns: data frame with columns dup_status and status added
+    """
+    df = df.copy()
+    fail = np.zeros(len(df), dtype=bool)
+    high_dup = np.zeros(len(df), dtype=bool)
+    for k, cutoff in QC_CUTOFF[application].iteritems():
         LOG.debug("assessing qc metric {}".format(k))
         if k == "PERCENT_DUPLICATION":
-            if float(x[k]) > QC_CUTOFF[application][k]: 
-                dup_status = "HIGH"
+            high_dup |= (df[k] > cutoff).values
         else:
-            if float(x[k]) < QC_CUTOFF[application][k]:
-                status = "FAIL"
-    return ["{:20}".format(x["sample"]),
-            "{:>5}".format(x["lane"]),
-            "{:>11}".format(x["flowcell"]),
-            "{:>8}".format(x["date"]), 
-            "{:>10.2f}M".format(int(x["TOTAL_READS"])/1e6/2), 
-            "{:>10.1f}".format(float(x["MEAN_INSERT_SIZE"])),
-            "{:>10.1f}G".format(int(x["GENOME_SIZE"])/1e9) if x["GENOME_SIZE"]>1e9 else "{:.1f}M".format(int(x["GENOME_SIZE"])/1e6),
-            "{:>10.1f}".format(float(x["PERCENT_ON_TARGET"])),
-            "{:>10.1f}".format(float(x["PERCENT_DUPLICATION"])),
-            "{:>10.1f}".format(float(x["PCT_TARGET_BASES_10X"])), 
-            "{:>10.1f}".format(float(x["PCT_PF_READS_ALIGNED"])), 
-            "{:>12}".format(dup_status), 
-            "{:>12}".format(status)]
-
-def compile_qc(path, application="seqcap", **kw):
+            fail |= (df[k] < cutoff).values
+    df["dup_status"] = np.where(high_dup, "HIGH", "OK")
+    df["status"] = np.where(fail, "FAIL", "PASS")
+    return df
+
+def _format_genome_size(x):
+    if np.isnan(x):
+        return "{:>11}".format(x)
+    return "{:>10.1f}G".format(int(x)/1e9) if x > 1e9 else "{:.1f}M".format(int(x)/1e6)
+
+def format_qc_table(df):
+    """Format an assessed qc table as fixed width text lines.
+
+    :param df: data frame as returned by assess_qc
+
+    :returns: list of lines
+    """
+    if len(df) == 0:
+        return []
+    columns = [df["sample"].map("{:20}".format),
+               df["lane"].map("{:>5}".format),
+               df["flowcell"].map("{:>11}".format),
+               df["date"].map("{:>8}".format),
+               (df["TOTAL_READS"]/1e6/2).map("{:>10.2f}M".format),
+               df["MEAN_INSERT_SIZE"].map("{:>10.1f}".format),
+               df["GENOME_SIZE"].map(_format_genome_size)]
+    columns += [df[k].map("{:>10.1f}".format) for k in ["PERCENT_ON_TARGET", "PERCENT_DUPLICATION", "PCT_TARGET_BASES_10X", "PCT_PF_READS_ALIGNED"]]
+    columns += [df[k].map("{:>12}".format) for k in ["dup_status", "status"]]
+    return list(reduce(lambda x, y: x + y, columns))
+
+def _write_qc_table(qcdata, application, output_data):
+    """Assess qc data and write it to output_data"""
+    for line in format_qc_table(assess_qc(qc_table(qcdata), application)):
+        output_data["stdout"].write(line + "\n")
+    return output_data
+
+def _collect_sample_qc(args):
+    """Read the picard metrics of the sample runs in a directory.
+    Module level so that it can be run in worker processes.
+
+    :param args: tuple of (directory, list of sample keyword arguments)
+
+    :returns: list of qc data dictionaries
+    """
+    (path, samples) = args
+    parser = SampleRunMetricsParser(path)
+    qcdata = []
+    for sample_kw in samples:
+        srm = dict(sample_kw)
+        srm["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
+        qcdata.append(_srm_to_qc(srm))
+    save_metrics_caches()
+    return qcdata
+
+def compile_qc(path, application="seqcap", workers=1, **kw):
     """Perform qc on data without access to statusdb.
 
+    :param path: path to search for bcbb config files
+    :param application: application for which to perform qc
+    :param workers: number of processes used to read metrics files
     :param **kw: keyword argument
 
     """
     output_data = {'stdout':StringIO(), 'stderr':StringIO()}
     ### find_samples excrutiatingly slow for multi-sample projects where we can have > 100k files...
-    flist = find_samples(path, **kw)
-    srm_l = []
-    for f in flist:
-        LOG.debug("Opening config file {}".format(f))
-        with open(f) as fh:
-            runinfo_yaml = yaml.load(fh)
+    flist = find_samples(path, workers=workers, **kw)
+    samples = OrderedDict()
+    for f, runinfo_yaml in izip(flist, CONFIG_INDEX.load(flist, workers)):
         for info in runinfo_yaml['details']:
             if info.get("multiplex", None):
                 for mp in info.get("multiplex"):
                     sample_kw = dict(path=os.path.dirname(f), flowcell=runinfo_yaml.get("fc_name", None), date=runinfo_yaml.get("fc_date", None), lane=info.get("lane", None), barcode_name=mp.get("name", None), sample_prj=kw.get("project"), barcode_id=mp.get('barcode_id', None), sequence=mp.get('sequence', None))
-                    obj = SampleRunMetrics(**sample_kw)
-                    srm_l.append(obj)
+                    samples.setdefault(os.path.dirname(f), []).append(sample_kw)
             else:
                 sample_kw = dict(path=os.path.dirname(f), flowcell=runinfo_yaml.get("fc_name", None), date=runinfo_yaml.get("fc_date", None), lane=info.get("lane", None), barcode_name=info.get("description", None), sample_prj=kw.get("project"), barcode_id=None, sequence=None)
-                obj = SampleRunMetrics(**sample_kw)
-                obj.read_picard_metrics()
-                srm_l.append(obj)
-    qcdata = []
+                samples.setdefault(os.path.dirname(f), []).append(sample_kw)
+    workers = min(workers, len(samples))
+    if workers <= 1:
+        res = map(_collect_sample_qc, samples.items())
+    else:
+        LOG.info("Reading metrics of {} sample directories with {} worker processes".format(len(samples), workers))
+        pool = multiprocessing.Pool(workers)
+        try:
+            res = pool.map(_collect_sample_qc, samples.items(), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
     output_data = _qc_info_header(kw.get("project"), application, output_data)
-    for s in srm_l:
-        qcdata.append(_srm_to_qc(s))
-    for v in qcdata:
-        y = [str(x) for x in assess_qc(v, application)]
-        output_data["stdout"].write("".join(y) + "\n")
+    output_data = _write_qc_table([x for qcdata in res for x in qcdata], application, output_data)
     return output_data
 
 
@@ -176,7 +245,6 @@ def application_qc(project_name=None, flowcell=None, application=None,
     p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url)
     s_con = SampleRunMetricsConnection(dbname=sampledb, username=username, password=password, url=url)
     prj_summary = p_con.get_entry(project_name)
-    qc_data = get_qc_data(project_name, p_con, s_con, flowcell)
 
     if not prj_summary is None:
         qc_data = get_qc_data(project_name, p_con, s_con, flowcell)
@@ -195,9 +263,7 @@ def application_qc(project_name=None, flowcell=None, application=None,
         qc_data = _get_sample_qc_data(project_name, application, s_con, flowcell)
 
     output_data = _qc_info_header(project_name, application, output_data)
-    for k,v in sorted(qc_data.iteritems()):
-        y = [str(x) for x in assess_qc(v, application)]
-        output_data["stdout"].write("".join(y) + "\n")
+    output_data = _write_qc_table([v for k, v in sorted(qc_data.iteritems())], application, output_data)
     return output_data
 
 def fastq_screen(project_name=None, flowcell=None,
@@ -226,3 +292,130 @@ def fastq_screen(project_name=None, flowcell=None,
             for v in vals:
                 output_data["stdout"].write(v)
     return output_data
+
+## Multiplex qc thresholds
+MAX_UNDEMULTIPLEXED_INDEX_COUNT = 1000000
+EXPECTED_LANE_YIELD = 143000000
+MAX_PHIX_ERROR_RATE = 2.0
+MIN_PHIX_ERROR_RATE = 0.0
+
+def _lane_key(lane):
+    return int(lane) if str(lane).isdigit() else lane
+
+class MultiplexData(object):
+    """Demultiplexing results of a flowcell, loaded from the flowcell
+    run metrics document into arrays. Barcode lane statistics are held
+    as one array per column, with lanes as indices into self.lanes, so
+    that lane totals are computed once for all lanes.
+
+    :param fc_doc: flowcell run metrics document
+    :param read_pairs: count read pairs instead of reads
+    """
+    def __init__(self, fc_doc, read_pairs=True):
+        ## Header rows are stored as empty dictionaries
+        stats = [x for x in fc_doc.get("illumina",{}).get("Demultiplex_Stats",{}).get("Barcode_lane_statistics",[]) if x]
+        self.lanes = sorted(set(x['Lane'] for x in stats), key=_lane_key)
+        lane_index = {lane:i for i, lane in enumerate(self.lanes)}
+        self.sample_id = np.array([x['Sample ID'] for x in stats], dtype=object)
+        self.project = np.array([x['Project'] for x in stats], dtype=object)
+        self.index = np.array([x['Index'] for x in stats], dtype=object)
+        self.lane = np.array([lane_index[x['Lane']] for x in stats], dtype=int)
+        self.reads = np.array([int(x['# Reads'].replace(',','')) for x in stats], dtype=np.int64)
+        if read_pairs:
+            self.reads //= 2
+        self.undetermined = self.index == "Undetermined"
+        n = len(self.lanes)
+        self.lane_yield = np.bincount(self.lane, weights=self.reads, minlength=n).astype(np.int64)
+        self.pool_size = np.bincount(self.lane[~self.undetermined], minlength=n)
+        self.undetermined_yield = np.bincount(self.lane[self.undetermined], weights=self.reads[self.undetermined], minlength=n).astype(np.int64)
+        self.phix_error_rate = self._phix_error_rate(fc_doc)
+        self.samplesheet = fc_doc.get("samplesheet_csv",[])
+        self.undemultiplexed = fc_doc.get("undemultiplexed_barcodes",{})
+
+    def _phix_error_rate(self, fc_doc):
+        """Get the mean PhiX error rate over the non-index reads of
+        each lane, as FlowcellRunMetricsConnection.get_phix_error_rate.
+        Error rates <= 0 are not counted.
+
+        :returns: array of error rates, -1 where the rate could not be determined
+        """
+        summary = [read for read in fc_doc.get("illumina",{}).get("Summary",{}).values() if read.get("ReadType","").strip() != "(Index)"]
+        err = np.array([[float(read.get(lane,{}).get("ErrRatePhiX","-1")) for lane in self.lanes] for read in summary], dtype=float).reshape(len(summary), len(self.lanes))
+        valid = err > 0
+        count = valid.sum(axis=0)
+        return np.where(count > 0, np.where(valid, err, 0).sum(axis=0) / np.maximum(count, 1), -1)
+
+    def pool_size_of(self, lane):
+        """Get the number of samples in the pool of a lane"""
+        return int(self.pool_size[self.lanes.index(lane)]) if lane in self.lanes else 0
+
+def multiplex_qc(fc_doc, read_pairs=True):
+    """Perform multiplex qc of a flowcell. Checks the PhiX error rate,
+    lane yield and undetermined index reads of each lane, the yield of
+    each sample and the counts of undemultiplexed indexes.
+
+    :param fc_doc: flowcell run metrics document
+    :param read_pairs: count read pairs instead of reads
+
+    :returns: list of rows, each a list starting with the status
+    """
+    fcid = fc_doc.get("name", None)
+    data = MultiplexData(fc_doc, read_pairs)
+    lanes = np.array(data.lanes, dtype=object)
+    out_data = []
+
+    # Compare samples in samplesheet with samples reported in Demultiplex_Stats
+    if len(data.samplesheet) == 0:
+        LOG.warn("No samplesheet data available for flowcell {}".format(fcid))
+    ssheet = {(x['SampleID'], x['Lane'], x['Index']):x['SampleProject'] for x in data.samplesheet}
+    demux_keys = set(zip(data.sample_id, lanes[data.lane], data.index))
+    for (id, lane, index) in sorted(set(ssheet.keys()) - demux_keys):
+        project = ssheet[(id, lane, index)]
+        LOG.warn("Sample {} from project {} is in samplesheet but no yield was reported in " \
+                 "Demultiplex_Stats.htm for lane {} and index {}".format(id, project, lane, index))
+    for i in np.flatnonzero(~data.undetermined):
+        if (data.sample_id[i], lanes[data.lane[i]], data.index[i]) not in ssheet:
+            LOG.warn("Sample {} from project {}, with index {} on lane {} is in Demultiplex_Stats " \
+                     "but no corresponding entry is present in SampleSheet".format(data.sample_id[i], data.project[i], data.index[i], lanes[data.lane[i]]))
+
+    # Check the PhiX error rate for each lane
+    phix_fail = (data.phix_error_rate <= MIN_PHIX_ERROR_RATE) | (data.phix_error_rate > MAX_PHIX_ERROR_RATE)
+    phix_status = np.where(data.phix_error_rate < 0, "N/A", np.where(phix_fail, "FAIL", "PASS"))
+    for lane, status, err_rate in izip(data.lanes, phix_status, data.phix_error_rate.tolist()):
+        if err_rate < 0:
+            LOG.warn("Could not get PhiX error rate for lane {} on flowcell {}".format(lane, fcid))
+            err_rate = -1
+        out_data.append([status, "PhiX error rate", lane, err_rate,
+                         "{} < PhiX e (%) <= {}".format(MIN_PHIX_ERROR_RATE, MAX_PHIX_ERROR_RATE)])
+
+    # Check that each lane received the minimum amount of reads
+    lane_status = np.where(data.lane_yield >= EXPECTED_LANE_YIELD, "PASS", "FAIL")
+    for lane, status, reads in izip(data.lanes, lane_status, data.lane_yield.tolist()):
+        out_data.append([status, "Lane yield", lane, reads, "[Yield >= {}]".format(EXPECTED_LANE_YIELD)])
+
+    # Check that all samples in the pool have received a minimum number of reads
+    samples = np.flatnonzero(~data.undetermined)
+    mplx_min = (0.5 * EXPECTED_LANE_YIELD / data.pool_size[data.lane[samples]]).astype(np.int64)
+    sample_status = np.where(data.reads[samples] >= mplx_min, "PASS", "FAIL")
+    for i, status, cutoff in izip(samples, sample_status, mplx_min.tolist()):
+        out_data.append([status, "Sample yield", lanes[data.lane[i]], data.project[i], data.sample_id[i], int(data.reads[i]), "[Yield >= {}]".format(cutoff)])
+
+    # Check that the number of undetermined reads in each lane is below 10% of the total yield for the lane
+    cutoff = 0.1 * data.lane_yield
+    index_status = np.where(data.undetermined_yield < cutoff, "PASS", "FAIL")
+    for lane, status, undetermined, c in izip(data.lanes, index_status, data.undetermined_yield.tolist(), cutoff.tolist()):
+        out_data.append([status, "Index read", lane, undetermined, "[Undetermined < {}]".format(c)])
+
+    # Check that no overrepresented index sequence exists in undemultiplexed output
+    if len(data.undemultiplexed) == 0:
+        LOG.warn("No undemultiplexed barcode data available for flowcell {}".format(fcid))
+    for lane in sorted(data.undemultiplexed.keys(), key=_lane_key):
+        barcodes = data.undemultiplexed[lane].get("undemultiplexed_barcodes", {})
+        counts = barcodes.get("count", [])
+        if len(counts) == 0:
+            continue
+        mplx_min = int(min(MAX_UNDEMULTIPLEXED_INDEX_COUNT, 0.5*EXPECTED_LANE_YIELD/max(1, data.pool_size_of(lane))))
+        status = np.where(np.array([int(x) for x in counts]) < mplx_min, "PASS", "FAIL")
+        for i in range(len(counts)):
+            out_data.append([status[i], "Index", lane, barcodes["sequence"][i], barcodes["index_name"][i], counts[i], "[Undetermined index < {}]".format(mplx_min)])
+    return out_data
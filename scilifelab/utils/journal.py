@@ -0,0 +1,46 @@
+"""Progress journals for batch jobs.
+
+A journal records the items of a batch job that have been completed,
+one per line, so that an interrupted job can be resumed by skipping
+the items already done. Entries are synced to disk as soon as they
+are recorded; a line that was cut short by an interruption does not
+match any item, so that item is simply done again.
+"""
+import os
+
+import scilifelab.log
+
+LOG = scilifelab.log.minimal_logger(__name__)
+
+class Journal(object):
+    """Journal of completed items.
+
+    :param filename: journal file name
+    """
+    def __init__(self, filename):
+        self.filename = os.path.expanduser(filename)
+        self._done = set()
+        if os.path.exists(self.filename):
+            with open(self.filename) as fh:
+                self._done = set(x.rstrip("\r\n") for x in fh if x.strip())
+            LOG.debug("read {} completed items from journal {}".format(len(self._done), self.filename))
+
+    def __contains__(self, item):
+        return item in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def record(self, item):
+        """Record an item as completed.
+
+        :param item: item name, without newlines
+        """
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.filename, "a") as fh:
+            fh.write("{}\n".format(item))
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._done.add(item)
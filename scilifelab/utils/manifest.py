@@ -0,0 +1,328 @@
+"""Persistent directory manifests.
+
+A manifest caches the listing of every directory below a root
+directory, keyed by the directory path and modification time. Since
+the modification time of a directory changes whenever an entry is
+added, removed or renamed in it, a subsequent walk only needs to stat
+the directories and can reuse the cached listings of directories that
+have not changed. Manifests are stored as json files in a cache
+directory, one per root directory. Within a process, walks of the same
+root directory share one manifest, which is written once with
+save_manifests, e.g. when a command finishes.
+
+Input manifests record the size, modification time and content hash
+of the files that documents, e.g. sample run metrics, were collected
+from, so that a document is only collected again when its input files
+have changed.
+"""
+import os
+import json
+import time
+import fcntl
+import hashlib
+import threading
+import contextlib
+
+import scilifelab.log
+
+LOG = scilifelab.log.minimal_logger(__name__)
+
+## Directories modified within this many seconds of a scan are not
+## cached, since further modifications within the resolution of the
+## file system timestamps would go unnoticed
+RACY_SECONDS = 2
+
+_cachedir = None
+## Directory manifests in use, by absolute root directory
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def enable_manifest_cache(cachedir):
+    """Enable manifest caching for directory walks.
+
+    :param cachedir: directory in which manifests are stored
+    """
+    global _cachedir
+    _cachedir = os.path.expanduser(cachedir)
+    with _manifests_lock:
+        _manifests.clear()
+
+def disable_manifest_cache():
+    """Disable manifest caching for directory walks. Unsaved
+    manifests are discarded."""
+    global _cachedir
+    _cachedir = None
+    with _manifests_lock:
+        _manifests.clear()
+
+def get_manifest(rootdir):
+    """Get the manifest of a root directory. Manifests are shared by
+    all walks of a root directory in a process.
+
+    :param rootdir: root directory
+
+    :returns: <DirectoryManifest> object, or None if manifest caching is disabled
+    """
+    if not _cachedir:
+        return None
+    with _manifests_lock:
+        key = os.path.abspath(rootdir)
+        if key not in _manifests:
+            _manifests[key] = DirectoryManifest(rootdir, _cachedir)
+        return _manifests[key]
+
+def save_manifests():
+    """Save the directory manifests that have been updated by walks"""
+    with _manifests_lock:
+        manifests = _manifests.values()
+    for manifest in manifests:
+        manifest.save()
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """Hold an exclusive lock on filename while reading and rewriting
+    it, so that concurrent processes do not drop each other's updates.
+    The lock is taken on a separate lock file.
+
+    :param filename: file to lock
+    """
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    with open("{}.lock".format(filename), "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+def get_input_manifest(name):
+    """Get the input manifest of a run.
+
+    :param name: run name, e.g. a flowcell name
+
+    :returns: <InputManifest> object, or None if manifest caching is disabled
+    """
+    if not _cachedir:
+        return None
+    return InputManifest(name, _cachedir)
+
+def _hash_file(f, blocksize=1048576):
+    h = hashlib.sha1()
+    with open(f, "rb") as fh:
+        for block in iter(lambda: fh.read(blocksize), ""):
+            h.update(block)
+    return h.hexdigest()
+
+class DirectoryManifest(object):
+    """Cache of the directory listings below a root directory.
+
+    Listings scanned by walks are merged into the stored manifest on
+    save. Directories are only dropped from the manifest once a walk
+    has seen that they were removed.
+
+    :param rootdir: root directory
+    :param cachedir: directory in which the manifest is stored
+    """
+    def __init__(self, rootdir, cachedir):
+        self.rootdir = rootdir
+        self.filename = os.path.join(cachedir, "{}.json".format(hashlib.sha1(os.path.abspath(rootdir)).hexdigest()))
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._updated = {}
+        self._removed = set()
+        self._lock = threading.Lock()
+        self.load()
+
+    def _read(self):
+        """Read the stored entries"""
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename) as fh:
+                data = json.load(fh)
+            if data.get("rootdir") == os.path.abspath(self.rootdir):
+                ## Names are listed as byte strings, as by os.listdir
+                return {k.encode("utf-8"):[v[0]] + [[x.encode("utf-8") for x in names] for names in v[1:]] for k, v in data.get("entries", {}).iteritems()}
+        except (IOError, ValueError) as e:
+            LOG.warn("could not read manifest {}: {}".format(self.filename, e))
+        return {}
+
+    def load(self):
+        """Load the manifest from disk"""
+        entries = self._read()
+        with self._lock:
+            self._entries = entries
+
+    def _is_removed(self, key, removed):
+        return any(key == x or key.startswith(x + os.sep) for x in removed)
+
+    def save(self):
+        """Merge the listings scanned since the last save into the
+        stored manifest. Nothing is written if no listing changed."""
+        with self._lock:
+            updated = dict(self._updated)
+            removed = set(self._removed)
+        if not updated and not removed:
+            return
+        with file_lock(self.filename):
+            entries = self._read()
+            if removed:
+                entries = {k:v for k, v in entries.iteritems() if not self._is_removed(k, removed)}
+            entries.update(updated)
+            tmpfile = "{}.{}.tmp".format(self.filename, os.getpid())
+            with open(tmpfile, "w") as fh:
+                json.dump({"rootdir" : os.path.abspath(self.rootdir), "entries" : entries}, fh)
+            os.rename(tmpfile, self.filename)
+        with self._lock:
+            for k, v in updated.iteritems():
+                if self._updated.get(k, None) is v:
+                    del self._updated[k]
+            self._removed -= removed
+            self._entries.update({k:v for k, v in entries.iteritems() if k not in self._updated})
+        LOG.debug("saved manifest for {} ({} cached, {} scanned directories)".format(self.rootdir, self.hits, self.misses))
+
+    def scan(self, path, scan_fn):
+        """List a directory, using the cached listing if the directory
+        has not been modified.
+
+        :param path: directory
+        :param scan_fn: function that lists a directory, returning (dirs, files, symlinked dirs)
+
+        :returns: tuple of (dirs, files, symlinked dirs)
+        """
+        key = os.path.relpath(path, self.rootdir)
+        mtime = os.stat(path).st_mtime
+        entry = self._entries.get(key, None)
+        if entry and entry[0] == mtime:
+            self.hits += 1
+            return (list(entry[1]), list(entry[2]), list(entry[3]))
+        self.misses += 1
+        res = scan_fn(path)
+        with self._lock:
+            if entry:
+                ## Listings of removed subdirectories are dropped
+                removed = [os.path.normpath(os.path.join(key, x)) for x in set(entry[1]) - set(res[0])]
+                if removed:
+                    self._removed.update(removed)
+                    for k in [k for k in self._entries if self._is_removed(k, removed)]:
+                        del self._entries[k]
+                    for k in [k for k in self._updated if self._is_removed(k, removed)]:
+                        del self._updated[k]
+            if time.time() - mtime > RACY_SECONDS:
+                self._entries[key] = [mtime, res[0], res[1], res[2]]
+                self._updated[key] = self._entries[key]
+        return res
+
+class InputManifest(object):
+    """Record of the input files of the documents collected from a run.
+
+    Each document is recorded under a key with the size, modification
+    time and sha1 hash of its input files. Files whose size and
+    modification time are unchanged are not hashed again; files that
+    have been touched but whose content is unchanged are not
+    considered changed. Records are kept pending until saved, so that
+    a document is only recorded once it has been stored.
+
+    :param name: run name
+    :param cachedir: directory in which the manifest is stored
+    """
+    def __init__(self, name, cachedir):
+        self.name = name
+        self.filename = os.path.join(cachedir, "{}.inputs.json".format(hashlib.sha1(name).hexdigest()))
+        self._entries = {}
+        self._pending = {}
+        self.load()
+
+    def load(self):
+        """Load the manifest from disk"""
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as fh:
+                data = json.load(fh)
+            if data.get("name") == self.name:
+                self._entries = {k:{f.encode("utf-8"):sig for f, sig in v.iteritems()} for k, v in data.get("entries", {}).iteritems()}
+        except (IOError, ValueError) as e:
+            LOG.warn("could not read input manifest {}: {}".format(self.filename, e))
+
+    def save(self):
+        """Save the pending records"""
+        if not self._pending:
+            return
+        dirname = os.path.dirname(self.filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._entries.update(self._pending)
+        self._pending = {}
+        tmpfile = "{}.{}.tmp".format(self.filename, os.getpid())
+        with open(tmpfile, "w") as fh:
+            json.dump({"name" : self.name, "entries" : self._entries}, fh)
+        os.rename(tmpfile, self.filename)
+
+    def _signature(self, f, previous=None):
+        """Get the signature of a file, reusing the hash of the previous
+        signature if size and modification time are unchanged.
+
+        :returns: list of size, mtime and hash, or None if the file does not exist
+        """
+        try:
+            st = os.stat(f)
+        except OSError:
+            return None
+        if previous and previous[0] == st.st_size and previous[1] == st.st_mtime:
+            return previous
+        ## Files modified within this many seconds may be modified again
+        ## without changing the modification time, so their hash is
+        ## always recomputed
+        mtime = st.st_mtime if time.time() - st.st_mtime > RACY_SECONDS else None
+        return [st.st_size, mtime, _hash_file(f)]
+
+    def changed(self, key, files=None):
+        """Check whether the input files of a document have changed
+        since they were recorded.
+
+        :param key: document key
+        :param files: current input files; if None, the recorded files are checked
+
+        :returns: True if the document has not been recorded, or if files have been added, removed or modified
+        """
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return True
+        if files is not None and set(files) != set(entry.keys()):
+            return True
+        refreshed = {}
+        for f, previous in entry.iteritems():
+            sig = self._signature(f, previous)
+            if sig is None or previous is None:
+                if sig != previous:
+                    return True
+            elif sig[0] != previous[0] or sig[2] != previous[2]:
+                return True
+            refreshed[f] = sig
+        if refreshed != entry:
+            self._pending[key] = refreshed
+        return False
+
+    def record(self, key, files):
+        """Record the input files of a document.
+
+        :param key: document key
+        :param files: input files; files that do not exist are recorded as missing
+        """
+        entry = self._entries.get(key, {})
+        self._pending[key] = {f:self._signature(f, entry.get(f, None)) for f in files}
+
+    def discard(self, key):
+        """Drop the pending record of a document, e.g. because the
+        document could not be stored.
+
+        :param key: document key
+        """
+        self._pending.pop(key, None)
@@ -0,0 +1,173 @@
+"""Persistent cache of parsed metrics.
+
+Metrics files of finished runs rarely change, but are parsed anew
+every time qc data is collected. A metrics cache stores the parsed
+results of a run directory, keyed by the files they were parsed from
+and their sizes and modification times, so that files are only parsed
+again when they have changed. Caches are stored as binary pickle
+files in a cache directory, one per run directory. Within a process,
+parsers of the same run directory share one cache. New results are
+kept in memory and written by save_metrics_caches, once a collection
+is done.
+"""
+import os
+import hashlib
+import threading
+import cPickle as pickle
+
+import scilifelab.log
+from scilifelab.utils.manifest import file_lock
+
+LOG = scilifelab.log.minimal_logger(__name__)
+
+_cachedir = None
+## Metrics caches in use, by absolute run directory
+_caches = {}
+_caches_lock = threading.Lock()
+
+def enable_metrics_cache(cachedir):
+    """Enable caching of parsed metrics.
+
+    :param cachedir: directory in which caches are stored
+    """
+    global _cachedir
+    _cachedir = os.path.expanduser(cachedir)
+    with _caches_lock:
+        _caches.clear()
+
+def disable_metrics_cache():
+    """Disable caching of parsed metrics. Unsaved results are discarded."""
+    global _cachedir
+    _cachedir = None
+    with _caches_lock:
+        _caches.clear()
+
+def get_metrics_cache(rundir):
+    """Get the metrics cache of a run directory.
+
+    :param rundir: run directory, e.g. a flowcell or sample run directory
+
+    :returns: <MetricsCache> object, or None if metrics caching is disabled
+    """
+    if not _cachedir:
+        return None
+    with _caches_lock:
+        key = os.path.abspath(rundir)
+        if key not in _caches:
+            _caches[key] = MetricsCache(rundir, _cachedir)
+        return _caches[key]
+
+def save_metrics_caches():
+    """Save the results added to metrics caches, and release the
+    caches so that they are loaded anew on next use."""
+    with _caches_lock:
+        caches = _caches.values()
+        _caches.clear()
+    for cache in caches:
+        cache.save()
+
+def file_signature(files):
+    """Get the signature of a list of files.
+
+    :param files: list of file names
+
+    :returns: tuple of (file name, size, mtime) tuples, or None if a file cannot be stat'ed
+    """
+    sig = []
+    for f in files:
+        try:
+            st = os.stat(f)
+        except OSError:
+            return None
+        sig.append((f, st.st_size, st.st_mtime))
+    return tuple(sig)
+
+class MetricsCache(object):
+    """Cache of the parsed metrics of a run directory.
+
+    Results are held pickled, so that callers always get a fresh copy
+    that they can modify. New results are merged into the stored cache
+    on save, so that processes sharing a run directory keep each
+    other's results.
+
+    :param rundir: run directory
+    :param cachedir: directory in which the cache is stored
+    """
+    def __init__(self, rundir, cachedir):
+        self.rundir = rundir
+        self.filename = os.path.join(cachedir, "{}.pickle".format(hashlib.sha1(os.path.abspath(rundir)).hexdigest()))
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._updated = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def _read(self):
+        """Read the stored entries"""
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, "rb") as fh:
+                data = pickle.load(fh)
+            if data.get("rundir") == os.path.abspath(self.rundir):
+                return data.get("entries", {})
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError) as e:
+            LOG.warn("could not read metrics cache {}: {}".format(self.filename, e))
+        return {}
+
+    def load(self):
+        """Load the cache from disk"""
+        entries = self._read()
+        with self._lock:
+            self._entries = entries
+
+    def save(self):
+        """Merge the results added since the last save into the stored
+        cache. Nothing is written if no results were added."""
+        with self._lock:
+            updated = dict(self._updated)
+            self._updated = {}
+        if not updated:
+            return
+        try:
+            with file_lock(self.filename):
+                entries = self._read()
+                entries.update(updated)
+                tmpfile = "{}.{}.tmp".format(self.filename, os.getpid())
+                with open(tmpfile, "wb") as fh:
+                    pickle.dump({"rundir" : os.path.abspath(self.rundir), "entries" : entries}, fh, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmpfile, self.filename)
+        except (IOError, OSError) as e:
+            LOG.warn("could not save metrics cache for {}: {}".format(self.rundir, e))
+
+    def get(self, key, files, fn, *args, **kw):
+        """Get the result of parsing files, parsing only if the files
+        have changed since the result was cached.
+
+        :param key: name of the parsing operation, e.g. 'picard_metrics'
+        :param files: list of files parsed by fn
+        :param fn: parsing function
+        :param *args: arguments to fn
+        :param **kw: keyword arguments to fn
+
+        :returns: result of fn
+        """
+        sig = file_signature(files)
+        entry_key = (key, tuple(files))
+        entry = self._entries.get(entry_key, None)
+        if sig is not None and entry is not None and entry[0] == sig:
+            self.hits += 1
+            return pickle.loads(entry[1])
+        self.misses += 1
+        res = fn(*args, **kw)
+        if sig is not None:
+            try:
+                entry = (sig, pickle.dumps(res, pickle.HIGHEST_PROTOCOL))
+            except (pickle.PicklingError, TypeError) as e:
+                LOG.warn("could not cache {} for {}: {}".format(key, self.rundir, e))
+                return res
+            with self._lock:
+                self._entries[entry_key] = entry
+                self._updated[entry_key] = entry
+        return res
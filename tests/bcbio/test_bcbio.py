@@ -1,14 +1,82 @@
 import os
+import json
+import pickle
 import tempfile
 import shutil
 import unittest
 from ..data import data_files
-from scilifelab.bcbio.qc import RunInfoParser
+from scilifelab.bcbio.qc import RunInfoParser, SampleRunMetricsParser, FlowcellRunMetricsParser, IlluminaXMLParser, TileMetrics, HtmlTableParser, DemultiplexStats, ExtendedPicardMetricsParser, ExtendedFastQCParser
+from scilifelab.utils.metrics_cache import enable_metrics_cache, disable_metrics_cache, save_metrics_caches, MetricsCache
+from scilifelab.io.picard import read_picard_metrics
+from scilifelab.io.fastqc import read_fastqc_data
+from scilifelab.bcbio.run import ConfigIndex, find_samples, _group_samples
 
 filedir = os.path.abspath(os.path.realpath(os.path.dirname(__file__)))
 
 RunInfo = data_files["RunInfo.xml"]
 
+InsertMetrics = """## net.sf.picard.metrics.StringHeader
+# net.sf.picard.analysis.CollectInsertSizeMetrics HISTOGRAM_FILE=1_120924_AC003CCCXX_2-sort-dup.insert_metrics.pdf INPUT=1_120924_AC003CCCXX_2-sort-dup.bam
+## net.sf.picard.metrics.StringHeader
+# Started on: Mon Sep 24 10:00:00 CEST 2012
+
+## METRICS CLASS	net.sf.picard.analysis.InsertSizeMetrics
+MEDIAN_INSERT_SIZE	MEAN_INSERT_SIZE	STANDARD_DEVIATION	PAIR_ORIENTATION	SAMPLE
+180	185,5	?	FR	
+
+## HISTOGRAM	java.lang.Integer
+insert_size	All_Reads.fr_count
+2	1
+3	4
+"""
+
+AlignMetrics = """## net.sf.picard.metrics.StringHeader
+# net.sf.picard.analysis.CollectAlignmentSummaryMetrics INPUT=1_120924_AC003CCCXX_2-sort-dup.bam
+
+## METRICS CLASS	net.sf.picard.analysis.AlignmentSummaryMetrics
+CATEGORY	TOTAL_READS	PCT_PF_READS_ALIGNED
+FIRST_OF_PAIR	500	0,5
+SECOND_OF_PAIR	500	0,5
+PAIR	1000	0,5
+
+"""
+
+FastQCData = """##FastQC	0.10.1
+>>Basic Statistics	pass
+#Measure	Value	
+Filename	1_120924_AC003CCCXX_2_1.fastq	
+Total Sequences	1000	
+>>END_MODULE
+>>Per base sequence quality	pass
+#Base	Mean	Median
+1	31.5	33.0
+10-11	30.25	32.0
+>>END_MODULE
+>>Per sequence quality scores	pass
+#Quality	Count
+2	12.0
+3	108.0
+>>END_MODULE
+>>Sequence Duplication Levels	pass
+#Total Duplicate Percentage	38.6
+#Duplication Level	Relative count
+1	100.0
+>>END_MODULE
+>>Overrepresented sequences	pass
+>>END_MODULE
+"""
+
+RTAChart = """<?xml version="1.0"?>
+<FlowCellData Instrument="SN0002" RunFolder="120924_SN0002_0003_CC003CCCXX">
+  <Layout NumLanes="2" RowsPerLane="2" ColsPerLane="1" NumSwaths="1"/>
+  <TileList>
+    <TL Key="1_1" A="{}" C="1.5"/>
+    <TL Key="1_2" A="NaN" C="2.5"/>
+    <TL Key="2_2" A="3" C="3.5"/>
+  </TileList>
+</FlowCellData>
+"""
+
 class TestBcbioQC(unittest.TestCase):
     """Test for bcbio qc module"""
     def setUp(self):
@@ -28,3 +96,232 @@ class TestBcbioQC(unittest.TestCase):
         self.assertEqual(res["Instrument"], "SN0002")
         self.assertEqual(res["Date"], "120924")
 
+    def test_file_index(self):
+        """Test classification of sample run metrics files"""
+        fcdir = os.path.join(self.rootdir, "120924_AC003CCCXX")
+        files = ["1_120924_AC003CCCXX_nophix_2-sort-dup.align_metrics", "1_120924_AC003CCCXX_2_nophix-sort-dup.hs_metrics",
+                 "1_120924_AC003CCCXX_12-sort-dup.insert_metrics", "1_120924_AC003CCCXX_nophix_2_1_fastq_screen.txt",
+                 "1_120924_AC003CCCXX_nophix.bc_metrics", "1_120924_AC003CCCXX_nophix_2-sort-dup.bam",
+                 os.path.join("fastqc", "1_120924_AC003CCCXX_nophix_2-sort-dup_fastqc", "fastqc_data.txt"),
+                 os.path.join("fastqc", "1_120924_AC003CCCXX_nophix_12-sort-dup_fastqc", "fastqc_data.txt")]
+        for f in files:
+            if not os.path.exists(os.path.dirname(os.path.join(fcdir, f))):
+                os.makedirs(os.path.dirname(os.path.join(fcdir, f)))
+            open(os.path.join(fcdir, f), "w").close()
+        parser = SampleRunMetricsParser(fcdir)
+        self.assertEqual(sorted([os.path.join(fcdir, x) for x in files[0:2]]), sorted(parser.lookup_files("picard_metrics", 1, 2)))
+        self.assertEqual([os.path.join(fcdir, files[2])], parser.lookup_files("picard_metrics", "1", "12"))
+        self.assertEqual([os.path.join(fcdir, files[3])], parser.lookup_files("fastq_screen", 1, 2))
+        self.assertEqual([os.path.join(fcdir, files[4])], parser.lookup_files("bc_metrics", 1))
+        self.assertEqual([os.path.join(fcdir, files[6])], parser.lookup_files("fastqc", 1, 2))
+        self.assertEqual([], parser.lookup_files("picard_metrics", 2, 2))
+
+    def test_parse_rta_charts(self):
+        """Test parsing RTA chart files into tile metric arrays"""
+        files = []
+        for d, index in [("ErrorRate", "2"), ("ErrorRate", "10"), ("ErrorRate", "1"), ("Summary", None)]:
+            if not os.path.exists(os.path.join(self.rootdir, d)):
+                os.makedirs(os.path.join(self.rootdir, d))
+            f = os.path.join(self.rootdir, d, "Chart_{}.xml".format(index) if index else "read1.xml")
+            with open(f, "w") as fh:
+                fh.write(RTAChart.format(index) if index else '<Summary Read="1"><Lane key="1" ClustersRaw="100"/></Summary>')
+            files.append(f)
+        for workers in [1, 2]:
+            parser = IlluminaXMLParser()
+            data = parser.parse(files, fullRTA=True, workers=workers)
+            tm = parser.tile_metrics["ErrorRate"]
+            self.assertEqual(["1", "2", "10"], tm.indices)
+            self.assertEqual(["A", "C"], tm.metrics)
+            self.assertEqual((3, 2, 2, 2), tm.data.shape)
+            self.assertEqual(10.0, tm.get("10", 1, 1, "A"))
+            self.assertEqual(3.5, tm.get("2", 2, 2, "C"))
+            self.assertIsNone(tm.get("2", 1, 2, "A"))
+            self.assertIsNone(tm.get("2", 2, 1, "C"))
+            self.assertEqual((0, 0, 0, 0), parser.tile_metrics["FWHM"].data.shape)
+            self.assertEqual("100", data["Summary"]["read1"]["1"]["ClustersRaw"])
+            tm = TileMetrics.from_dict(json.loads(json.dumps(data["ErrorRate"])))
+            self.assertEqual(["1", "2", "10"], tm.indices)
+            self.assertEqual(2.5, tm.get("1", 1, 2, "C"))
+            self.assertEqual("2", tm.header["NumLanes"])
+
+    def test_html_table_parser(self):
+        """Test parsing html tables in chunks"""
+        htm = os.path.join(self.rootdir, "Demultiplex_Stats.htm")
+        with open(htm, "w") as fh:
+            fh.write('<html><body><table><col width="4%"><tr><th>Sample<p></p>ID</th><th>% of &gt;= Q30</th></tr></table>'
+                     '<div><table><tr><td>P001_101</td><td>90.05</td></tr><tr></tr><tr><td>P001_102</td><td>&#56;7.28</td></tr></table></div></body></html>')
+        tables = HtmlTableParser().parse_file(htm, chunksize=7)
+        self.assertEqual(2, len(tables))
+        self.assertEqual([[("th", "SampleID"), ("th", "% of >= Q30")]], tables[0])
+        self.assertEqual([[("td", "P001_101"), ("td", "90.05")], [("td", "P001_102"), ("td", "87.28")]], tables[1])
+
+    def test_parse_demultiplex_stats_htm(self):
+        """Test that header rows in data tables are kept as empty dictionaries"""
+        htm = os.path.join(self.rootdir, "Unaligned", "Basecall_Stats_C003CCCXX", "Demultiplex_Stats.htm")
+        os.makedirs(os.path.dirname(htm))
+        with open(htm, "w") as fh:
+            fh.write('<html><body><table><tr><th>Lane</th><th>Sample ID</th><th># Reads</th></tr></table>'
+                     '<table><tr><th>Lane</th><th>Sample ID</th><th># Reads</th></tr><tr><td>1</td><td>P001_101_index3</td><td>39,034,396</td></tr></table>'
+                     '<table><tr><th>Sample<p></p>ID</th><th>Recipe</th></tr></table>'
+                     '<table><tr><td>P001_101_index3</td><td>R1</td></tr></table></body></html>')
+        stats = FlowcellRunMetricsParser(self.rootdir).parse_demultiplex_stats_htm(fc_name="AC003CCCXX")
+        self.assertEqual([{}, {"Lane":"1", "Sample ID":"P001_101_index3", "# Reads":"39,034,396"}], stats["Barcode_lane_statistics"])
+        self.assertEqual(39034396, stats.read_count("P001_101_index3", 1))
+
+    def test_input_file_candidates(self):
+        """Test that missing flowcell input files are expected, and new files are found"""
+        open(os.path.join(self.rootdir, "RunInfo.xml"), "w").close()
+        parser = FlowcellRunMetricsParser(self.rootdir)
+        files = parser.input_file_candidates("AC003CCCXX", runinfo_csv="SampleSheet.csv")
+        self.assertEqual(sorted([os.path.join(self.rootdir, x) for x in ["RunInfo.xml", "runParameters.xml", "SampleSheet.csv"]]), files)
+        htm = os.path.join(self.rootdir, "Unaligned", "Basecall_Stats_C003CCCXX", "Demultiplex_Stats.htm")
+        os.makedirs(os.path.dirname(htm))
+        open(htm, "w").close()
+        open(os.path.join(self.rootdir, "1_120924_AC003CCCXX_nophix.bc_metrics"), "w").close()
+        parser = FlowcellRunMetricsParser(self.rootdir)
+        files = parser.input_file_candidates("AC003CCCXX", runinfo_csv="SampleSheet.csv")
+        self.assertIn(htm, files)
+        self.assertIn(os.path.join(self.rootdir, "1_120924_AC003CCCXX_nophix.bc_metrics"), files)
+        self.assertIn(os.path.join(self.rootdir, "run_info.yaml"), parser.input_file_candidates("AC003CCCXX", run_info_yaml="run_info.yaml", casava=False))
+
+    def test_demultiplex_stats(self):
+        """Test lookup of read counts in demultiplex statistics"""
+        stats = DemultiplexStats({"Barcode_lane_statistics":[{"Sample ID":"P001_101_index3", "Lane":"1", "# Reads":"39,034,396"},
+                                                             {"Sample ID":"P001_102_index6", "Lane":"2", "# Reads":"30,641,418"}],
+                                  "Sample_information":[]})
+        self.assertEqual(39034396, stats.read_count("P001_101_index3", 1))
+        self.assertEqual(30641418, stats.read_count("P001_102_index6", "2"))
+        self.assertIsNone(stats.read_count("P001_101_index3", 2))
+        stats = pickle.loads(pickle.dumps(stats))
+        self.assertEqual(39034396, stats.read_count("P001_101_index3", "1"))
+        self.assertEqual("39,034,396", json.loads(json.dumps(stats))["Barcode_lane_statistics"][0]["# Reads"])
+        parser = SampleRunMetricsParser(self.rootdir)
+        self.assertEqual(19517198, parser.get_bc_count("P001_101_index3", "J.Doe_00_01", "AC003CCCXX", 1, 1, demultiplex_stats=stats))
+        self.assertEqual(19517198, parser.get_bc_count("P001_101_index3", "J.Doe_00_01", "AC003CCCXX", 1, 1, demultiplex_stats=dict(stats)))
+
+    def test_read_picard_metrics(self):
+        """Test reading picard metrics into typed columns"""
+        f = os.path.join(self.rootdir, "1_120924_AC003CCCXX_2-sort-dup.insert_metrics")
+        with open(f, "w") as fh:
+            fh.write(InsertMetrics)
+        data = read_picard_metrics(f)
+        self.assertTrue(data.command.startswith("# net.sf.picard.analysis.CollectInsertSizeMetrics"))
+        self.assertEqual(["MEDIAN_INSERT_SIZE", "MEAN_INSERT_SIZE", "STANDARD_DEVIATION", "PAIR_ORIENTATION", "SAMPLE"], data.metrics.header)
+        self.assertEqual("int64", str(data.metrics.columns["MEDIAN_INSERT_SIZE"].dtype))
+        self.assertEqual(185.5, data.metrics.columns["MEAN_INSERT_SIZE"][0])
+        self.assertEqual(["FR"], list(data.metrics.columns["PAIR_ORIENTATION"]))
+        self.assertEqual({"MEDIAN_INSERT_SIZE":[180], "MEAN_INSERT_SIZE":[185.5], "STANDARD_DEVIATION":[None], "PAIR_ORIENTATION":["FR"], "SAMPLE":[None]}, data.metrics.to_dict())
+        self.assertEqual([2, 3], list(data.hist.columns["insert_size"]))
+        with open(f) as fh:
+            res = ExtendedPicardMetricsParser()._parse_insert_metrics(fh)
+        self.assertEqual("185,5", res["metrics"]["MEAN_INSERT_SIZE"])
+        self.assertEqual({"insert_size":[2, 3], "All_Reads.fr_count":[1, 4]}, res["hist"])
+        with open(f, "w") as fh:
+            fh.write(AlignMetrics)
+        with open(f) as fh:
+            res = ExtendedPicardMetricsParser()._parse_align_metrics(fh)
+        self.assertEqual("1000", res["PAIR"]["TOTAL_READS"])
+        self.assertEqual("0,5", res["FIRST_OF_PAIR"]["PCT_PF_READS_ALIGNED"])
+        self.assertIsNone(read_picard_metrics(f).hist)
+
+    def test_metrics_cache(self):
+        """Test reading flowcell metrics through the metrics cache"""
+        enable_metrics_cache(os.path.join(self.rootdir, "cache"))
+        self.addCleanup(disable_metrics_cache)
+        fcdir = os.path.join(self.rootdir, "120924_SN0002_0003_CC003CCCXX")
+        os.makedirs(fcdir)
+        with open(os.path.join(fcdir, "RunInfo.xml"), "w") as fh:
+            fh.write(RunInfo)
+        parser = FlowcellRunMetricsParser(fcdir)
+        self.assertEqual("CC003CCCXX", parser.parseRunInfo()["Flowcell"])
+        self.assertEqual((0, 1), (parser.metrics_cache.hits, parser.metrics_cache.misses))
+        ## Results are written once the collection is saved
+        self.assertFalse(os.path.exists(parser.metrics_cache.filename))
+        save_metrics_caches()
+        parser = FlowcellRunMetricsParser(fcdir)
+        res = parser.parseRunInfo()
+        self.assertEqual("CC003CCCXX", res["Flowcell"])
+        self.assertEqual((1, 0), (parser.metrics_cache.hits, parser.metrics_cache.misses))
+        ## Results are copies of the cached values
+        res["Flowcell"] = "modified"
+        self.assertEqual("CC003CCCXX", parser.parseRunInfo()["Flowcell"])
+        ## Changed files are parsed again
+        with open(os.path.join(fcdir, "RunInfo.xml"), "w") as fh:
+            fh.write(RunInfo.replace("CC003CCCXX", "CC0004CCCXX"))
+        save_metrics_caches()
+        parser = FlowcellRunMetricsParser(fcdir)
+        self.assertEqual("CC0004CCCXX", parser.parseRunInfo()["Flowcell"])
+        self.assertEqual((0, 1), (parser.metrics_cache.hits, parser.metrics_cache.misses))
+
+    def test_metrics_cache_merge(self):
+        """Test that caches of a run directory saved by different processes keep each other's results"""
+        cachedir = os.path.join(self.rootdir, "cache")
+        files = []
+        for x in ["a", "b"]:
+            files.append(os.path.join(self.rootdir, x))
+            open(files[-1], "w").close()
+        (cache1, cache2) = (MetricsCache(self.rootdir, cachedir), MetricsCache(self.rootdir, cachedir))
+        cache1.get("parse", files[0:1], lambda: "a")
+        cache2.get("parse", files[1:2], lambda: "b")
+        cache1.save()
+        cache2.save()
+        cache = MetricsCache(self.rootdir, cachedir)
+        self.assertEqual(["a", "b"], [cache.get("parse", [f], lambda: None) for f in files])
+        self.assertEqual((2, 0), (cache.hits, cache.misses))
+
+    def test_read_fastqc_data(self):
+        """Test reading fastqc modules into typed columns"""
+        os.makedirs(os.path.join(self.rootdir, "fastqc"))
+        with open(os.path.join(self.rootdir, "fastqc", "fastqc_data.txt"), "w") as fh:
+            fh.write(FastQCData)
+        modules = read_fastqc_data(os.path.join(self.rootdir, "fastqc", "fastqc_data.txt"))
+        self.assertEqual(["Basic Statistics", "Per base sequence quality", "Per sequence quality scores", "Sequence Duplication Levels", "Overrepresented sequences"], modules.keys())
+        self.assertEqual("pass", modules["Per base sequence quality"].status)
+        self.assertEqual(["1", "10-11"], list(modules["Per base sequence quality"].columns["Base"]))
+        self.assertEqual("float64", str(modules["Per base sequence quality"].columns["Mean"].dtype))
+        self.assertEqual("int64", str(modules["Per sequence quality scores"].columns["Quality"].dtype))
+        self.assertEqual([], modules["Overrepresented sequences"].header)
+        stats = ExtendedFastQCParser(os.path.join(self.rootdir, "fastqc")).get_fastqc_summary()
+        self.assertEqual({"Measure":["Filename", "Total Sequences"], "Value":["1_120924_AC003CCCXX_2_1.fastq", "1000"]}, stats["Basic Statistics"])
+        self.assertEqual({"Quality":["2", "3"], "Count":["12.0", "108.0"]}, stats["Per sequence quality scores"])
+        self.assertEqual({}, stats["Overrepresented sequences"])
+        self.assertEqual({}, stats["Kmer Content"])
+
+class TestConfigIndex(unittest.TestCase):
+    """Test for the bcbb config index"""
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_bcbio_run_")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _write_config(self, sample, fc_name, barcode_id):
+        sampledir = os.path.join(self.rootdir, sample, "120924_{}".format(fc_name))
+        if not os.path.exists(sampledir):
+            os.makedirs(sampledir)
+        f = os.path.join(sampledir, "{}-bcbb-config.yaml".format(sample))
+        with open(f, "w") as fh:
+            fh.write("fc_name: {}\nfc_date: '120924'\ndetails:\n- lane: '1'\n  flowcell_id: {}\n  multiplex:\n  - name: {}\n    barcode_id: {}\n".format(fc_name, fc_name, sample, barcode_id))
+        return f
+
+    def test_config_index(self):
+        """Test that configs are parsed once, and again when changed"""
+        for sample, fc_name, barcode_id in [("P001_101", "AC003CCCXX", 1), ("P001_101", "BC003CCCXX", 2), ("P001_102", "AC003CCCXX", 3)]:
+            self._write_config(sample, fc_name, barcode_id)
+        flist = sorted(find_samples(self.rootdir, workers=2))
+        self.assertEqual(3, len(flist))
+        index = ConfigIndex()
+        for workers in [2, 1]:
+            samples = index.sample_table(flist, workers=workers)
+            self.assertEqual(["P001_101", "P001_101", "P001_102"], list(samples["sample"]))
+            self.assertEqual([1, 2, 3], list(samples["barcode_id"]))
+            self.assertEqual(os.path.dirname(flist[0]), samples["path"][0])
+        conf = index.get(flist[0])
+        self.assertIs(conf, index.get(flist[0]))
+        f = self._write_config("P001_101", "AC003CCCXX", 4)
+        ## Make sure the modification time changes
+        os.utime(f, (0, 0))
+        self.assertIsNot(conf, index.get(f))
+        self.assertEqual([4, 2, 3], list(index.sample_table(flist)["barcode_id"]))
+        self.assertEqual({"P001_101":{"AC003CCCXX":flist[0], "BC003CCCXX":flist[1]}, "P001_102":{"AC003CCCXX":flist[2]}}, _group_samples(flist))
+
@@ -1,7 +1,6 @@
 import os
 import yaml
 import couchdb
-from couchdb.design import ViewDefinition
 import unittest
 import logbook
 import xml.etree.cElementTree as ET
@@ -10,7 +9,8 @@ import shutil
 from classes import PmFullTest
 from ..classes import has_couchdb_installation
 
-from scilifelab.db.statusdb import SampleRunMetricsConnection, VIEWS, ProjectSummaryDocument, ProjectSummaryConnection, FlowcellRunMetricsConnection
+from scilifelab.db import fetch_entries, prefetch_entries
+from scilifelab.db.statusdb import SampleRunMetricsConnection, sync_views, update_views, get_qc_data, ProjectSummaryDocument, ProjectSummaryConnection, FlowcellRunMetricsConnection
 from scilifelab.bcbio.qc import FlowcellRunMetricsParser, SampleRunMetricsParser,  XmlToDict
 
 filedir = os.path.dirname(os.path.abspath(__file__))
@@ -201,11 +201,7 @@ def setUpModule():
     ## Create views for flowcells and samples
     for dbname in DATABASES:
         dblab = dbname.replace("-test", "")
-        db = server[dbname]
-        for k,v in VIEWS[dblab].items():
-            for title, view in v.items():
-                viewdef = ViewDefinition(k, title, view)
-                viewdef.sync(db)
+        sync_views(server[dbname], dblab)
     
     ## Create and upload project summary
     with open(os.path.join(filedir, "data", "config", "project_summary.yaml")) as fh:
@@ -284,6 +280,14 @@ class TestQCUpload(PmFullTest):
         self.assertIsNone(s["project_sample_name"])
         self.assertEqual(s["project_id"], "P003")
         
+    def test_qc_upload_workers(self):
+        """Test running qc upload with parallel sample metrics parsing"""
+        self.app = self.make_app(argv = ['qc', 'upload-qc', flowcells[1], '--mtime',  '100', '--workers', '2'], extensions=['scilifelab.pm.ext.ext_qc',  'scilifelab.pm.ext.ext_couchdb'])
+        self._run_app()
+        s = self.s_con.get_entry("4_120924_AC003CCCXX_CGTTAA")
+        self.assertEqual(s["project_id"], "P003")
+        self.assertIsNotNone(s["picard_metrics"])
+
     def test_qc_update(self):
         """Test running qc update of a project id"""
         s = self.s_con.get_entry("4_120924_AC003CCCXX_CGTTAA")
@@ -409,6 +413,38 @@ class TestDbConnection(unittest.TestCase):
         self.assertEqual(len(samples), 0)
         
                 
+    def test_prefetch(self):
+        """Test concurrent prefetching of documents across databases"""
+        sample_con = SampleRunMetricsConnection(dbname="samples-test", username=self.user, password=self.pw, url=self.url)
+        fc_con = FlowcellRunMetricsConnection(dbname="flowcells-test", username=self.user, password=self.pw, url=self.url)
+        keys = [(sample_con, x) for x in sample_con.name_view.keys()] + [(fc_con, "120924_AC003CCCXX"), (fc_con, "bogusflowcell")]
+        docs = {name:doc for (_, name, doc) in fetch_entries(keys, workers=2)}
+        self.assertEqual(len(docs), len(keys))
+        self.assertIsNone(docs["bogusflowcell"])
+        self.assertEqual(docs["120924_AC003CCCXX"]["name"], "120924_AC003CCCXX")
+        prefetch_entries(keys)
+        self.assertIn(self.examples["sample"], sample_con._entry_cache)
+        self.assertNotIn("bogusflowcell", fc_con._entry_cache)
+        self.assertEqual(str(sample_con.get_entry(self.examples["sample"], "flowcell")), self.examples["flowcell"])
+
+    def test_get_qc_data(self):
+        """Test getting qc data from the qc view"""
+        sample_con = SampleRunMetricsConnection(dbname="samples-test", username=self.user, password=self.pw, url=self.url)
+        qc_data = get_qc_data(self.examples["project"], self.p_con, sample_con, self.examples["flowcell"])
+        self.assertEqual(len(qc_data), 2)
+        for name, qc in qc_data.iteritems():
+            s = sample_con.get_entry(name)
+            self.assertEqual(qc["sample"], s["barcode_name"])
+            self.assertEqual(qc["TOTAL_READS"], int(s.get("picard_metrics", {}).get("AL_PAIR", {}).get("TOTAL_READS", -1)))
+        self.assertEqual(len(get_qc_data(self.examples["project"], self.p_con, sample_con)), 3)
+
+    def test_update_views(self):
+        """Test building all views of the samples database"""
+        sample_con = SampleRunMetricsConnection(dbname="samples-test", username=self.user, password=self.pw, url=self.url)
+        viewnames = update_views(sample_con.db, "samples", wait=True)
+        self.assertIn("qc/project_flowcell", viewnames)
+        self.assertEqual(len(viewnames), len(set(x.split("/")[0] for x in viewnames)))
+
     def test_get_project_sample_ids(self):
         """Test getting project sample ids"""
         sample_con = SampleRunMetricsConnection(dbname="samples-test", username=self.user, password=self.pw, url=self.url)
@@ -1,7 +1,9 @@
 import os
+import unittest
 from cement.core import backend, handler, output
 from cement.utils import test, shell
 from scilifelab.pm import PmApp
+from scilifelab.db.profile import PROFILE
 from data import setup_data_files
 from empty_files import setup_empty_files
 
@@ -73,3 +75,26 @@ class PmTest(test.CementTestCase):
         finally:
             self.app.close()
             
+
+class PmAppTest(unittest.TestCase):
+    """Tests for application options"""
+    def tearDown(self):
+        PROFILE.enabled = False
+        PROFILE.reset()
+
+    def _run_app(self, argv):
+        app = PmTestApp(argv=argv)
+        try:
+            app.setup()
+            app.run()
+        finally:
+            app.close()
+
+    def test_profile_db(self):
+        """Test that database profiling is enabled from the parsed arguments"""
+        PROFILE.enabled = False
+        self._run_app(['--debug'])
+        self.assertFalse(PROFILE.enabled)
+        ## Abbreviated options are expanded by the argument parser
+        self._run_app(['--profile-d'])
+        self.assertTrue(PROFILE.enabled)
@@ -60,6 +60,36 @@ class FlowcellTest(PmTest):
         self.eq(fc.barcode_sequence_to_name('2'), {'TGACCA': 'P2_104_index4a', 'CGATGT': 'P2_102_index12a', 'TTAGGC': 'P2_103_index3a', 'ATCACG': 'P2_101_index19a'})
         self.eq(fc.barcode_sequences('2'), ['ATCACG', 'CGATGT', 'TTAGGC', 'TGACCA'])
 
+    def test_subset_view(self):
+        """Test that subsets share entries with their flowcell, but flowcells do not share state"""
+        fc = Flowcell(runinfo)
+        newfc = fc.subset("lane", "2").subset("name", "P2_103_index3a")
+        self.eq(newfc.barcode_id_to_sequence('2'), {17: 'TTAGGC'})
+        fc.append_to_entry("2_TTAGGC", "files", "2_120829_AA001AAAXX_nophix_17_1_fastq.txt")
+        self.eq(newfc.get_entry("2_TTAGGC", "files"), ["2_120829_AA001AAAXX_nophix_17_1_fastq.txt"])
+        newfc.set_entry("2_TTAGGC", "sequence", "TTAGGA")
+        self.eq(fc.barcode_id_to_sequence('2')[17], "TTAGGA")
+        self.eq(fc.get_entry("2_TTAGGA", "name"), "P2_103_index3a")
+        self.eq(Flowcell(runinfo).get_entry("2_TTAGGC", "files"), [])
+        fc.lane_files['1'].append("1_120829_AA001AAAXX_nophix.bc_metrics")
+        self.eq(Flowcell(runinfo).lane_files['1'], [])
+
+    def test_file_classifier(self):
+        """Test classification of lane, sample and casava sample files"""
+        fc = Flowcell(runinfo)
+        classifier = fc.file_classifier()
+        self.eq(classifier.classify("1_120829_AA001AAAXX_nophix.bc_metrics"), ("lane", "1"))
+        self.eq(classifier.classify("2_120829_AA001AAAXX_nophix_unmatched_1_fastq.txt"), ("lane", "2"))
+        self.eq(classifier.classify("3_120829_AA001AAAXX_nophix.bc_metrics"), None)
+        self.eq(classifier.classify("2_120829_AA001AAAXX_nophix_17_1_fastq.txt"), ("files", "2_TTAGGC"))
+        self.eq(classifier.classify("2_120829_AA001AAAXX_nophix_17-sort-dup.align_metrics"), ("results", "2_TTAGGC"))
+        self.eq(classifier.classify("2_120829_AA001AAAXX_nophix_18_1_fastq.txt"), None)
+        self.eq(classifier.classify("P2_103_index3a_TTAGGC_L002_R1_001.fastq.gz"), ("files", "2_TTAGGC"))
+        self.eq(classifier.classify("P2_103_index3a-bcbb-command.txt"), ("results", "2_TTAGGC"))
+        self.eq(classifier.classify("P2_103_index3ab.txt"), ("results", "2_TTAGGC"))
+        self.eq(classifier.classify("P2_103_index3ab.txt", strict=True), None)
+        self.eq(classifier.classify("P2_105_index3a.txt"), None)
+
     def test_glob_str(self):
         """Test construction of glob prefixes"""
         fc = Flowcell(runinfo)
@@ -1,7 +1,9 @@
 import os
+import shutil
+import tempfile
 import unittest
 import logbook
-from scilifelab.report.qc import fastq_screen, application_qc
+from scilifelab.report.qc import fastq_screen, application_qc, compile_qc, qc_table, assess_qc, format_qc_table, multiplex_qc
 
 from ..classes import has_couchdb_installation
 
@@ -34,3 +36,63 @@ class TestReportQCFunctions(unittest.TestCase):
         """Test fastq screen summary"""
         data = fastq_screen(project_name=self.examples["project"], flowcell=self.examples["flowcell"].split("_")[-1], username=self.user, password=self.pw, dbname="samples-test", url=self.url)
         self.assertEqual(len(data['stdout'].getvalue().split()), 2)
+
+class TestQCTable(unittest.TestCase):
+    """Tests for project qc tables"""
+    def _qc(self, sample, total_reads=40000000, dup=10.0, aligned=90.0, on_target=70.0):
+        return {"sample":sample, "lane":"1", "flowcell":"AC003CCCXX", "date":"120924", "TOTAL_READS":total_reads,
+                "MEAN_INSERT_SIZE":180.0, "GENOME_SIZE":3000000000, "PERCENT_ON_TARGET":on_target,
+                "PERCENT_DUPLICATION":dup, "PCT_TARGET_BASES_10X":95.0, "PCT_PF_READS_ALIGNED":aligned}
+
+    def test_assess_qc(self):
+        """Test assessing qc column-wise"""
+        df = assess_qc(qc_table([self._qc("P001_101"), self._qc("P001_102", dup=40.0), self._qc("P001_103", aligned=50.0), self._qc("P001_104", on_target=50.0)]), "seqcap")
+        self.assertEqual(["OK", "HIGH", "OK", "OK"], list(df["dup_status"]))
+        self.assertEqual(["PASS", "PASS", "FAIL", "FAIL"], list(df["status"]))
+        self.assertEqual(["PASS", "PASS", "FAIL", "PASS"], list(assess_qc(qc_table(df.to_dict("records")), "reseq")["status"]))
+        lines = format_qc_table(df)
+        self.assertEqual("P001_101                1 AC003CCCXX  120924     20.00M     180.0       3.0G      70.0      10.0      95.0      90.0          OK        PASS", lines[0])
+        self.assertEqual([], format_qc_table(assess_qc(qc_table([]), "seqcap")))
+
+    def test_compile_qc(self):
+        """Test compiling qc data from metrics files"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for sample, barcode_id in [("P001_101", 1), ("P001_102", 2)]:
+            sampledir = os.path.join(path, sample, "120924_AC003CCCXX")
+            os.makedirs(sampledir)
+            with open(os.path.join(sampledir, "{}-bcbb-config.yaml".format(sample)), "w") as fh:
+                fh.write("fc_name: AC003CCCXX\nfc_date: '120924'\ndetails:\n- lane: '1'\n  multiplex:\n  - name: {}\n    barcode_id: {}\n".format(sample, barcode_id))
+            with open(os.path.join(sampledir, "1_120924_AC003CCCXX_nophix_{}-sort-dup.align_metrics".format(barcode_id)), "w") as fh:
+                fh.write("## METRICS CLASS\tnet.sf.picard.analysis.AlignmentSummaryMetrics\nCATEGORY\tTOTAL_READS\tPCT_PF_READS_ALIGNED\nPAIR\t2000000\t0,5\n\n")
+        for workers in [1, 2]:
+            data = compile_qc(path, application="reseq", project="J.Doe_00_01", workers=workers)
+            tab = sorted([x for x in data['stdout'].getvalue().split("\n") if x.startswith("P001")])
+            self.assertEqual(2, len(tab))
+            self.assertTrue(tab[1].startswith("P001_102"))
+            self.assertEqual(["1.00M", "50.0", "FAIL"], [tab[0].split()[4], tab[0].split()[-3], tab[0].split()[-1]])
+
+    def test_multiplex_qc(self):
+        """Test multiplex qc of a flowcell document"""
+        stats = [{"Sample ID":"P001_101", "Lane":"1", "Index":"ACAGTG", "Project":"J.Doe_00_01", "# Reads":"100,000,000"},
+                 {"Sample ID":"P001_102", "Lane":"1", "Index":"GCCAAT", "Project":"J.Doe_00_01", "# Reads":"40,000,000"},
+                 {"Sample ID":"lane1", "Lane":"1", "Index":"Undetermined", "Project":"Undetermined_indices", "# Reads":"60,000,000"},
+                 {"Sample ID":"P001_103", "Lane":"2", "Index":"ACAGTG", "Project":"J.Doe_00_01", "# Reads":"300,000,000"}]
+        fc_doc = {"name":"120924_AC003CCCXX",
+                  "illumina":{"Demultiplex_Stats":{"Barcode_lane_statistics":stats},
+                              "Summary":{"read1":{"ReadType":"Read", "1":{"ErrRatePhiX":"0.5"}, "2":{"ErrRatePhiX":"0"}},
+                                         "read2":{"ReadType":"(Index)", "1":{"ErrRatePhiX":"3.0"}},
+                                         "read3":{"ReadType":"Read", "1":{"ErrRatePhiX":"1.5"}}}},
+                  "undemultiplexed_barcodes":{"1":{"undemultiplexed_barcodes":{"count":["2000000", "10"], "sequence":["AAAAAA", "CCCCCC"], "index_name":["", "index1"]}}}}
+        rows = [[str(x) for x in row] for row in multiplex_qc(fc_doc)]
+        self.assertEqual([["PASS", "PhiX error rate", "1", "1.0", "0.0 < PhiX e (%) <= 2.0"],
+                          ["N/A", "PhiX error rate", "2", "-1", "0.0 < PhiX e (%) <= 2.0"],
+                          ["FAIL", "Lane yield", "1", "100000000", "[Yield >= 143000000]"],
+                          ["PASS", "Lane yield", "2", "150000000", "[Yield >= 143000000]"],
+                          ["PASS", "Sample yield", "1", "J.Doe_00_01", "P001_101", "50000000", "[Yield >= 35750000]"],
+                          ["FAIL", "Sample yield", "1", "J.Doe_00_01", "P001_102", "20000000", "[Yield >= 35750000]"],
+                          ["PASS", "Sample yield", "2", "J.Doe_00_01", "P001_103", "150000000", "[Yield >= 71500000]"],
+                          ["FAIL", "Index read", "1", "30000000", "[Undetermined < 10000000.0]"],
+                          ["PASS", "Index read", "2", "0", "[Undetermined < 15000000.0]"],
+                          ["FAIL", "Index", "1", "AAAAAA", "", "2000000", "[Undetermined index < 1000000]"],
+                          ["PASS", "Index", "1", "CCCCCC", "index1", "10", "[Undetermined index < 1000000]"]], rows)
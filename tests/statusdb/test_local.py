@@ -0,0 +1,251 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+import logbook
+from distutils.spawn import find_executable
+from scilifelab.db import ChangesTracker
+from scilifelab.db.local import LocalServer, replicate
+from scilifelab.db.statusdb import SampleRunMetricsConnection, ProjectSummaryConnection, SampleRunMetricsDocument, ProjectSummaryDocument, get_qc_data, content_hash, update_views, update_fn, VIEWS, LOCAL_VIEWS, QC_VIEW_FIELDS, _sample_qc_row
+
+LOG = logbook.Logger(__name__)
+
+# Evaluate javascript map functions on documents, collecting emitted
+# rows the way couchdb does
+MAP_JS = """
+var input = JSON.parse(require("fs").readFileSync(0, "utf8"));
+var out = {};
+Object.keys(input.views).forEach(function (name) {
+    var rows = [];
+    var emit = function (k, v) {rows.push([k === undefined ? null : k, v === undefined ? null : v]);};
+    var fn = eval(input.views[name].replace(/function/, "(function") + ")");
+    input.docs.forEach(function (doc) {try {fn(doc);} catch (e) {}});
+    out[name] = rows;
+});
+console.log(JSON.stringify(out));
+"""
+
+# Values that javascript parseFloat and python float disagree on
+QC_ODD_METRICS = {"AL_PAIR":{"TOTAL_READS":"12abc", "PCT_PF_READS_ALIGNED":"1."},
+                  "DUP_metrics":{"PERCENT_DUPLICATION":""},
+                  "INS_metrics":{"MEAN_INSERT_SIZE":"NaN"},
+                  "HS_metrics":{"GENOME_SIZE":1000, "FOLD_ENRICHMENT":"1e400", "PCT_USABLE_BASES_ON_TARGET":" 0,5",
+                                "PCT_TARGET_BASES_10X":True, "TARGET_TERRITORY":"Infinity"}}
+
+VIEW_DOCS = {"samples":[{"_id":"s1", "name":"1_120924_AC003CCCXX_ACGT", "barcode_name":"P1_101_index1", "sample_prj":"J.Doe_00_01",
+                         "flowcell":"AC003CCCXX", "lane":"1", "date":"120924", "content_hash":"abc",
+                         "picard_metrics":{"AL_PAIR":{"TOTAL_READS":"1000", "PCT_PF_READS_ALIGNED":"0,5"},
+                                           "DUP_metrics":{"PERCENT_DUPLICATION":"0.1"}, "HS_metrics":{"GENOME_SIZE":"x"}}},
+                        {"_id":"s2", "name":"1_120924_AC003CCCXX_ACGT_1", "flowcell":"AC003CCCXX"},
+                        {"_id":"s3", "name":"2_120924_AC003CCCXX_TGCA", "flowcell":"AC003CCCXX"},
+                        {"_id":"s4"},
+                        {"_id":"s5", "name":"3_120924_AC003CCCXX_ACGT", "picard_metrics":QC_ODD_METRICS}],
+             "flowcells":[{"_id":"f1", "name":"120924_AC003CCCXX", "content_hash":"abc"}, {"_id":"f2"}],
+             "projects":[{"_id":"p1", "project_name":"J.Doe_00_01", "project_id":"P1", "content_hash":"abc"},
+                         {"_id":"p2", "project_name":"J.Doe_00_02"}]}
+
+class TestLocalDatabase(unittest.TestCase):
+    """Tests for the embedded database backend"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = "sqlite://{}".format(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _sample(self, lane, sequence, barcode_name, flowcell="AC003CCCXX", sample_prj="J.Doe_00_01", total_reads=1000):
+        s = SampleRunMetricsDocument(flowcell=flowcell, date="120924", lane=lane, sequence=sequence,
+                                     barcode_name=barcode_name, sample_prj=sample_prj)
+        s["picard_metrics"] = {"AL_PAIR":{"TOTAL_READS":str(total_reads), "PCT_PF_READS_ALIGNED":"0,5"}}
+        return s
+
+    def test_database(self):
+        """Test saving, updating and querying documents"""
+        db = LocalServer(self.url)["test"]
+        db.define_views({"names/name":lambda doc: [(doc["name"], None)],
+                         "names/count":{"map":lambda doc: [([doc["group"], doc["name"]], 1)], "reduce":"_count"}})
+        doc = {"name":"a", "group":"x"}
+        db.save(doc)
+        self.assertTrue(doc["_rev"].startswith("1-"))
+        db.save({"name":"b", "group":"x"})
+        db.save({"name":"c", "group":"y"})
+        doc["name"] = "d"
+        db.save(doc)
+        self.assertTrue(doc["_rev"].startswith("2-"))
+        self.assertEqual(["b", "c", "d"], [x.key for x in db.view("names/name")])
+        self.assertEqual(doc["_id"], db.view("names/name", key="d").rows[0].id)
+        self.assertEqual([], db.view("names/name", key="a").rows)
+        self.assertEqual(["b", "d"], [x.key[1] for x in db.view("names/count", reduce=False, startkey=["x"], endkey=["x", {}])])
+        self.assertEqual(3, db.view("names/count").rows[0].value)
+        self.assertEqual([1, 1], [x.value for x in db.view("names/count", group=True, startkey=["x"], endkey=["x", {}])])
+        self.assertEqual(["d", "b"], [x.key[1] for x in db.view("names/count", reduce=False, descending=True, startkey=["x", {}], endkey=["x"])])
+        self.assertEqual(["c"], [x.key for x in db.view("names/name", skip=1, limit=1)])
+        self.assertEqual(["c", "d"], [x.key for x in db.view("names/name", startkey="bb", endkey="d")])
+        self.assertEqual(4, db.changes()["last_seq"])
+        self.assertEqual(["c", "d"], [x["doc"]["name"] for x in db.changes(since=2, include_docs=True)["results"]])
+        db.delete(doc)
+        self.assertEqual(["b", "c"], [x.key for x in db.view("names/name")])
+        self.assertTrue(db.changes(since=4)["results"][0]["deleted"])
+
+    def test_view_rebuild(self):
+        """Test that views are rebuilt when defined on an existing database"""
+        db = LocalServer(self.url)["test"]
+        db.save({"name":"a"})
+        db = LocalServer(self.url)["test"]
+        db.define_views({"names/name":lambda doc: [(doc["name"], None)]})
+        self.assertEqual(["a"], [x.key for x in db.view("names/name")])
+
+    def test_update_views(self):
+        """Test that update_views skips views missing in the database"""
+        db = LocalServer(self.url)["test"]
+        db.define_views({"names/name":lambda doc: [(doc["name"], None)]})
+        views = {"samples":{"names":{"name":"function(doc) {emit(doc.name, null);}"},
+                            "qc":{"project_flowcell":"function(doc) {emit(doc.name, null);}"}}}
+        self.assertEqual(["names/name"], update_views(db, "samples", views=views))
+
+    @unittest.skipIf(not find_executable("node"), "no node executable for evaluating javascript views")
+    def test_local_views(self):
+        """Test that the python views emit the same rows as the javascript views"""
+        for label, docs in VIEW_DOCS.iteritems():
+            views = {"{}/{}".format(design, title):view.get("map") if isinstance(view, dict) else view
+                     for design, v in VIEWS[label].iteritems() for title, view in v.iteritems()}
+            self.assertEqual(sorted(views.keys()), sorted(LOCAL_VIEWS[label].keys()))
+            proc = subprocess.Popen(["node", "-e", MAP_JS], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            js_rows = json.loads(proc.communicate(json.dumps({"views":views, "docs":docs}))[0])
+            for name, view in LOCAL_VIEWS[label].iteritems():
+                fn = view["map"] if isinstance(view, dict) else view
+                rows = []
+                for doc in docs:
+                    try:
+                        rows.extend([[k, v] for k, v in fn(doc)])
+                    except Exception:
+                        pass
+                self.assertEqual(js_rows[name], json.loads(json.dumps(rows)), "view {} in {}".format(name, label))
+
+    def test_sample_qc_row(self):
+        """Test that picard metrics that are not numbers are read as missing"""
+        row = dict(zip(QC_VIEW_FIELDS, _sample_qc_row({"picard_metrics":QC_ODD_METRICS})))
+        self.assertEqual({"TOTAL_READS":-1, "PERCENT_DUPLICATION":-100, "MEAN_INSERT_SIZE":-1, "GENOME_SIZE":1000,
+                          "FOLD_ENRICHMENT":-1, "PCT_USABLE_BASES_ON_TARGET":-100, "PCT_TARGET_BASES_10X":-100,
+                          "PCT_PF_READS_ALIGNED":100.0, "TARGET_TERRITORY":-1}, {k:v for k, v in row.iteritems() if k in QC_VIEW_FIELDS[6:]})
+
+    def test_connections(self):
+        """Test statusdb connections on a local database"""
+        s_con = SampleRunMetricsConnection(dbname="samples-test", url=self.url)
+        for s in [self._sample(1, "ACGT", "P1_101_index1"), self._sample(1, "TGCA", "P1_102_index2", total_reads=2000),
+                  self._sample(2, "ACGT", "P2_101_index1", flowcell="BB002BBBXX", sample_prj="J.Doe_00_02")]:
+            s_con.save(s)
+        # An unmodified document is not saved again
+        s_con.save(self._sample(1, "ACGT", "P1_101_index1"))
+        self.assertEqual(3, s_con.db.changes()["last_seq"])
+        s_con = SampleRunMetricsConnection(dbname="samples-test", url=self.url)
+        self.assertEqual(2, len(s_con.get_sample_ids(sample_prj="J.Doe_00_01")))
+        self.assertEqual(["P2_101_index1"], [x["barcode_name"] for x in s_con.get_samples(fc_id="BB002BBBXX")])
+        p_con = ProjectSummaryConnection(dbname="projects-test", url=self.url)
+        p_con.save(ProjectSummaryDocument(project_name="J.Doe_00_01", samples={"P1_101":{}, "P1_102":{}}))
+        p_con = ProjectSummaryConnection(dbname="projects-test", url=self.url)
+        qc_data = get_qc_data("J.Doe_00_01", p_con, s_con)
+        self.assertEqual([1000, 2000], sorted([x["TOTAL_READS"] for x in qc_data.values()]))
+        self.assertEqual([50.0, 50.0], [x["PCT_PF_READS_ALIGNED"] for x in qc_data.values()])
+
+    def test_update(self):
+        """Test that documents are only saved when their content has changed"""
+        s_con = SampleRunMetricsConnection(dbname="samples-test", url=self.url)
+        s = self._sample(1, "ACGT", "P1_101_index1")
+        s_con.save(s)
+        self.assertEqual(content_hash(s), s_con.db.view("names/name_hash", key=s["name"]).rows[0].value)
+        s = self._sample(1, "ACGT", "P1_101_index1", total_reads=2000)
+        s_con.save(s)
+        self.assertEqual(2, s_con.db.changes()["last_seq"])
+        self.assertEqual("2000", s_con.db.get(s["_id"])["picard_metrics"]["AL_PAIR"]["TOTAL_READS"])
+        # Documents without content hash are compared by content and
+        # have the hash written back once
+        doc = s_con.db.get(s["_id"])
+        del doc["content_hash"]
+        s_con.db.save(doc)
+        s_con.save(self._sample(1, "ACGT", "P1_101_index1", total_reads=2000))
+        self.assertEqual(4, s_con.db.changes()["last_seq"])
+        self.assertEqual(content_hash(s), s_con.db.get(s["_id"])["content_hash"])
+        self.assertEqual(doc["modification_time"], s_con.db.get(s["_id"])["modification_time"])
+        s_con.save(self._sample(1, "ACGT", "P1_101_index1", total_reads=2000))
+        self.assertEqual(4, s_con.db.changes()["last_seq"])
+
+    def test_update_fallback(self):
+        """Test that update_fn uses the id_to_name view of the design document of viewname if viewname is missing"""
+        db = LocalServer(self.url)["test"]
+        db.define_views({"projects/id_to_name":lambda doc: [(doc["_id"], doc.get("project_name", None))]})
+        db.save({"_id":"p1", "project_name":"J.Doe_00_01"})
+        (obj, dbid) = update_fn(None, db, {"project_name":"J.Doe_00_01"}, viewname="projects/project_hash", key="project_name")
+        self.assertEqual("p1", dbid.id)
+        self.assertEqual("p1", obj["_id"])
+
+    def test_save_many(self):
+        """Test saving documents in bulk"""
+        s_con = SampleRunMetricsConnection(dbname="samples-test", url=self.url)
+        s_con.save(self._sample(1, "ACGT", "P1_101_index1"))
+        saved = s_con.save_many([self._sample(1, "ACGT", "P1_101_index1"), self._sample(1, "ACGT", "P1_101_index1", sample_prj="J.Doe_00_02"),
+                                 self._sample(1, "TGCA", "P1_102_index2")])
+        self.assertEqual(["P1_101_index1", "P1_102_index2"], [x["barcode_name"] for x in saved])
+        self.assertEqual(3, s_con.db.changes()["last_seq"])
+        self.assertEqual("J.Doe_00_02", s_con.db.get(saved[0]["_id"])["sample_prj"])
+        unchanged = []
+        self.assertEqual([], s_con.save_many([self._sample(1, "TGCA", "P1_102_index2")], unchanged=unchanged))
+        self.assertEqual(["P1_102_index2"], [x["barcode_name"] for x in unchanged])
+
+    def test_save_invalidates_cache(self):
+        """Test that saving a new object for a prefetched name updates the cached entry"""
+        s_con = SampleRunMetricsConnection(dbname="samples-test", url=self.url)
+        s_con.save(self._sample(1, "ACGT", "P1_101_index1"))
+        s_con = SampleRunMetricsConnection(dbname="samples-test", url=self.url)
+        name = self._sample(1, "ACGT", "P1_101_index1")["name"]
+        s_con.prefetch([name])
+        self.assertIn(name, s_con._entry_cache)
+        s_con.save(self._sample(1, "ACGT", "P1_101_index1", total_reads=2000))
+        self.assertEqual("2000", s_con.get_entry(name, "picard_metrics")["AL_PAIR"]["TOTAL_READS"])
+        s_con.prefetch([name])
+        s_con.save_many([self._sample(1, "ACGT", "P1_101_index1", total_reads=3000)])
+        self.assertEqual("3000", s_con.get_entry(name, "picard_metrics")["AL_PAIR"]["TOTAL_READS"])
+
+    def test_content_hash(self):
+        """Test that content hashes ignore meta fields and empty values"""
+        self.assertEqual(content_hash({"name":"a", "lane":"1"}), content_hash({"lane":u"1", "name":"a", "_id":"x", "_rev":"1-x", "modification_time":"now", "sample_prj":None}))
+        self.assertNotEqual(content_hash({"name":"a", "lane":"1"}), content_hash({"name":"a", "lane":"2"}))
+
+    def test_replicate(self):
+        """Test copying documents between databases by name"""
+        source = SampleRunMetricsConnection(dbname="samples-source", url=self.url)
+        target = SampleRunMetricsConnection(dbname="samples-target", url=self.url)
+        for s in [self._sample(1, "ACGT", "P1_101_index1", total_reads=2000), self._sample(1, "TGCA", "P1_102_index2"),
+                  self._sample(2, "ACGT", "P2_101_index1")]:
+            source.save(s)
+        target.save(self._sample(1, "ACGT", "P1_101_index1"))
+        target.save(self._sample(1, "TGCA", "P1_102_index2"))
+        tracker = ChangesTracker(source.db, statefile=os.path.join(self.tmpdir, "changes.json"))
+        ## The unchanged document is not copied, the modified one updates the target document of the same name
+        self.assertEqual(2, replicate(source.db, target.db, target._update_fn, tracker=tracker))
+        rows = target.db.view("names/name").rows
+        self.assertEqual(3, len(rows))
+        self.assertEqual("2000", target.db.get(target.db.view("names/name", key=self._sample(1, "ACGT", "P1_101_index1")["name"]).rows[0].id)["picard_metrics"]["AL_PAIR"]["TOTAL_READS"])
+        self.assertEqual(source.db.changes()["last_seq"], ChangesTracker(source.db, statefile=tracker.statefile).last_seq)
+        ## Documents deleted in the source are deleted in the target
+        doc = source.db.get(source.db.view("names/name", key=self._sample(2, "ACGT", "P2_101_index1")["name"]).rows[0].id)
+        source.db.delete(doc)
+        self.assertEqual(1, replicate(source.db, target.db, target._update_fn, tracker=ChangesTracker(source.db, statefile=tracker.statefile)))
+        self.assertEqual(2, len(target.db.view("names/name").rows))
+
+    def test_replicate_failure(self):
+        """Test that the changes tracker is only committed up to the last copied document"""
+        source = LocalServer(self.url)["source"]
+        target = LocalServer(self.url)["target"]
+        for name in ["a", "b", "c"]:
+            source.save({"_id":name, "name":name})
+        target.save({"_id":"b", "name":"old"})
+        ## Match by id, so that the new document b conflicts with the target document
+        def update_fn(db, doc):
+            return (doc, None)
+        tracker = ChangesTracker(source, statefile=os.path.join(self.tmpdir, "changes.json"))
+        self.assertEqual(2, replicate(source, target, update_fn, tracker=tracker))
+        self.assertEqual(1, ChangesTracker(source, statefile=tracker.statefile).last_seq)
+        self.assertEqual("old", target["b"]["name"])
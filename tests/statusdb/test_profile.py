@@ -0,0 +1,42 @@
+import shutil
+import tempfile
+import unittest
+from scilifelab.db.profile import PROFILE, ProfiledDatabase
+from scilifelab.db.statusdb import SampleRunMetricsConnection, SampleRunMetricsDocument
+
+class TestDbProfile(unittest.TestCase):
+    """Tests for database request instrumentation"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = "sqlite://{}".format(self.tmpdir)
+        PROFILE.enable()
+        PROFILE.reset()
+
+    def tearDown(self):
+        PROFILE.enabled = False
+        PROFILE.reset()
+        shutil.rmtree(self.tmpdir)
+
+    def test_profile(self):
+        """Test recording requests of a connection"""
+        s_con = SampleRunMetricsConnection(dbname="samples-test", url=self.url)
+        self.assertIsInstance(s_con.db, ProfiledDatabase)
+        s_con.save(SampleRunMetricsDocument(flowcell="AC003CCCXX", date="120924", lane=1, sequence="ACGT", barcode_name="P1_101_index1"))
+        s_con = SampleRunMetricsConnection(dbname="samples-test", url=self.url)
+        name = "1_120924_AC003CCCXX_ACGT"
+        s_con.prefetch([name])
+        s_con.get_entry(name)
+        s_con.get_entry(name)
+        stats = PROFILE.stats()
+        self.assertEqual(1, stats[("samples-test", "save")]["calls"])
+        self.assertEqual(2, stats[("samples-test", "view names/name")]["calls"])
+        self.assertEqual(1, stats[("samples-test", "get")]["calls"])
+        self.assertEqual({'calls':2, 'hits':2}, {k:v for k, v in stats[("samples-test", "get_entry")].iteritems() if k in ['calls', 'hits']})
+        self.assertIn("view names/name", PROFILE.summary())
+
+    def test_disabled(self):
+        """Test that nothing is recorded when profiling is disabled"""
+        PROFILE.enabled = False
+        s_con = SampleRunMetricsConnection(dbname="samples-test", url=self.url)
+        self.assertNotIsInstance(s_con.db, ProfiledDatabase)
+        self.assertEqual({}, PROFILE.stats())
@@ -1,11 +1,16 @@
 import os
 import re
+import json
+import shutil
+import tempfile
 import unittest
 import logbook
 
 import subprocess 
 
-from scilifelab.utils.misc import walk, filtered_walk, safe_makedir
+from scilifelab.utils.misc import walk, filtered_walk, fast_walk, safe_makedir
+from scilifelab.utils.manifest import enable_manifest_cache, disable_manifest_cache, get_manifest, get_input_manifest, save_manifests
+from scilifelab.utils.journal import Journal
 
 filedir = os.path.abspath(__file__)
 LOG = logbook.Logger(__name__)
@@ -45,6 +50,19 @@ class TestMisc(unittest.TestCase):
         flist = filtered_walk("data", filter_fn=self.filter_fn, include_dirs=["nophix"], exclude_dirs=["fastqc"])
         self.assertEqual(set(flist), set(['data/nophix/file1.txt']))
 
+    def test_filtered_walk_workers(self):
+        """Perform a filtered walk of data dir with several threads, lazily"""
+        flist = filtered_walk("data", filter_fn=self.filter_fn, exclude_dirs=["nophix"], workers=4, lazy=True)
+        self.assertFalse(isinstance(flist, list))
+        self.assertEqual(list(flist), filtered_walk("data", filter_fn=self.filter_fn, exclude_dirs=["nophix"]))
+
+    def test_fast_walk(self):
+        """Compare fast walk to os.walk"""
+        self.assertEqual(list(fast_walk("data")), list(os.walk("data")))
+        self.assertEqual(list(fast_walk("data", workers=3)), list(os.walk("data")))
+        pruned = [x[0] for x in fast_walk("data", exclude_fn=lambda x: os.path.basename(x) == "fastqc")]
+        self.assertEqual(set(pruned), set(["data", "data/alignments", "data/nophix"]))
+
     # FIX ME: what should filtered walk return?!? If not subdirectories of fastqc then ok
     def test_filtered_walk_get_dirs(self):
         """Perform a filtered walk of data dir, getting dirs"""
@@ -53,3 +71,121 @@ class TestMisc(unittest.TestCase):
         flist = filtered_walk("data", filter_fn=self.filter_fn, include_dirs=["nophix"], exclude_dirs=["fastqc"], get_dirs=False)
         self.assertEqual(set(flist), set(['data/nophix/file1.txt']))
 
+
+class TestManifest(unittest.TestCase):
+    """Tests for directory manifest caching"""
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.rootdir = tempfile.mkdtemp()
+        for d in ["a", "a/b", "c"]:
+            os.makedirs(os.path.join(self.rootdir, d))
+            open(os.path.join(self.rootdir, d, "file.txt"), "w").close()
+        self._age()
+        enable_manifest_cache(self.cachedir)
+
+    def tearDown(self):
+        disable_manifest_cache()
+        shutil.rmtree(self.cachedir)
+        shutil.rmtree(self.rootdir)
+
+    def _age(self, t=1000000000):
+        """Set directory modification times in the past so that listings are cached"""
+        for root, dirs, files in os.walk(self.rootdir):
+            os.utime(root, (t, t))
+
+    def test_manifest(self):
+        """Test that listings of unmodified directories are reused"""
+        flist = walk(self.rootdir)
+        self.assertEqual(flist, walk(self.rootdir))
+        self.assertEqual(flist, [os.path.join(root, x) for root, dirs, files in os.walk(self.rootdir) for x in files])
+        manifest = get_manifest(self.rootdir)
+        self.assertEqual(4, len(manifest._entries))
+        self.assertFalse(os.path.exists(manifest.filename))
+        save_manifests()
+        ## Modify a cached listing: it is used as long as the directory is unmodified
+        with open(manifest.filename) as fh:
+            data = json.load(fh)
+        data["entries"]["c"][2].append("cached.txt")
+        with open(manifest.filename, "w") as fh:
+            json.dump(data, fh)
+        manifest.load()
+        self.assertIn(os.path.join(self.rootdir, "c", "cached.txt"), walk(self.rootdir))
+        open(os.path.join(self.rootdir, "c", "new.txt"), "w").close()
+        self._age(1000000100)
+        flist = walk(self.rootdir)
+        self.assertIn(os.path.join(self.rootdir, "c", "new.txt"), flist)
+        self.assertNotIn(os.path.join(self.rootdir, "c", "cached.txt"), flist)
+
+    def test_manifest_racy(self):
+        """Test that recently modified directories are not cached"""
+        open(os.path.join(self.rootdir, "c", "new.txt"), "w").close()
+        walk(self.rootdir)
+        self.assertNotIn("c", get_manifest(self.rootdir)._entries)
+        self.assertIn("a", get_manifest(self.rootdir)._entries)
+
+    def test_manifest_merge(self):
+        """Test that walks of different parts of a tree keep each other's listings"""
+        list(fast_walk(self.rootdir, lambda x: os.path.basename(x) == "a"))
+        save_manifests()
+        list(fast_walk(self.rootdir, lambda x: os.path.basename(x) == "c"))
+        save_manifests()
+        enable_manifest_cache(self.cachedir)
+        self.assertEqual([".", "a", "a/b", "c"], sorted(get_manifest(self.rootdir)._entries.keys()))
+        ## Removed directories are dropped
+        shutil.rmtree(os.path.join(self.rootdir, "a"))
+        self._age(1000000100)
+        walk(self.rootdir)
+        save_manifests()
+        enable_manifest_cache(self.cachedir)
+        self.assertEqual([".", "c"], sorted(get_manifest(self.rootdir)._entries.keys()))
+
+    def test_input_manifest(self):
+        """Test that documents are only changed if the content of their input files changes"""
+        files = [os.path.join(self.rootdir, "a", "file.txt"), os.path.join(self.rootdir, "c", "file.txt")]
+        for f in files:
+            os.utime(f, (1000000000, 1000000000))
+        manifest = get_input_manifest("120924_AC003CCCXX")
+        self.assertTrue(manifest.changed("sample", files))
+        manifest.record("sample", files)
+        ## Records are not kept until saved
+        self.assertTrue(get_input_manifest("120924_AC003CCCXX").changed("sample", files))
+        ## Discarded records, e.g. of documents that failed to save, are not saved
+        manifest.record("flowcell", files)
+        manifest.discard("flowcell")
+        manifest.save()
+        self.assertTrue(get_input_manifest("120924_AC003CCCXX").changed("flowcell", files))
+        manifest = get_input_manifest("120924_AC003CCCXX")
+        self.assertFalse(manifest.changed("sample", files))
+        self.assertFalse(manifest.changed("sample"))
+        self.assertTrue(manifest.changed("sample", files[0:1]))
+        ## Touching a file does not change its content
+        os.utime(files[0], (1000000100, 1000000100))
+        self.assertFalse(manifest.changed("sample", files))
+        with open(files[0], "w") as fh:
+            fh.write("modified")
+        self.assertTrue(manifest.changed("sample", files))
+        os.unlink(files[1])
+        self.assertTrue(get_input_manifest("120924_AC003CCCXX").changed("sample"))
+
+class TestJournal(unittest.TestCase):
+    """Tests for progress journals"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_journal(self):
+        """Test resuming from a journal"""
+        filename = os.path.join(self.tmpdir, "pm", "upload.journal")
+        journal = Journal(filename)
+        self.assertEqual(0, len(journal))
+        journal.record("120924_AC003CCCXX")
+        journal.record("121015_BB002BBBXX")
+        ## An entry cut short by an interruption
+        with open(filename, "a") as fh:
+            fh.write("121113_BB00")
+        journal = Journal(filename)
+        self.assertEqual(3, len(journal))
+        self.assertIn("120924_AC003CCCXX", journal)
+        self.assertNotIn("121113_BB002BBBXX", journal)